@@ -0,0 +1,775 @@
+"""
+A calibration session loads a dataset once and then runs several calibrations with it, e.g. with different noise in
+the initial guess, sampling seeds or selections of collections and sensors, returning the results as python objects.
+"""
+
+# -------------------------------------------------------------------------------
+# --- IMPORTS
+# -------------------------------------------------------------------------------
+
+# Standard imports
+import argparse
+import copy
+import multiprocessing
+import os
+import random
+import sys
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+
+# Atom imports
+from colorama import Fore, Style
+from atom_core.optimization_utils import Optimizer, addArguments
+from atom_calibration.calibration.getters_and_setters import (getterCameraIntrinsics, getterTransform,
+                                                              setterCameraIntrinsics, setterTransform)
+from atom_calibration.calibration.objective_function import clearCaches, errorReport, objectiveFunction
+from atom_calibration.calibration.residual_layout import ResidualLayout
+from atom_calibration.calibration.jacobian import jacobianFunction, supported_modalities
+from atom_calibration.calibration.visualization import setupVisualization, VisualizationPublisher
+from atom_core.dataset_io import (addNoiseToInitialGuess, checkIfAtLeastOneLabeledCollectionPerSensor,
+                                  filterCollectionsFromDataset, filterSensorsFromDataset, loadResultsJSON,
+                                  saveAtomDataset, filterJointsFromDataset, filterAdditionalTfsFromDataset)
+from atom_core.naming import generateName, generateKey
+from atom_core.utilities import atomError, waitForKeyPress2, verifyAnchoredSensor
+from atom_core.xacro_io import saveResultsXacro
+from atom_core.results_yml_io import saveResultsYml
+
+# ------------------------
+# DATA STRUCTURES   ##
+# ------------------------
+CalibrationResultT = namedtuple('CalibrationResultT',
+                                'dataset selected_collection_key transforms_list parameters residuals errors')
+
+# Session used by the forked processes of CalibrationSession.calibrateMany. It is set before forking, so the processes
+# share the loaded dataset (copy on write) instead of receiving a pickled copy of it.
+forked_session = None
+
+
+# -------------------------------------------------------------------------------
+# --- FUNCTIONS
+# -------------------------------------------------------------------------------
+def addCalibrationArguments(ap):
+    """ Adds to an argument parser the command line arguments of a calibration.
+
+    :param ap: an argparse.ArgumentParser
+    :return: the argument parser
+    """
+    ap = addArguments(ap)
+    ap.add_argument("-json", "--json_file", type=str, required=True,
+                    help="Json file containing input dataset.", )
+    ap.add_argument("-v", "--verbose", help="Be verbose",
+                    action="store_true", default=False)
+    ap.add_argument("-snv", "--show_normalized_values", action="store_true", default=False,
+                    help="In the output table, shows normalized residuals alongside the original values.")
+    ap.add_argument("-rv", "--ros_visualization",
+                    help="Publish ros visualization markers.", action="store_true")
+    ap.add_argument("-si", "--show_images", action="store_true",
+                    default=False, help="shows images for each camera")
+    ap.add_argument("-vr", "--visualization_rate", type=float, default=10,
+                    help="Maximum rate (Hz) at which the ros visualization is published during the optimization.")
+    ap.add_argument("-ipt", "--images_per_tick", type=int, default=4,
+                    help="Maximum number of images published at each tick of the ros visualization. 0 for all.")
+    ap.add_argument("-oi", "--optimize_intrinsics", action="store_true", default=False,
+                    help="Adds camera instrinsics to the  ptimization",)
+    ap.add_argument("-sr", "--sample_residuals",
+                    help="Samples residuals", type=float, default=1)
+    ap.add_argument("-ss", "--sample_seed", help="Sampling seed", type=int)
+    ap.add_argument("-slr", "--sample_longitudinal_residuals",
+                    help="Samples residuals", type=float, default=1)
+    ap.add_argument("-ajf", "--all_joints_fixed", action="store_true", default=False,
+                    help="Assume all joints are fixed and because of that draw a single robot mesh."
+                    "Overrides automatic detection of static robot.")
+    ap.add_argument("-oas", "--only_anchored_sensor", action="store_true", default=False,
+                    help="Runs optimization only using the anchored sensor and discarding all others.")
+    ap.add_argument("-ap", "--anchor_patterns", action="store_true", default=False,
+                    help="Runs optimization without changing the poses of the patterns.")
+    ap.add_argument("-uic", "--use_incomplete_collections", action="store_true", default=False,
+                    help="Remove any collection which does not have a detection for all sensors.", )
+    ap.add_argument("-ias", "--ignore_anchored_sensor", action="store_true", default=False,
+                    help="Ignore the anchored sensor information in the dataset.", )
+    ap.add_argument("-rpd", "--remove_partial_detections", help="Remove detected labels which are only partial."
+                            "Used or the Charuco.", action="store_true", default=False)
+    ap.add_argument("-nig", "--noisy_initial_guess", nargs=2, metavar=("translation", "rotation"),
+                    help="Percentage of noise to add to the initial guess atomic transformations set before starting optimization.",
+                    type=float, default=[0.0, 0.0],),
+    ap.add_argument("-ssf", "--sensor_selection_function", default=None, type=lambda s: eval(s, globals()),
+                    help="A string to be evaluated into a lambda function that receives a sensor name as input and "
+                    "returns True or False to indicate if the sensor should be loaded (and used in the "
+                    "optimization). The Syntax is lambda name: f(x), where f(x) is the function in python "
+                    'language. Example: lambda name: name in ["left_laser", "frontal_camera"] , to load only '
+                    "sensors left_laser and frontal_camera")
+    ap.add_argument("-csf", "--collection_selection_function", default=None, type=lambda s: eval(s, globals()),
+                    help="A string to be evaluated into a lambda function that receives a collection name as input and "
+                    "returns True or False to indicate if the collection should be loaded (and used in the "
+                    "optimization). The Syntax is lambda name: f(x), where f(x) is the function in python "
+                    "language. Example: lambda name: int(name) > 5 , to load only collections 6, 7, and onward.")
+    ap.add_argument("-jsf", "--joint_selection_function", default=None, type=lambda s: eval(s, globals()),
+                    help="A string to be evaluated into a lambda function that receives a joint name as input and "
+                    "returns True or False to indicate if the joint should be calibrated (and used in the "
+                    "optimization). The Syntax is lambda name: f(x), where f(x) is the function in python "
+                    'language. Example: lambda name: name in ["left_arm_roll", "right_shoulder_lift"] , to load only '
+                    "joints left_arm_roll and right_shoulder_lift")
+    ap.add_argument("-atsf", "--additional_tf_selection_function", default=None, type=lambda s: eval(s, globals()),
+                    help="A string to be evaluated into a lambda function that receives an additional_tf name as input and "
+                    "returns True or False to indicate if the additional_tf should be calibrated (and used in the "
+                    "optimization). The Syntax is lambda name: f(x), where f(x) is the function in python "
+                    'language. Example: lambda name: name in ["base_link_to_base_link_mb", "left_wheel_to_base_link"] , to load only '
+                    "additional_tfs base_link_to_base_link_mb and left_wheel_to_base_link")
+    ap.add_argument("-phased", "--phased_execution", help="Stay in a loop before calling optimization, and in another "
+                    "after calling the optimization. Good for debugging.", action="store_true", default=False)
+    ap.add_argument("-ipg", "--initial_pose_ghost", action="store_true", default=False,
+                    help="Draw a ghost mesh with the systems initial pose. Good for debugging.")
+    ap.add_argument("-oj", "--output_json", help="Output json file. Relative paths are relative to the dataset folder.",
+                    type=str, required=False, default=None)
+    ap.add_argument("-ox", "--output_xacro", help="Save the optimized xacro to this file instead of to the urdf folder of "
+                    "the calibration package.",
+                    type=str, required=False, default=None)
+    ap.add_argument("-pp", "--print_parameters",
+                    help="Will print the value of the estimated parameters at the end of the optimization.", action="store_true", default=False)
+    ap.add_argument("-sfr", "--save_file_results",
+                    help="Output folder to where the results will be stored.", type=str, required=False)
+    ap.add_argument("-uaj", "--use_analytic_jacobian", action="store_true", default=False,
+                    help="Compute the jacobian analytically instead of using finite differences. Only available for "
+                         "rgb, depth and lidar3d sensors without joint parameters.")
+    return ap
+
+
+def getCalibrationArguments(json_file, **kwargs):
+    """ Gets the arguments of a calibration, i.e. the defaults of the command line arguments of calibrate, replaced by
+    the given keyword arguments, e.g.:
+        getCalibrationArguments('dataset.json', noisy_initial_guess=[0.1, 0.1], sample_seed=3)
+
+    :param json_file: the json file of the dataset
+    :return: a dictionary with the arguments
+    """
+    ap = addCalibrationArguments(argparse.ArgumentParser())
+    args = vars(ap.parse_args(args=['-json', json_file]))
+    for key, value in kwargs.items():
+        if key not in args:
+            raise ValueError('Unknown calibration argument ' + key + '.')
+        args[key] = value
+
+    return args
+
+
+def calibrateInForkedSession(idx, args_list):
+    """ Runs a calibration in a process forked by CalibrationSession.calibrateMany. The sensor data store is not
+    returned, since the parent process already has it. """
+    result = forked_session.calibrate(args_list[idx])
+    result.dataset.pop('_sensor_data', None)
+    return result
+
+
+# -------------------------------------------------------------------------------
+# --- CLASS
+# -------------------------------------------------------------------------------
+class CalibrationSession:
+    """
+    Loads a dataset, with the data of its images and point clouds, once, so that several calibrations may be run with
+    it without loading the dataset again. Each calibration works on its own copy of the loaded dataset, whose sensor
+    data is shared (see atom_core.sensor_data_store.SensorDataStore), e.g.:
+        session = CalibrationSession('dataset.json')
+        for seed in range(10):
+            result = session.calibrate(getCalibrationArguments(session.json_file, sample_seed=seed))
+            print(result.errors['averages'])
+
+    Calibrations may also be run in parallel, by forked processes which share the loaded dataset (see calibrateMany).
+    """
+
+    def __init__(self, json_file, collection_selection_function=None, lazy_loading=False, number_of_workers=1):
+        """
+        :param json_file: the json file of the dataset.
+        :param collection_selection_function: a function which receives a collection key and returns True if the
+        collection should be loaded. Collections may also be selected for each calibration, with the
+        collection_selection_function argument.
+        :param lazy_loading: if True, data files are decoded only when used by a calibration. Otherwise, all data is
+        decoded when the session is created, so that processes forked by calibrateMany share it.
+        :param number_of_workers: number of threads used to decode the data files.
+        """
+        # Loads a json file containing the detections. Returned json_file has path resolved by urireader.
+        self.dataset, self.json_file = loadResultsJSON(json_file, collection_selection_function,
+                                                       use_sensor_data_store=True, lazy_loading=lazy_loading,
+                                                       number_of_workers=number_of_workers)
+        clearCaches()  # the points cached for the dataset of a previous session
+
+        if float(self.dataset['_metadata']['version']) < 3.0:
+            atomError('Your dataset not version 3.0. Before running a calibration, you need to update it first with:\nrosrun atom_calibration update_dataset_from_version_2_to_3.')
+
+    def calibrate(self, args):
+        """ Runs a calibration.
+
+        :param args: a dictionary with the arguments of the calibration (see getCalibrationArguments).
+        :return: a CalibrationResultT with the calibrated dataset, the collection the calibrated transforms are read
+        from, the list of calibrated transforms, a dictionary with the values of the parameters, the final (normalized)
+        residuals and the errors per collection and sensor (see errorReport).
+        """
+        # The loaded dataset is not changed, so it is copied before filtering out collections and sensors
+        dataset = copy.deepcopy(self.dataset)
+
+        # ---------------------------------------
+        # --- Filter some collections, sensors, joints and additional tfs from the dataset
+        # ---------------------------------------
+        dataset = filterCollectionsFromDataset(dataset, args)  # filter collections
+        dataset = filterSensorsFromDataset(dataset, args)  # filter sensors
+        dataset = filterJointsFromDataset(dataset, args)
+        dataset = filterAdditionalTfsFromDataset(dataset, args)
+        print("Loaded dataset containing " + str(len(dataset["sensors"].keys())) +
+              " sensors and " + str(len(dataset["collections"].keys())) + " collections.")
+
+        # ---------------------------------------
+        # --- Verifications
+        # ---------------------------------------
+        checkIfAtLeastOneLabeledCollectionPerSensor(dataset)
+
+        # No residuals are configured for 2D lidars (see the residual layout below), so they cannot be calibrated
+        lidar2d_sensors = [sensor_key for sensor_key, sensor in dataset['sensors'].items()
+                           if sensor['modality'] == 'lidar2d']
+        if lidar2d_sensors:
+            atomError('Calibration of lidar2d sensors is not supported. Remove sensors ' + Fore.BLUE +
+                      str(lidar2d_sensors) + Style.RESET_ALL + ' with the sensor selection function (-ssf).')
+
+        # ---------------------------------------
+        # --- Store initial values for transformations to be optimized
+        # ---------------------------------------
+        for collection_key, collection in dataset["collections"].items():
+            initial_transform_key = generateName("transforms", suffix="ini")
+            collection[initial_transform_key] = copy.deepcopy(
+                collection["transforms"])
+            for transform_key, transform in collection[initial_transform_key].items():
+                transform["parent"] = generateName(
+                    transform["parent"], suffix="ini")
+                transform["child"] = generateName(transform["child"], suffix="ini")
+
+        # ---------------------------------------
+        # --- Define selected collection key.
+        # ---------------------------------------
+        # For the getters we only need to get one collection because optimized transformations are static. Lets take the first key in the dictionary and always get that transformation.
+        selected_collection_key = list(dataset["collections"].keys())[0]
+        print("Selected collection key is " + str(selected_collection_key))
+
+        # ---------------------------------------
+        # --- Add noise to the initial guess atomic transformations to be calibrated.
+        # ---------------------------------------
+        addNoiseToInitialGuess(dataset, args, selected_collection_key)
+
+        # ---------------------------------------
+        # --- SETUP OPTIMIZER: Create data models
+        # ---------------------------------------
+        opt = Optimizer()
+        opt.addDataModel("args", args)
+        opt.addDataModel("dataset", dataset)
+
+        # ---------------------------------------
+        # --- DEFINE THE VISUALIZATION FUNCTION
+        # ---------------------------------------
+        if args["view_optimization"]:
+            opt.setInternalVisualization(True)
+        else:
+            opt.setInternalVisualization(False)
+
+        if args["ros_visualization"]:
+            print("Configuring visualization ... ")
+            graphics = setupVisualization(dataset, args, selected_collection_key)
+            opt.addDataModel("graphics", graphics)
+
+            # Published in a background thread, so that visualization does not slow down the optimization
+            visualization_publisher = VisualizationPublisher(rate=args["visualization_rate"],
+                                                             images_per_tick=args["images_per_tick"])
+            opt.setVisualizationFunction(visualization_publisher, args["ros_visualization"], niterations=1,
+                                         figures=[])
+
+        # ---------------------------------------
+        # --- SETUP OPTIMIZER: Add sensor parameters
+        # ---------------------------------------
+        # Each sensor will have a position (tx,ty,tz) and a rotation (r1,r2,r3)
+
+        # Add parameters related to the sensors
+        # remove anchored sensor if flagged as such.
+
+        anchored_transform_key = ""  # not transform is anchored
+        if args['ignore_anchored_sensor']:
+            dataset["calibration_config"]["anchored_sensor"] = None
+
+        if dataset["calibration_config"]["anchored_sensor"] is not None:
+
+            print("Anchored sensor is " + Fore.GREEN + dataset["calibration_config"]["anchored_sensor"]
+                  + Style.RESET_ALL)
+
+            # Verify is anchored sensor is on dataset
+            verifyAnchoredSensor(dataset["calibration_config"]["anchored_sensor"], dataset['sensors'])
+
+            if dataset["calibration_config"]["anchored_sensor"] in dataset["sensors"]:
+                anchored_parent = dataset["sensors"][dataset["calibration_config"]["anchored_sensor"]]["calibration_parent"]
+                anchored_child = dataset["sensors"][dataset["calibration_config"]["anchored_sensor"]]["calibration_child"]
+                anchored_transform_key = generateKey(anchored_parent, anchored_child)
+        # TODO If we want an anchored sensor we should search (and fix) all the transforms in its chain that do are
+        #  being optimized
+
+        print("Creating parameters ...")
+        # Steaming from the config json, we define a transform to be optimized for each sensor. It could happen that two
+        # or more sensors define the same transform to be optimized (#120). To cope with this we first create a list of
+        # transformations to be optimized and then compute the unique set of that list.
+        transforms_set = set()
+        for sensor_key, sensor in dataset["sensors"].items():
+            transform_key = generateKey(
+                sensor["calibration_parent"], sensor["calibration_child"])
+            transforms_set.add(transform_key)
+
+        if dataset['calibration_config']['additional_tfs'] is not None:
+            for _, additional_tf in dataset['calibration_config']['additional_tfs'].items():
+                transform_key = generateKey(additional_tf['parent_link'], additional_tf['child_link'])
+                transforms_set.add(transform_key)
+
+        # push six parameters for each transform to be optimized.
+        for transform_key in transforms_set:
+            initial_transform = getterTransform(dataset, transform_key=transform_key,
+                                                collection_name=selected_collection_key)
+
+            if transform_key == anchored_transform_key:
+                bound_max = [
+                    x + 2 * sys.float_info.epsilon for x in initial_transform]
+                bound_min = [
+                    x - 2 * sys.float_info.epsilon for x in initial_transform]
+            else:
+                bound_max = [+np.inf for x in initial_transform]
+                bound_min = [-np.inf for x in initial_transform]
+
+            opt.pushParamVector(
+                group_name=transform_key, data_key="dataset", bound_max=bound_max, bound_min=bound_min,
+                getter=partial(getterTransform, transform_key=transform_key,
+                               collection_name=selected_collection_key,),
+                setter=partial(setterTransform,
+                               transform_key=transform_key, collection_name=None),
+                suffix=["_x", "_y", "_z", "_r1", "_r2", "_r3"])
+
+        # Intrinsic parameters. TODO bound_min and max for intrinsics
+        if args["optimize_intrinsics"]:
+            for sensor_key, sensor in dataset["sensors"].items():
+                if sensor["modality"] == "rgb":  # if sensor is a camera add intrinsics
+                    opt.pushParamVector(group_name=str(sensor_key) + "_intrinsics", data_key="dataset",
+                                        getter=partial(
+                                            getterCameraIntrinsics, sensor_key=sensor_key),
+                                        setter=partial(
+                                            setterCameraIntrinsics, sensor_key=sensor_key),
+                                        suffix=["_fx", "_fy", "_cx", "_cy", "_k1", "_k2", "_t1", "_t2", "_k3"])
+
+        # ---------------------------------------
+        # --- SETUP OPTIMIZER: Add pattern(s) parameters
+        # ---------------------------------------
+
+        # Each Pattern will have the position (tx,ty,tz) and rotation (r1,r2,r3)
+        for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
+
+            # Pattern not fixed -----------------
+            if not pattern["fixed"]:
+                # If pattern is not fixed there will be a transform for each collection. To tackle this reference link called
+                # according to what is on the dataset['calibration_config']['calibration_pattern']['link'] is prepended with
+                # a "c<collection_name>" appendix. This is done automatically for the collection['transforms'] when
+                # publishing ROS, but we must add this to the parameter name.
+                parent = pattern["parent_link"]
+                child = pattern["link"]
+                transform_key = generateKey(parent, child)
+
+                # iterate all collections
+                for collection_key, collection in dataset["collections"].items():
+
+                    # Set transform using the initial estimate of the transformations.
+                    initial_estimate = dataset["patterns"][pattern_key]["transforms_initial"][collection_key]
+                    if not initial_estimate["detected"] or not parent == initial_estimate["parent"] or \
+                            not child == initial_estimate["child"]:
+                        atomError("Cannot set initial estimate for pattern " + Fore.BLUE + pattern_key + Style.RESET_ALL + "at collection " +
+                                  collection_key + '. You must run the calibration without this collection. Check how to use the csf flag.')
+
+                    collection["transforms"][transform_key] = {"parent": parent, "child": child,
+                                                               "trans": initial_estimate["trans"],
+                                                               "quat": initial_estimate["quat"]}
+
+                    # Finally push the six parameters to describe the patterns pose w.r.t its parent link:
+                    #   a) The Getter will pick up transform from the collection collection_key;
+                    #   b) The Setter will received a transform value and a collection_key and copy the transform to that of the corresponding collection.
+                    if not args['anchor_patterns']:
+
+                        opt.pushParamVector(group_name="c" + collection_key + "_" + transform_key,
+                                            data_key="dataset", suffix=["_x", "_y", "_z", "_r1", "_r2", "_r3"],
+                                            getter=partial(getterTransform, transform_key=transform_key,
+                                                           collection_name=collection_key),
+                                            setter=partial(setterTransform, transform_key=transform_key,
+                                                           collection_name=collection_key))
+
+            else:  # fixed pattern ----------------------------------------------------------------------------------
+                # if pattern is fixed it will not be replicated for all collections , i.e. there will be a single
+                # reference link called according to what is on the dataset['calibration_config']['calibration_pattern'][
+                # 'link']
+                parent = pattern["parent_link"]
+                child = pattern["link"]
+                transform_key = generateKey(parent, child)
+
+                # Set transform using the initial estimate of the transformations.
+                initial_estimate = dataset["patterns"][pattern_key]["transforms_initial"][selected_collection_key]
+                if not initial_estimate["detected"] or not parent == initial_estimate["parent"] \
+                        or not child == initial_estimate["child"]:
+                    raise ValueError("Cannot set initial estimate for pattern " + Fore.BLUE +
+                                     pattern_key + Style.RESET_ALL + " at collection " + selected_collection_key)
+
+                # The pattern is fixed but we have a replicated transform for each collection. Lets add those.
+                for collection_key, collection in dataset["collections"].items():
+                    collection["transforms"][transform_key] = {"parent": parent, "child": child,
+                                                               "trans": initial_estimate["trans"],
+                                                               "quat": initial_estimate["quat"]}
+
+                # Finally push the six parameters to describe the patterns pose w.r.t its parent link:
+                #   a) The Getter will pick up the collection from one selected collection (it does not really matter which,
+                #       since they are replicas);
+                #   b) The Setter will received a transform value and copy that to all collection replicas, to ensure they
+                #       all have the same value. This is done by setting  "collection_name=None".
+                if not args['anchor_patterns']:
+                    opt.pushParamVector(group_name=transform_key, data_key="dataset",
+                                        getter=partial(getterTransform, transform_key=transform_key,
+                                                       collection_name=selected_collection_key),
+                                        setter=partial(setterTransform, transform_key=transform_key,
+                                                       collection_name=None),
+                                        suffix=["_x", "_y", "_z", "_r1", "_r2", "_r3"])
+
+        # ---------------------------------------
+        # --- SETUP OPTIMIZER: Add joint(s) parameters
+        # ---------------------------------------
+
+        if not dataset['calibration_config']['joints'] == "":
+            def getterJointParam(dataset, joint_key, param_key, collection_name):
+                return [dataset['collections'][collection_name]['joints'][joint_key][param_key]]
+
+            def setterJointParam(dataset, value, joint_key, param_key, collection_name):
+                if collection_name is None:  # if collection_name is None, set all collections with the same value
+                    for collection_key in dataset['collections']:
+                        dataset['collections'][collection_key]['joints'][joint_key][param_key] = value[0]
+                else:
+                    dataset['collections'][collection_name]['joints'][joint_key][param_key] = value
+
+            for joint_key, joint in dataset['collections'][selected_collection_key]['joints'].items():
+                joint_config = dataset['calibration_config']['joints'][joint_key]
+
+                for param_key in joint_config['params_to_calibrate']:
+
+                    group_name = 'joint-' + joint_key + '-' + param_key
+                    getter = partial(getterJointParam, joint_key=joint_key,
+                                     param_key=param_key, collection_name=selected_collection_key)
+                    setter = partial(setterJointParam, joint_key=joint_key,
+                                     param_key=param_key, collection_name=None)
+                    opt.pushParamScalar(group_name=group_name, data_key='dataset', getter=getter, setter=setter)
+
+        # opt.printParameters()
+
+        # ---------------------------------------
+        # --- Define THE OBJECTIVE FUNCTION
+        # ---------------------------------------
+        opt.setObjectiveFunction(objectiveFunction)
+
+        # ---------------------------------------
+        # --- Define THE RESIDUALS
+        # ---------------------------------------
+        # Each residual is computed after the sensor and the pattern of a collection. Thus, each error will be affected
+        # by the parameters tx,ty,tz,r1,r2,r3 of the sensor and the pattern
+
+        print("Creating residuals ... ")
+
+        if args["sample_seed"] is None:
+            seed = random.randrange(sys.maxsize)
+        else:
+            seed = args["sample_seed"]
+
+        rng = random.Random(seed)
+        print("RNG Seed: " + str(seed))
+
+        # The residual layout fixes the slot of each block of residuals in the residuals vector returned by the
+        # objective function. Blocks must be added in the same order the residuals are pushed to the optimizer.
+        residual_layout = ResidualLayout()
+
+        for collection_key, collection in dataset["collections"].items():
+            for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
+                for sensor_key, sensor in dataset["sensors"].items():
+                    # if pattern not detected by sensor in collection
+                    if not collection["labels"][pattern_key][sensor_key]["detected"]:
+                        continue
+
+                    # Sensor related parameters
+                    # sensors_transform_key = generateKey(
+                    #     sensor["calibration_parent"], sensor["calibration_child"])
+                    # params = opt.getParamsContainingPattern(sensors_transform_key)
+
+                    # Issue #543: Create the list of transformations that influence this residual by analyzing the transformation chain.
+                    # Parameters are given by their columns in the parameter vector, looked up from their group.
+                    columns = []
+                    for transform_in_chain in sensor['chain']:
+                        transform_key = generateKey(
+                            transform_in_chain["parent"], transform_in_chain["child"])
+                        if transform_key in transforms_set:
+                            columns.append(opt.getParamColumns(transform_key))
+
+                    # Intrinsics parameters
+                    if sensor["modality"] == "rgb" and args["optimize_intrinsics"]:
+                        columns.append(opt.getParamColumns(sensor_key + "_intrinsics"))
+
+                    # Pattern related parameters
+                    if pattern["fixed"]:
+                        pattern_transform_key = generateKey(pattern["parent_link"],
+                                                            pattern["link"])
+                    else:
+                        pattern_transform_key = "c" + collection_key + "_" + generateKey(pattern["parent_link"],
+                                                                                         pattern["link"])
+
+                    if pattern_transform_key in opt.groups:  # pattern related params, unless patterns are anchored
+                        columns.append(opt.getParamColumns(pattern_transform_key))
+
+                    # TODO Append joint params. Right now appending all joint params. Should be clever and know, from residual, which will affect
+                    if not dataset['calibration_config']['joints'] == "":
+                        for joint_key, joint in dataset['collections'][selected_collection_key]['joints'].items():
+                            for param_key in dataset['calibration_config']['joints'][joint_key]['params_to_calibrate']:
+                                columns.append(opt.getParamColumns('joint-' + joint_key + '-' + param_key))
+
+                    columns = np.concatenate(columns) if columns else np.zeros((0,), dtype=int)
+
+                    if sensor["modality"] == "rgb":
+                        # Compute step as a function of residual sampling factor
+                        # using all pattern corners
+                        rnames = ["c" + str(collection_key) + "_" + "p_" + pattern_key + "_" + str(sensor_key) + "_corner" +
+                                  str(idx["id"]) for idx in collection["labels"][pattern_key][sensor_key]["idxs"]]
+                        opt.pushResiduals(names=rnames, columns=columns)
+
+                        residual_layout.addBlock(collection_key, pattern_key, sensor_key, 'corners',
+                                                 len(collection["labels"][pattern_key][sensor_key]["idxs"]))
+
+                    elif sensor["modality"] == "lidar3d":
+
+                        # Laser beam error (or orthogonal error) ==
+
+                        # The number of residuals for this error can be huge.
+                        # Therefore, we do a random sample to reduce the number.
+                        # The sample percentage has the interval [0.1, 1.0]
+                        population = range(0, len(collection["labels"][pattern_key][sensor_key]["idxs"]))
+                        number_of_samples = int(max(0.1, min(args["sample_residuals"], 1.0)) * len(population))
+                        samples = rng.sample(population, number_of_samples)
+
+                        # Save it to be used in the objective function.
+                        collection["labels"][pattern_key][sensor_key]["samples"] = samples
+
+                        rnames = ["c" + collection_key + "_p_" + pattern_key + '_' + sensor_key + "_oe_" + str(idx)
+                                  for idx in samples]
+                        opt.pushResiduals(names=rnames, columns=columns)
+
+                        residual_layout.addBlock(collection_key, pattern_key, sensor_key, 'oe', len(samples))
+
+                        # Extrema (limits) displacement error
+                        rnames = ["c" + collection_key + "_" + "p_" + pattern_key + "_" + sensor_key + "_ld_" + str(idx)
+                                  for idx in range(0, len(collection["labels"][pattern_key][sensor_key]["idxs_limit_points"]))]
+                        opt.pushResiduals(names=rnames, columns=columns)
+
+                        residual_layout.addBlock(collection_key, pattern_key, sensor_key, 'ld',
+                                                 len(collection["labels"][pattern_key][sensor_key]["idxs_limit_points"]))
+
+                    elif sensor["modality"] == "depth":
+
+                        population = range(0, len(collection["labels"][pattern_key][sensor_key]["idxs"]))
+                        number_of_samples = int(max(0.1, min(args["sample_residuals"], 1.0)) * len(population))
+                        samples = rng.sample(population, number_of_samples)
+
+                        # Save it to be used in the objective function.
+                        collection["labels"][pattern_key][sensor_key]["samples"] = samples
+
+                        rnames = ["c" + collection_key + "_" + "p_" + pattern_key + "_" + sensor_key + "_oe_" + str(idx)
+                                  for idx in samples]
+                        opt.pushResiduals(names=rnames, columns=columns)
+
+                        residual_layout.addBlock(collection_key, pattern_key, sensor_key, 'oe', len(samples))
+
+                        population_longitudinal = range(
+                            0, len(collection["labels"][pattern_key][sensor_key]["idxs_limit_points"]))
+                        number_of_samples_longitudinal = int(
+                            max(0.1, min(args["sample_longitudinal_residuals"], 1.0)) * len(population_longitudinal))
+                        samples_longitudinal = rng.sample(population_longitudinal, number_of_samples_longitudinal)
+
+                        # Save it to be used in the objective function.
+                        collection["labels"][pattern_key][sensor_key]["samples_longitudinal"] = samples_longitudinal
+
+                        # Extrema displacement error
+                        rnames = ["c" + collection_key + "_" + "p_" + pattern_key + "_" + sensor_key + "_ld_" + str(idx)
+                                  for idx in samples_longitudinal]
+                        opt.pushResiduals(names=rnames, columns=columns)
+
+                        residual_layout.addBlock(collection_key, pattern_key, sensor_key, 'ld', len(samples_longitudinal))
+
+                    # print(opt.residuals.keys())
+                    # print('Adding residuals for sensor ' + sensor_key + ' with msg_type ' + sensor['msg_type'] +
+                    #       ' affected by parameters:\n' + str(params))
+
+        # opt.printParameters()
+        # opt.printResiduals()
+        # exit(0)
+
+        # ---------------------------------------
+        # --- SETUP OPTIMIZER: Analytic jacobian
+        # ---------------------------------------
+        if args['use_analytic_jacobian']:
+            unsupported_modalities = set([s['modality'] for s in dataset['sensors'].values()]) - set(supported_modalities)
+            if not dataset['calibration_config']['joints'] == "" or unsupported_modalities:
+                print(Fore.YELLOW + 'Analytic jacobian is not available for joint parameters or for ' +
+                      str(list(unsupported_modalities)) + ' sensors. Using finite differences.' + Style.RESET_ALL)
+            else:
+                # Columns of the parameters of each transform, per collection, and of the intrinsics of each sensor
+                parameter_columns = {'transforms': {}, 'intrinsics': {},
+                                     'number_of_parameters': opt.getNumberOfParameters()}
+                for collection_key in dataset['collections']:
+                    for transform_key in transforms_set:
+                        parameter_columns['transforms'][(collection_key, transform_key)] = opt.groups[transform_key].idx
+
+                    for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
+                        transform_key = generateKey(pattern['parent_link'], pattern['link'])
+                        group_name = transform_key if pattern['fixed'] else 'c' + collection_key + '_' + transform_key
+                        if group_name in opt.groups:
+                            parameter_columns['transforms'][(collection_key, transform_key)] = opt.groups[group_name].idx
+
+                for sensor_key in dataset['sensors']:
+                    if str(sensor_key) + '_intrinsics' in opt.groups:
+                        parameter_columns['intrinsics'][sensor_key] = opt.groups[str(sensor_key) + '_intrinsics'].idx
+
+                opt.addDataModel('parameter_columns', parameter_columns)
+                opt.setJacobianFunction(jacobianFunction)
+
+        if not residual_layout.size == len(opt.residuals):
+            atomError('Residual layout has ' + str(residual_layout.size) + ' residuals but ' + str(len(opt.residuals)) +
+                      ' residuals were pushed to the optimizer.')
+        opt.addDataModel("residual_layout", residual_layout)
+
+        # ---------------------------------------
+        # --- Compute the SPARSE MATRIX
+        # ---------------------------------------
+        print("Computing sparse matrix ... ")
+        opt.computeSparseMatrix()
+        # opt.printSparseMatrix()
+
+        # ---------------------------------------
+        # --- Get a normalizer for each residual type
+        # ---------------------------------------
+        modalities = set([s["modality"] for s in dataset["sensors"].values()])
+        normalizer = {k: 1.0 for k in modalities}
+        opt.addDataModel("normalizer", normalizer)
+
+        residuals = objectiveFunction(opt.data_models)
+        opt.callObjectiveFunction()
+        (sensor_keys,), sums, counts = residual_layout.groupedSums(residuals, ('sensor',))
+        for modality in modalities:
+            idxs = [idx for idx, sensor_key in enumerate(sensor_keys)
+                    if dataset["sensors"][sensor_key]["modality"] == modality]
+
+            # If the normalizer is to big, the residuals may loose their influence when close to zero.
+            normalizer[modality] = np.sum(sums[idxs]) / np.sum(counts[idxs]) if np.sum(counts[idxs]) > 0 else np.nan
+            print(f'Normalizer for {modality}: {normalizer[modality]}')
+
+        # ---------------------------------------
+        # --- Start Optimization
+        # ---------------------------------------
+        if args["phased_execution"]:
+            waitForKeyPress2(function=opt.callObjectiveFunction, timeout=0.1)
+
+        print("Initializing optimization ...")
+        # options = {'ftol': 1e-3, 'xtol': 1e-3, 'gtol': 1e-3, 'diff_step': None, 'x_scale': 'jac'}
+        # options = {"ftol": 1e-4, "xtol": 1e-4, "gtol": 1e-4, "diff_step": None, "x_scale": "jac", }
+        options = {'ftol': 1e-5, 'xtol': 1e-5, 'gtol': 1e-5,
+                   'diff_step': None, 'x_scale': 'jac'}
+        # options = {'ftol': 1e-6, 'xtol': 1e-6, 'gtol': 1e-6, 'diff_step': None, 'x_scale': 'jac'}
+        # options = {'ftol': 1e-7, 'xtol': 1e-7, 'gtol': 1e-7, 'diff_step': None, 'x_scale': 'jac'}
+        # options = {'ftol': 1e-5, 'xtol': 1e-5, 'gtol': 1e-5,
+        #    'diff_step': None, 'x_scale': 'jac', 'max_nfev': 1}
+
+        opt.startOptimization(optimization_options=options)
+
+        if args["phased_execution"]:
+            waitForKeyPress2(opt.callObjectiveFunction, timeout=0.1,
+                             message=Fore.BLUE + "Optimization finished" + Style.RESET_ALL)
+        # Final error report
+        residuals = objectiveFunction(opt.data_models)
+        errors = errorReport(dataset=dataset, residuals=residuals, normalizer=normalizer, args=args,
+                             residual_layout=residual_layout)
+
+        if args["ros_visualization"]:  # publish the final state, with all the images
+            visualization_publisher(opt.data_models)
+            visualization_publisher.stop()
+
+        if args['print_parameters']:
+            opt.printParameters()
+        # to store all sensors that existed in the dataset, regardless of which were optimized
+        # If a sensor_key exists in the original dataset but not in the optimized dataset, then it was removed from the optimization and we should copy it back to the dataset before saving.
+        for sensor_key, sensor in self.dataset["sensors"].items():
+            if not sensor_key in dataset['sensors']:
+                dataset['sensors'][sensor_key] = copy.deepcopy(sensor)
+
+        return CalibrationResultT(dataset=dataset, selected_collection_key=selected_collection_key,
+                                  transforms_list=list(transforms_set),
+                                  parameters=dict(zip(opt.getParameters(), opt.x)),
+                                  residuals=residuals, errors=errors)
+
+    def calibrateMany(self, args_list, number_of_processes=1):
+        """ Runs several calibrations. With more than one process, calibrations run in processes forked from this one,
+        which share the loaded dataset, copy on write, and return their results to this process.
+
+        :param args_list: a list of dictionaries with the arguments of each calibration (see getCalibrationArguments).
+        :param number_of_processes: number of calibrations run in parallel.
+        :return: a list with the CalibrationResultT of each calibration, in the order of args_list.
+        """
+        if number_of_processes <= 1:
+            return [self.calibrate(args) for args in args_list]
+
+        for args in args_list:
+            if args['ros_visualization'] or args['view_optimization'] or args['phased_execution']:
+                raise ValueError('Calibrations with visualization or phased execution cannot run in parallel.')
+
+        # Arguments have selection functions, which cannot be pickled. Thus, as the session, they are inherited by the
+        # forked processes, which only receive the index of their calibration.
+        global forked_session
+        forked_session = self
+        try:
+            with multiprocessing.get_context('fork').Pool(processes=number_of_processes) as pool:
+                results = pool.map(partial(calibrateInForkedSession, args_list=args_list), range(len(args_list)))
+        finally:
+            forked_session = None
+
+        for result in results:  # the sensor data is that of the session
+            result.dataset['_sensor_data'] = self.dataset['_sensor_data']
+
+        return results
+
+    def save(self, result, output_json=None, output_xacro=None):
+        """ Saves the results of a calibration: the calibrated dataset, the optimized xacro and a yml file with the
+        calibrated parameters, in the folder of the calibrated dataset.
+
+        :param result: the CalibrationResultT of the calibration.
+        :param output_json: the calibrated dataset json file. Relative paths are relative to the dataset folder.
+        Defaults to atom_calibration.json in the dataset folder.
+        :param output_xacro: if given, the optimized xacro is saved to this file instead of to the urdf folder of the
+        calibration package.
+        :return: the calibrated dataset json file.
+        """
+        if output_json is None:
+            filename_results_json = os.path.dirname(self.json_file) + "/atom_calibration.json"
+        else:
+            filename_results_json = os.path.join(os.path.dirname(self.json_file), output_json)
+
+        # The sensor data is not changed by the calibration, so the calibrated dataset points to the data files of the
+        # loaded dataset instead of having copies of them (e.g. batch executions save each run to its own folder)
+        saveAtomDataset(filename_results_json, result.dataset, freeze_dataset=True,
+                        source_folder=os.path.dirname(str(self.json_file).rstrip('/')))
+
+        # ---------------------------------------
+        # --- Save updated xacro
+        # ---------------------------------------
+        saveResultsXacro(result.dataset, result.selected_collection_key, result.transforms_list,
+                         output_file=output_xacro)
+
+        # ---------------------------------------
+        # --- Save results into yaml
+        # ---------------------------------------
+        filename_results_yml = os.path.dirname(filename_results_json) + "/" + 'atom_calibration_params.yml'
+        saveResultsYml(result.dataset, result.selected_collection_key, filename_results_yml)
+
+        return filename_results_json
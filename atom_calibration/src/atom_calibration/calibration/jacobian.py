@@ -0,0 +1,218 @@
+"""
+Definition of the analytic jacobian of the objective function.
+"""
+
+# -------------------------------------------------------------------------------
+# --- IMPORTS
+# -------------------------------------------------------------------------------
+
+# Standard imports
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import distance
+
+# Atom imports
+from atom_core.atom import getChain
+from atom_core.naming import generateKey
+from atom_core.geometry import (translationQuaternionToTransform, matrixToRodrigues, rodriguesToMatrixDerivatives)
+from atom_core.vision import projectToCamera, projectToCameraDerivatives
+from atom_calibration.calibration.objective_function import (getPointsInPatternAsNPArray,
+                                                             getPointsDetectedInImageAsNPArray,
+                                                             getPointsInSensorAsNPArray,
+                                                             getPointsInDepthSensorAsNPArray,
+                                                             getLimitPointsInPatternAsNPArray)
+
+# Modalities for which the analytic jacobian is implemented
+supported_modalities = ['rgb', 'depth', 'lidar3d']
+
+
+# -------------------------------------------------------------------------------
+# --- FUNCTIONS
+# -------------------------------------------------------------------------------
+def transformDerivatives(parent_T_child):
+    """ Computes the derivatives of a transform w.r.t. its six parameters [tx, ty, tz, r1, r2, r3], where r1, r2, r3
+    are the components of the Rodrigues rotation vector, as in getterTransform and setterTransform.
+
+    :param parent_T_child: the transform (4x4 homogeneous)
+    :return: an array of shape (6, 4, 4) with the derivative w.r.t. each parameter
+    """
+    derivatives = np.zeros((6, 4, 4), dtype=float)
+    derivatives[0:3, 0:3, 3] = np.eye(3)  # translation parameters
+    derivatives[3:6, 0:3, 0:3] = rodriguesToMatrixDerivatives(matrixToRodrigues(parent_T_child[0:3, 0:3]))
+    return derivatives
+
+
+def getAggregateTransformDerivatives(chain, transforms, transform_columns, collection_key):
+    """ Multiplies local transforms in a chain to get the global transform of the chain, and computes the derivatives
+    of the global transform w.r.t. the parameters of the local transforms which are being optimized.
+
+    @param chain: a list of transforms
+    @param transforms: a pool of transformations
+    @param transform_columns: a dictionary with key (collection_key, transform_key) and value the columns of the six
+    parameters of that transform in the parameter vector
+    @param collection_key: the collection of the transforms pool
+    @return: the global transformation (4x4 homogeneous), and a list of tuples (column, derivative (4x4))
+    """
+    links = []  # a list of tuples (transform_key, local transform, is_inverted, parametrized transform)
+    for link in chain:
+        key = generateKey(link['parent'], link['child'])
+        inverse_key = generateKey(link['child'], link['parent'])
+        if key in transforms:  # check if link exists in transforms
+            parent_T_child = translationQuaternionToTransform(transforms[key]['trans'], transforms[key]['quat'])
+            links.append((key, parent_T_child, False, parent_T_child))
+        elif inverse_key in transforms:  # the reverse transform may exist
+            child_T_parent = translationQuaternionToTransform(transforms[inverse_key]['trans'],
+                                                              transforms[inverse_key]['quat'])
+            links.append((inverse_key, np.linalg.inv(child_T_parent), True, child_T_parent))
+        else:
+            raise ValueError('Transform from ' + link['parent'] + ' to ' + link['child'] + ' does not exist.')
+
+    # Products of the local transforms before (prefixes) and after (suffixes) each link
+    prefixes = [np.eye(4, dtype=float)]
+    for _, local_transform, _, _ in links:
+        prefixes.append(np.dot(prefixes[-1], local_transform))
+
+    suffixes = [np.eye(4, dtype=float)]
+    for _, local_transform, _, _ in reversed(links):
+        suffixes.insert(0, np.dot(local_transform, suffixes[0]))
+
+    derivatives = []
+    for idx, (transform_key, local_transform, is_inverted, parametrized_transform) in enumerate(links):
+        columns = transform_columns.get((collection_key, transform_key))
+        if columns is None:  # this transform is not being optimized
+            continue
+
+        for column, d_parametrized in zip(columns, transformDerivatives(parametrized_transform)):
+            if is_inverted:  # derivative of the inverse, d(A^-1) = -A^-1 dA A^-1
+                d_local = -np.dot(np.dot(local_transform, d_parametrized), local_transform)
+            else:
+                d_local = d_parametrized
+            derivatives.append((column, np.dot(np.dot(prefixes[idx], d_local), suffixes[idx + 1])))
+
+    return prefixes[-1], derivatives
+
+
+def jacobianFunction(data):
+    """
+    Computes the jacobian of the vector of residuals returned by objectiveFunction w.r.t. the parameters. Derivatives
+    are analytic for the transforms (translation and Rodrigues rotation parameters) and for the camera intrinsics, and
+    cover the following residuals:
+        - Reprojection error for camera to chessboard
+        - Orthogonal (point to plane) and longitudinal distances for depth and 3D range sensors
+    :return: a sparse matrix (number of residuals x number of parameters)
+    """
+
+    # Get the data from the model
+    dataset = data['dataset']
+    normalizer = data['normalizer']
+    residual_layout = data['residual_layout']
+    parameter_columns = data['parameter_columns']
+    transform_columns = parameter_columns['transforms']
+    intrinsics_columns = parameter_columns['intrinsics']
+
+    rows, columns, values = [], [], []  # triplets of the sparse jacobian
+
+    def addDerivatives(block_slice, column, derivative):
+        block_rows = np.arange(block_slice.start, block_slice.stop)
+        rows.append(block_rows)
+        columns.append(np.full(block_rows.shape, column))
+        values.append(derivative)
+
+    for collection_key, collection in dataset['collections'].items():
+        for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
+            for sensor_key, sensor in dataset['sensors'].items():  # iterate all sensors
+
+                if not collection['labels'][pattern_key][sensor_key]['detected']:  # pattern not detected by sensor in collection
+                    continue
+
+                if sensor['modality'] == 'rgb':
+                    pts_in_pattern = getPointsInPatternAsNPArray(collection_key, pattern_key, sensor_key, dataset)
+
+                    from_frame = sensor['parent']
+                    to_frame = pattern['link']
+                    chain = getChain(from_frame, to_frame, collection['transforms'])
+                    sensor_to_pattern, transform_derivatives = getAggregateTransformDerivatives(
+                        chain, collection['transforms'], transform_columns, collection_key)
+                    pts_in_sensor = np.dot(sensor_to_pattern, pts_in_pattern)
+
+                    w, h = collection['data'][sensor_key]['width'], collection['data'][sensor_key]['height']
+                    K = np.ndarray((3, 3), buffer=np.array(sensor['camera_info']['K']), dtype=float)
+                    D = np.ndarray((5, 1), buffer=np.array(sensor['camera_info']['D']), dtype=float)
+
+                    pts_in_image, _, _ = projectToCamera(K, D, w, h, pts_in_sensor[0:3, :])
+                    d_pixs_d_pts, d_pixs_d_intrinsics = projectToCameraDerivatives(K, D, pts_in_sensor[0:3, :])
+
+                    pts_detected_in_image = getPointsDetectedInImageAsNPArray(
+                        collection_key, pattern_key, sensor_key, dataset)
+
+                    # Residual is the norm of the error, so its derivative w.r.t. the pixels is the unit error vector
+                    errors = (pts_in_image - pts_detected_in_image).transpose()
+                    norms = np.linalg.norm(errors, axis=1)
+                    unit_errors = np.divide(errors, norms[:, np.newaxis], out=np.zeros_like(errors),
+                                            where=norms[:, np.newaxis] > 0) / normalizer['rgb']
+
+                    block_slice = residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'corners')
+                    d_residuals_d_pts = np.einsum('ni,nij->nj', unit_errors, d_pixs_d_pts)
+                    for column, d_transform in transform_derivatives:
+                        d_pts = np.dot(d_transform[0:3, :], pts_in_pattern).transpose()
+                        addDerivatives(block_slice, column, np.sum(d_residuals_d_pts * d_pts, axis=1))
+
+                    if sensor_key in intrinsics_columns:
+                        d_residuals_d_intrinsics = np.einsum('ni,nik->nk', unit_errors, d_pixs_d_intrinsics)
+                        for idx, column in enumerate(intrinsics_columns[sensor_key]):
+                            addDerivatives(block_slice, column, d_residuals_d_intrinsics[:, idx])
+
+                elif sensor['modality'] in ['lidar3d', 'depth']:
+                    if sensor['modality'] == 'lidar3d':
+                        points_in_sensor = getPointsInSensorAsNPArray(
+                            collection_key, pattern_key, sensor_key, 'idxs', dataset)
+                        limit_points_in_sensor = getPointsInSensorAsNPArray(
+                            collection_key, pattern_key, sensor_key, 'idxs_limit_points', dataset)
+                        limit_samples = list(range(limit_points_in_sensor.shape[1]))
+                    else:
+                        points_in_sensor = getPointsInDepthSensorAsNPArray(
+                            collection_key, pattern_key, sensor_key, 'idxs', dataset)
+                        limit_points_in_sensor = getPointsInDepthSensorAsNPArray(
+                            collection_key, pattern_key, sensor_key, 'idxs_limit_points', dataset)
+                        limit_samples = collection['labels'][pattern_key][sensor_key]['samples_longitudinal']
+
+                    from_frame = pattern['link']
+                    to_frame = sensor['parent']
+                    chain = getChain(from_frame, to_frame, collection['transforms'])
+                    sensor_to_pattern, transform_derivatives = getAggregateTransformDerivatives(
+                        chain, collection['transforms'], transform_columns, collection_key)
+
+                    # Orthogonal residuals are the absolute z coordinate of the points in the pattern's frame
+                    samples = collection['labels'][pattern_key][sensor_key]['samples']
+                    sampled_points_in_sensor = points_in_sensor[:, samples]
+                    signs = np.sign(np.dot(sensor_to_pattern[2, :], sampled_points_in_sensor)) / \
+                        normalizer[sensor['modality']]
+
+                    # Longitudinal residuals are the distance of the limit points in the pattern's frame to the
+                    # closest point sampled from the pattern's limits
+                    sampled_limit_points_in_sensor = limit_points_in_sensor[:, limit_samples]
+                    limit_points_in_pattern = np.dot(sensor_to_pattern, sampled_limit_points_in_sensor)[0:2, :]
+                    ground_truth_limit_points_in_pattern = getLimitPointsInPatternAsNPArray(pattern_key, dataset)
+                    closest = np.argmin(distance.cdist(limit_points_in_pattern.transpose(),
+                                                       ground_truth_limit_points_in_pattern.transpose(),
+                                                       'euclidean'), axis=1)
+                    errors = (limit_points_in_pattern - ground_truth_limit_points_in_pattern[:, closest]).transpose()
+                    norms = np.linalg.norm(errors, axis=1)
+                    unit_errors = np.divide(errors, norms[:, np.newaxis], out=np.zeros_like(errors),
+                                            where=norms[:, np.newaxis] > 0) / normalizer[sensor['modality']]
+
+                    oe_slice = residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'oe')
+                    ld_slice = residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'ld')
+                    for column, d_transform in transform_derivatives:
+                        addDerivatives(oe_slice, column, signs * np.dot(d_transform[2, :], sampled_points_in_sensor))
+                        d_limit_points = np.dot(d_transform[0:2, :], sampled_limit_points_in_sensor).transpose()
+                        addDerivatives(ld_slice, column, np.sum(unit_errors * d_limit_points, axis=1))
+
+                else:
+                    raise ValueError('Analytic jacobian not implemented for modality ' + sensor['modality'])
+
+    if rows:
+        rows, columns, values = np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+    # Duplicate (row, column) entries, i.e. a parameter in more than one link of a chain, are summed up
+    return csr_matrix((values, (rows, columns)), shape=(residual_layout.size, parameter_columns['number_of_parameters']))
@@ -7,27 +7,22 @@ Definition of the objective function.
 # -------------------------------------------------------------------------------
 
 # Standard imports
-import math
 import copy
-from datetime import datetime
 
-import re
 import numpy as np
 from atom_core.joint_models import getTransformationFromRevoluteJoint
-import atom_core.ros_numpy
 from colorama import Fore, Style
 from scipy.spatial import distance
 
 # ROS imports
 from geometry_msgs.msg import Point
-from image_geometry import PinholeCameraModel
 from rospy_message_converter import message_converter
 from cv_bridge import CvBridge
 
 # Atom imports
-from atom_core.atom import getTransform
-from atom_core.vision import projectToCamera
-from atom_core.dataset_io import getPointCloudMessageFromDictionary
+from atom_core.atom import getTransform, getTransformForCollections
+from atom_core.vision import projectToCamera, depthIdxsToPoints
+from atom_core.dataset_io import getPointCloudArrayFromDataset, getDepthImageFromDataset
 from atom_core.geometry import distance_two_3D_points, isect_line_plane_v3
 from atom_core.cache import Cache
 from atom_calibration.collect.label_messages import pixToWorld, worldToPix
@@ -36,7 +31,13 @@ from atom_calibration.collect.label_messages import pixToWorld, worldToPix
 # -------------------------------------------------------------------------------
 # --- FUNCTIONS
 # -------------------------------------------------------------------------------
-def errorReport(dataset, residuals, normalizer, args):
+def errorReport(dataset, residuals, normalizer, args, residual_layout):
+    """ Prints a table with the average error of each sensor in each collection. Residuals are grouped by collection
+    and sensor using the labels of the residual layout, so the report is computed with a few numpy reductions.
+
+    :return: a dictionary with the errors, {'collections': {collection_key: {sensor_key: error}}, 'averages':
+    {sensor_key: error}}, where the error is None if the sensor has no residuals.
+    """
     from prettytable import PrettyTable
     table_header = ['Collection']
 
@@ -59,67 +60,66 @@ def errorReport(dataset, residuals, normalizer, args):
     # table to save. This table was created, because the original has colors and the output csv save them as random characters
     table_to_save = PrettyTable(table_header)
 
-    # Build each row in the table
-    keys = sorted(dataset['collections'].keys(), key=lambda x: int(x))
-    for collection_key in keys:
+    # Average of the residuals of each sensor in each collection. Null residuals are not accounted for.
+    collection_keys = sorted(dataset['collections'].keys(), key=lambda x: int(x))
+    sensor_keys = list(dataset['sensors'].keys())
+    (layout_collection_keys, layout_sensor_keys), sums, counts = \
+        residual_layout.groupedSums(residuals, ('collection', 'sensor'), mask=np.asarray(residuals) != 0)
+
+    layout_collection_idxs = {key: idx for idx, key in enumerate(layout_collection_keys)}
+    layout_sensor_idxs = {key: idx for idx, key in enumerate(layout_sensor_keys)}
+    normal_errors = np.full((len(collection_keys), len(sensor_keys)), np.nan)  # nan if there are no residuals
+    for row_idx, collection_key in enumerate(collection_keys):
+        for col_idx, sensor_key in enumerate(sensor_keys):
+            if collection_key in layout_collection_idxs and sensor_key in layout_sensor_idxs:
+                group = (layout_collection_idxs[collection_key], layout_sensor_idxs[sensor_key])
+                if counts[group] > 0:
+                    normal_errors[row_idx, col_idx] = sums[group] / counts[group]
+
+    normalizers = np.array([normalizer[dataset['sensors'][sensor_key]['modality']] for sensor_key in sensor_keys])
+    errors_array = normal_errors * normalizers
+
+    def formatValue(value, normal_value):
+        if args['show_normalized_values']:
+            return f'{value:.4f} ({normal_value:.4f})'
+        return '%.4f' % value
+
+    # Build each row in the table, with the larger error per column (per sensor) in red
+    has_errors = ~np.isnan(errors_array)
+    max_row_idxs = np.argmax(np.where(has_errors, errors_array, -np.inf), axis=0) if collection_keys else []
+    errors = {'collections': {}, 'averages': {}}
+    for row_idx, collection_key in enumerate(collection_keys):
         row = [collection_key]
         row_save = [collection_key]
-        v = []
-        for sensor_key, sensor in dataset['sensors'].items():
-            keys = [k for k in residuals.keys() if ('c' + collection_key) == k.split('_')[0] and sensor_key in k]
-            v = [residuals[k] * normalizer[sensor['modality']] for k in keys if residuals[k]]
-            if v:
-                if args['show_normalized_values']:
-                    normal_v = [residuals[k] for k in keys if residuals[k]]
-                    value = f'{np.mean(v):.4f} ({np.mean(normal_v):.4f})'
-                else:
-                    value = '%.4f' % np.mean(v)
-                row.append(value)
+        errors['collections'][collection_key] = {}
+        for col_idx, sensor_key in enumerate(sensor_keys):
+            if has_errors[row_idx, col_idx]:
+                error = float(errors_array[row_idx, col_idx])
+                value = formatValue(error, normal_errors[row_idx, col_idx])
+                row.append(Fore.RED + value + Style.RESET_ALL if max_row_idxs[col_idx] == row_idx else value)
                 row_save.append(value)
             else:
+                error = None
                 row.append(Fore.LIGHTBLACK_EX + '---' + Style.RESET_ALL)
                 row_save.append('---')
+            errors['collections'][collection_key][sensor_key] = error
 
         table.add_row(row)
-        table_to_save.add_row(row)
-
-    if args['show_normalized_values']:
-        # Regular expression pattern to match floats
-        pattern = r'\d+\.\d+'
-
-    # Compute averages and add a bottom row
-    bottom_row = []  # Compute averages and add bottom row to table
-    bottom_row_save = []
-    for col_idx, _ in enumerate(table_header):
-        if col_idx == 0:
-            bottom_row.append(Fore.BLUE + Style.BRIGHT + 'Averages' + Fore.BLACK + Style.RESET_ALL)
-            bottom_row_save.append('Averages')
-            continue
-
-        total = 0
-        normal_total = 0
-        count = 0
-        for row in table.rows:
-            # if row[col_idx].isnumeric():
-            try:
-                if args['show_normalized_values']:
-                    floats = re.findall(pattern, row[col_idx])
-                    value = float(floats[0])
-                    normal_value = float(floats[1])
-                    total += float(value)
-                    normal_total += float(normal_value)
-                else:
-                    value = float(row[col_idx])
-                    total += float(value)
-                count += 1
-            except:
-                pass
-
-        if count > 0:
-            value = '%.4f' % (total / count)
-            if args['show_normalized_values']:
-                value += ' (' + '%.4f' % (normal_total / count) + ')'
+        table_to_save.add_row(row_save)
+
+    # Compute averages over the collections and add a bottom row
+    bottom_row = [Fore.BLUE + Style.BRIGHT + 'Averages' + Fore.BLACK + Style.RESET_ALL]
+    bottom_row_save = ['Averages']
+    counts_per_sensor = np.sum(has_errors, axis=0)
+    with np.errstate(invalid='ignore'):
+        averages = np.nansum(errors_array, axis=0) / counts_per_sensor
+        normal_averages = np.nansum(normal_errors, axis=0) / counts_per_sensor
+    for col_idx, sensor_key in enumerate(sensor_keys):
+        if counts_per_sensor[col_idx] > 0:
+            errors['averages'][sensor_key] = float(averages[col_idx])
+            value = formatValue(averages[col_idx], normal_averages[col_idx])
         else:
+            errors['averages'][sensor_key] = None
             value = '---'
 
         bottom_row.append(Fore.BLUE + value + Fore.BLACK + Style.RESET_ALL)
@@ -128,26 +128,6 @@ def errorReport(dataset, residuals, normalizer, args):
     table.add_row(bottom_row)
     table_to_save.add_row(bottom_row_save)
 
-    # Put larger errors in red per column (per sensor)
-    for col_idx, _ in enumerate(table_header):
-        if col_idx == 0:  # nothing to do
-            continue
-
-        max = 0
-        max_row_idx = 0
-        for row_idx, row in enumerate(table.rows[:-1]):  # ignore bottom row
-            try:
-                value = float(row[col_idx])
-            except:
-                continue
-
-            if value > max:
-                max = value
-                max_row_idx = row_idx
-
-        # set the max column value to red
-        table.rows[max_row_idx][col_idx] = Fore.RED + table.rows[max_row_idx][col_idx] + Style.RESET_ALL
-
     table.align = 'c'
     table_to_save.align = 'c'
     print(Style.BRIGHT + 'Errors per collection' + Style.RESET_ALL + ' (' + Fore.YELLOW + 'anchored sensor' +
@@ -160,6 +140,8 @@ def errorReport(dataset, residuals, normalizer, args):
         with open(args['save_file_results'] + 'calibration_results.csv', 'w', newline='') as f_output:
             f_output.write(table_to_save.get_csv_string())
 
+    return errors
+
 
 @Cache(args_to_ignore=['_dataset'])
 def getPointsInPatternAsNPArray(_collection_key, _pattern_key, _sensor_key, _dataset):
@@ -189,6 +171,16 @@ def getDepthPointsInPatternAsNPArray(_collection_key, _pattern_key, _sensor_key,
                      [1 for _ in pts_in_pattern_list]], float)
 
 
+@Cache(args_to_ignore=['_dataset'])
+def getLimitPointsInPatternAsNPArray(_pattern_key, _dataset):
+    pts = []
+    pts.extend(_dataset['patterns'][_pattern_key]['frame']['lines_sampled']['left'])
+    pts.extend(_dataset['patterns'][_pattern_key]['frame']['lines_sampled']['right'])
+    pts.extend(_dataset['patterns'][_pattern_key]['frame']['lines_sampled']['top'])
+    pts.extend(_dataset['patterns'][_pattern_key]['frame']['lines_sampled']['bottom'])
+    return np.array([[pt['x'] for pt in pts], [pt['y'] for pt in pts]], float)
+
+
 @Cache(args_to_ignore=['_dataset'])
 def getPointsDetectedInImageAsNPArray(_collection_key, _pattern_key, _sensor_key, _dataset):
     return np.array(
@@ -199,9 +191,8 @@ def getPointsDetectedInImageAsNPArray(_collection_key, _pattern_key, _sensor_key
 
 @Cache(args_to_ignore=['_dataset'])
 def getPointsInSensorAsNPArray(_collection_key, _pattern_key, _sensor_key, _label_key, _dataset):
-    cloud_msg = getPointCloudMessageFromDictionary(_dataset['collections'][_collection_key]['data'][_sensor_key])
     idxs = _dataset['collections'][_collection_key]['labels'][_pattern_key][_sensor_key][_label_key]
-    pc = atom_core.ros_numpy.numpify(cloud_msg)[idxs]
+    pc = getPointCloudArrayFromDataset(_dataset, _collection_key, _sensor_key)[idxs]
     points = np.zeros((4, pc.shape[0]))
     points[0, :] = pc['x']
     points[1, :] = pc['y']
@@ -236,90 +227,28 @@ def getDepthImageFromDictionary(dictionary_in, safe=False):
 @Cache(args_to_ignore=['_dataset'])
 def getPointsInDepthSensorAsNPArray(_collection_key, _pattern_key, _sensor_key, _label_key, _dataset):
     # getting image and detected idxs
-    img = getDepthImageFromDictionary(_dataset['collections'][_collection_key]['data'][_sensor_key])
+    img = getDepthImageFromDataset(_dataset, _collection_key, _sensor_key)
     idxs = _dataset['collections'][_collection_key]['labels'][_pattern_key][_sensor_key][_label_key]
 
-    # getting information from camera info
-    pinhole_camera_model = PinholeCameraModel()
-    pinhole_camera_model.fromCameraInfo(
-        message_converter.convert_dictionary_to_ros_message('sensor_msgs/CameraInfo',
-                                                            _dataset['sensors'][_sensor_key]['camera_info']))
-    f_x = pinhole_camera_model.fx()
-    f_y = pinhole_camera_model.fy()
-    c_x = pinhole_camera_model.cx()
-    c_y = pinhole_camera_model.cy()
-    w = pinhole_camera_model.fullResolution()[0]
-    # w = size[0]
-
-    # initialize lists
-    xs = []
-    ys = []
-    zs = []
-    for idx in idxs:  # iterate all points
-
-        # convert from linear idx to x_pix and y_pix indices.
-        y_pix = int(idx / w)
-        x_pix = int(idx - y_pix * w)
-
-        # get distance value for this pixel coordinate
-        distance = img[y_pix, x_pix]
-        if np.isnan(distance):  # Cannot use this point with distance nan
-            print('found nan distance for idx ' + str(idx))
-            continue
-
-        # compute 3D point and add to list of coordinates xs, ys, zs
-        x, y, z = convert_from_uvd(c_x, c_y, f_x, f_y, x_pix, y_pix, distance)
-        xs.append(x)
-        ys.append(y)
-        zs.append(z)
-
-    homogeneous = np.ones((len(xs)))
-    points = np.array((xs, ys, zs, homogeneous), dtype=float)
-    return points
+    # back-project all idxs at once, ignoring the pixels with nan distance
+    return depthIdxsToPoints(img, idxs, _dataset['sensors'][_sensor_key]['camera_info'])
 
 
 def getPointsInDepthSensorAsNPArrayNonCached(_collection_key, _pattern_key, _sensor_key, _label_key, _dataset):
     # getting image and detected idxs
-    img = getDepthImageFromDictionary(_dataset['collections'][_collection_key]['data'][_sensor_key])
+    img = getDepthImageFromDataset(_dataset, _collection_key, _sensor_key)
     idxs = _dataset['collections'][_collection_key]['labels'][_pattern_key][_sensor_key][_label_key]
 
-    # getting information from camera info
-    pinhole_camera_model = PinholeCameraModel()
-    pinhole_camera_model.fromCameraInfo(
-        message_converter.convert_dictionary_to_ros_message('sensor_msgs/CameraInfo',
-                                                            _dataset['sensors'][_sensor_key]['camera_info']))
-    f_x = pinhole_camera_model.fx()
-    f_y = pinhole_camera_model.fy()
-    c_x = pinhole_camera_model.cx()
-    c_y = pinhole_camera_model.cy()
-    w = pinhole_camera_model.fullResolution()[0]
-    # w = size[0]
-
-    # initialize lists
-    xs = []
-    ys = []
-    zs = []
-    for idx in idxs:  # iterate all points
-
-        # convert from linear idx to x_pix and y_pix indices.
-        y_pix = int(idx / w)
-        x_pix = int(idx - y_pix * w)
-
-        # get distance value for this pixel coordinate
-        distance = img[y_pix, x_pix]
-        if np.isnan(distance):  # Cannot use this point with distance nan
-            print('found nan distance for idx ' + str(idx))
-            continue
-
-        # compute 3D point and add to list of coordinates xs, ys, zs
-        x, y, z = convert_from_uvd(c_x, c_y, f_x, f_y, x_pix, y_pix, distance)
-        xs.append(x)
-        ys.append(y)
-        zs.append(z)
-
-    homogeneous = np.ones((len(xs)))
-    points = np.array((xs, ys, zs, homogeneous), dtype=float)
-    return points
+    # back-project all idxs at once, ignoring the pixels with nan distance
+    return depthIdxsToPoints(img, idxs, _dataset['sensors'][_sensor_key]['camera_info'])
+
+
+def clearCaches():
+    """ Clears the caches of the getters of points. They are keyed by the collection, pattern and sensor keys, not by
+    the dataset, so they must be cleared when another dataset is used, e.g. by a new calibration session. """
+    for function in [getPointsInPatternAsNPArray, getDepthPointsInPatternAsNPArray, getLimitPointsInPatternAsNPArray,
+                     getPointsDetectedInImageAsNPArray, getPointsInSensorAsNPArray, getPointsInDepthSensorAsNPArray]:
+        function.clearCache()
 
 
 def convert_from_uvd(cx, cy, fx, fy, xpix, ypix, d):
@@ -342,49 +271,27 @@ def printImageInfo(image, text=None):
               '\n\tmin value = ' + str(np.nanmin(image)))
 
 
-# @Cache(args_to_ignore=['residuals', 'dataset'])
-# def getNormalizerForMsgType(msg_type, residuals, dataset):
-#     values = []
-#     for sensor_key, sensor in dataset['sensors'].items():
-#         if sensor['msg_type'] == msg_type:
-#             values += [residuals[k] for k in residuals.keys() if sensor_key in k]
-#
-#     return np.mean(values)
-
-@Cache(args_to_ignore=['residuals', 'dataset'])
-def getNormalizerForMsgType(modality, residuals, dataset):
-    values = []
-    for sensor_key, sensor in dataset['sensors'].items():
-        if sensor['modality'] == modality:
-            values += [residuals[k] for k in residuals.keys() if sensor_key in k]
-
-    return np.mean(values)
-
-
-@Cache(args_to_ignore=['keys'])
-def getResKeysForSensor(sensor_key, keys):
-    return [k for k in keys if sensor_key in k]
-
-
 def objectiveFunction(data):
     """
-    Computes a list or a dictionary of residuals. There should be an error for each stamp, sensor and chessboard tuple.
+    Computes the vector of residuals. There should be an error for each stamp, sensor and chessboard tuple.
     The computation of the error varies according with the modality of the sensor:
         - Reprojection error for camera to chessboard
         - Point to plane distance for 2D laser scanners
         - (...)
+    Each block of residuals is written directly to its slot in the residuals vector, as defined by the residual
+    layout compiled when the optimization is configured.
         :return: a vector of residuals
     """
     # print('Calling objective function.')
 
     # Get the data from the model
     dataset = data['dataset']
-    patterns = data['dataset']['patterns']
     args = data['args']
     if args['view_optimization'] or args['ros_visualization']:
         dataset_graphics = data['graphics']
 
     normalizer = data['normalizer']
+    residual_layout = data['residual_layout']
 
     if not dataset['calibration_config']['joints'] == "":
         # Read all joints being optimized, and correct the corresponding transforms
@@ -403,8 +310,18 @@ def objectiveFunction(data):
 
                 # print('Transform after:\n' + str(collection['transforms'][joint['transform_key']]))
 
+    # Transforms between two frames are computed for all collections at once, the first time they are needed
+    collection_idxs = {collection_key: idx for idx, collection_key in enumerate(dataset['collections'])}
+    transforms_for_collections = {}  # key=(from_frame, to_frame) value=transforms of all collections (N x 4 x 4)
+
+    def getCollectionTransform(from_frame, to_frame, collection_key):
+        if (from_frame, to_frame) not in transforms_for_collections:
+            transforms_for_collections[(from_frame, to_frame)] = \
+                getTransformForCollections(from_frame, to_frame, dataset['collections'])
+        return transforms_for_collections[(from_frame, to_frame)][collection_idxs[collection_key]]
+
     # print('Computing cost ...')
-    r = {}  # Initialize residuals dictionary.
+    r = residual_layout.allocate()  # Initialize residuals vector.
     for collection_key, collection in dataset['collections'].items():
         for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
             for sensor_key, sensor in dataset['sensors'].items():  # iterate all sensors
@@ -420,7 +337,7 @@ def objectiveFunction(data):
                     # Transform the pts from the pattern's reference frame to the sensor's reference frame -----------------
                     from_frame = sensor['parent']
                     to_frame = dataset['calibration_config']['calibration_patterns'][pattern_key]['link']
-                    sensor_to_pattern = getTransform(from_frame, to_frame, collection['transforms'])
+                    sensor_to_pattern = getCollectionTransform(from_frame, to_frame, collection_key)
                     pts_in_sensor = np.dot(sensor_to_pattern, pts_in_pattern)
 
                     # q = transformations.quaternion_from_matrix(sensor_to_pattern)
@@ -438,17 +355,12 @@ def objectiveFunction(data):
                         collection_key, pattern_key, sensor_key, dataset)
 
                     # Compute the residuals as the distance between the pt_in_image and the pt_detected_in_image
-                    for idx, label_idx in enumerate(collection['labels'][pattern_key][sensor_key]['idxs']):
-                        rname = 'c' + str(collection_key) + '_' + "p_" + pattern_key + "_" + \
-                            str(sensor_key) + '_corner' + str(label_idx['id'])
-                        r[rname] = np.sqrt((pts_in_image[0, idx] - pts_detected_in_image[0, idx]) ** 2 +
-                                           (pts_in_image[1, idx] - pts_detected_in_image[1, idx]) ** 2) / normalizer[
-                            'rgb']
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'corners')] = \
+                        np.sqrt(np.sum((pts_in_image - pts_detected_in_image) ** 2, axis=0)) / normalizer['rgb']
 
                     # Required by the visualization function to publish annotated images
-                    idxs_projected = []
-                    for idx in range(0, pts_in_image.shape[1]):
-                        idxs_projected.append({'x': pts_in_image[0][idx], 'y': pts_in_image[1][idx]})
+                    idxs_projected = [{'x': x, 'y': y} for x, y in zip(pts_in_image[0, :].tolist(),
+                                                                       pts_in_image[1, :].tolist())]
                     collection['labels'][pattern_key][sensor_key]['idxs_projected'] = idxs_projected  # store projections
 
                     # store the first projections
@@ -459,82 +371,51 @@ def objectiveFunction(data):
                 elif sensor['modality'] == 'lidar2d':
                     # Get laser points that belong to the chessboard
                     idxs = collection['labels'][pattern_key][sensor_key]['idxs']
-                    rhos = [collection['data'][sensor_key]['ranges'][idx] for idx in idxs]
-                    thetas = [collection['data'][sensor_key]['angle_min'] +
-                              collection['data'][sensor_key]['angle_increment'] * idx for idx in idxs]
+                    rhos = np.array([collection['data'][sensor_key]['ranges'][idx] for idx in idxs], dtype=float)
+                    thetas = collection['data'][sensor_key]['angle_min'] + \
+                        collection['data'][sensor_key]['angle_increment'] * np.array(idxs, dtype=float)
 
                     # Convert from polar to cartesian coordinates and create np array with xyz coords
                     # TODO could be done only once
                     pts_in_laser = np.zeros((4, len(rhos)), np.float32)
-                    for idx, (rho, theta) in enumerate(zip(rhos, thetas)):
-                        pts_in_laser[0, idx] = rho * math.cos(theta)
-                        pts_in_laser[1, idx] = rho * math.sin(theta)
-                        pts_in_laser[2, idx] = 0
-                        pts_in_laser[3, idx] = 1
+                    pts_in_laser[0, :] = rhos * np.cos(thetas)
+                    pts_in_laser[1, :] = rhos * np.sin(thetas)
+                    pts_in_laser[2, :] = 0
+                    pts_in_laser[3, :] = 1
 
                     from_frame = dataset['calibration_config']['calibration_pattern']['link']
                     to_frame = sensor['parent']
                     pattern_to_sensor = getTransform(from_frame, to_frame, collection['transforms'])
                     pts_in_chessboard = np.dot(pattern_to_sensor, pts_in_laser)
 
-                    # Compute the coordinate of the laser points in the chessboard reference frame
-                    # root_to_sensor = getAggregateTransform(sensor['chain'], collection['transforms'])
-                    # pts_in_root = np.dot(root_to_sensor, pts_in_laser)
-                    #
-                    # transform_key = opt_utilities.generateKey(sensor['calibration_parent'], sensor['calibration_child'])
-                    # trans = collection['transforms'][transform_key]['trans']
-                    # quat = collection['transforms'][transform_key]['quat']
-                    #
-                    #
-                    #
-                    # chessboard_to_root = np.linalg.inv(opt_utilities.translationQuaternionToTransform(trans, quat))
-                    # pts_in_chessboard = np.dot(chessboard_to_root, pts_in_root)
-
                     # --- Residuals: longitudinal error for extrema
-                    pts = []
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['left'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['right'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['top'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['bottom'])
-                    pts_canvas_in_chessboard = np.array([[pt['x'] for pt in pts], [pt['y'] for pt in pts]], float)
-
-                    # pts_canvas_in_chessboard = patterns['limit_points'][0:2, :].transpose()
+                    pts_canvas_in_chessboard = getLimitPointsInPatternAsNPArray(pattern_key, dataset)
 
                     # compute minimum distance to inner_pts for right most edge (first in pts_in_chessboard list)
                     extrema_right = np.reshape(pts_in_chessboard[0:2, 0], (2, 1))  # longitudinal -> ignore z values
-                    rname = collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_eright'
-                    r[rname] = float(np.amin(distance.cdist(extrema_right.transpose(),
-                                                            pts_canvas_in_chessboard.transpose(), 'euclidean'))) / \
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'eright')] = \
+                        float(np.amin(distance.cdist(extrema_right.transpose(),
+                                                     pts_canvas_in_chessboard.transpose(), 'euclidean'))) / \
                         normalizer['lidar2d']
 
                     # compute minimum distance to inner_pts for left most edge (last in pts_in_chessboard list)
                     extrema_left = np.reshape(pts_in_chessboard[0:2, -1], (2, 1))  # longitudinal -> ignore z values
-                    rname = collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_eleft'
-                    r[rname] = float(np.amin(distance.cdist(extrema_left.transpose(),
-                                                            pts_canvas_in_chessboard.transpose(), 'euclidean'))) / \
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'eleft')] = \
+                        float(np.amin(distance.cdist(extrema_left.transpose(),
+                                                     pts_canvas_in_chessboard.transpose(), 'euclidean'))) / \
                         normalizer['lidar2d']
 
                     # --- Residuals: Longitudinal distance for inner points
-                    pts = []
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['left'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['right'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['top'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['bottom'])
-                    pts_inner_in_chessboard = np.array([[pt['x'] for pt in pts], [pt['y'] for pt in pts]], float)
-                    # pts_inner_in_chessboard = patterns['inner_points'][0:2, :].transpose()
+                    pts_inner_in_chessboard = getLimitPointsInPatternAsNPArray(pattern_key, dataset)
                     edges2d_in_chessboard = pts_in_chessboard[0:2,
                                                               collection['labels'][sensor_key]['edge_idxs']]  # this
                     # is a longitudinal residual, so ignore z values.
 
-                    for idx in xrange(
-                            edges2d_in_chessboard.shape[1]):  # compute minimum distance to inner_pts for each edge
-                        xa = np.reshape(edges2d_in_chessboard[:, idx], (2, 1)
-                                        ).transpose()  # need the reshape because this
-                        # becomes a shape (2,) which the function cdist does not support.
-
-                        rname = collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_inner_' + str(idx)
-                        r[rname] = float(np.amin(distance.cdist(xa, pts_inner_in_chessboard.transpose(), 'euclidean'))) / \
-                            normalizer['lidar2d']
+                    # compute minimum distance to inner_pts for each edge
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'inner')] = \
+                        np.amin(distance.cdist(edges2d_in_chessboard.transpose(),
+                                               pts_inner_in_chessboard.transpose(), 'euclidean'), axis=1) / \
+                        normalizer['lidar2d']
 
                     # --- Residuals: Beam direction distance from point to chessboard plan
                     # For computing the intersection we need:
@@ -570,6 +451,7 @@ def objectiveFunction(data):
                         marker.points = []
                         rviz_p0_in_laser = Point(p0_in_laser[0], p0_in_laser[1], p0_in_laser[2])
 
+                    beam_residuals = np.zeros((pts_in_laser.shape[1],), dtype=np.float64)
                     for idx in range(0, pts_in_laser.shape[1]):  # for all points
                         rho = rhos[idx]
                         p1_in_laser = pts_in_laser[:, idx]
@@ -579,18 +461,18 @@ def objectiveFunction(data):
                             raise ValueError('Pattern is almost parallel to the laser beam! Please remove collection ' +
                                              collection_key)
 
-                        rname = collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_beam_' + str(idx)
-                        r[rname] = abs(distance_two_3D_points(p0_in_laser, pt_intersection) - rho) / \
+                        beam_residuals[idx] = abs(distance_two_3D_points(p0_in_laser, pt_intersection) - rho) / \
                             normalizer['lidar2d']
 
                         if args['ros_visualization']:
                             marker.points.append(copy.deepcopy(rviz_p0_in_laser))
                             marker.points.append(Point(pt_intersection[0], pt_intersection[1], pt_intersection[2]))
 
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'beam')] = beam_residuals
+
                 # elif sensor['msg_type'] == 'PointCloud2':
                 elif sensor['modality'] == 'lidar3d':
 
-                    now = datetime.now()
                     # Get the 3D LiDAR labelled points for the given collection
                     points_in_sensor = getPointsInSensorAsNPArray(
                         collection_key, pattern_key, sensor_key, 'idxs', dataset)
@@ -601,17 +483,16 @@ def objectiveFunction(data):
                     # Transform the pts from the pattern's reference frame to the sensor's reference frame -----------------
                     from_frame = pattern['link']
                     to_frame = sensor['parent']
-                    lidar_to_pattern = getTransform(from_frame, to_frame, collection['transforms'])
+                    lidar_to_pattern = getCollectionTransform(from_frame, to_frame, collection_key)
 
                     # TODO we could also use the middle points ...
                     # points_in_pattern = np.dot(lidar_to_pattern, detected_middle_points_in_sensor)
                     points_in_pattern = np.dot(lidar_to_pattern, points_in_sensor)
 
-                    rname_pre = 'c' + collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_oe_'
-                    for idx in collection['labels'][pattern_key][sensor_key]['samples']:
-                        # Compute the residual: absolute of z component
-                        rname = rname_pre + str(idx)
-                        r[rname] = float(abs(points_in_pattern[2, idx])) / normalizer['lidar3d']
+                    # Compute the residuals: absolute of z component
+                    samples = collection['labels'][pattern_key][sensor_key]['samples']
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'oe')] = \
+                        np.abs(points_in_pattern[2, samples]) / normalizer['lidar3d']
 
                     # ------------------------------------------------------------------------------------------------
                     # --- Pattern Extrema Residuals: Distance from the extremas of the pattern to the extremas of the cloud
@@ -619,111 +500,53 @@ def objectiveFunction(data):
                     detected_limit_points_in_sensor = getPointsInSensorAsNPArray(
                         collection_key, pattern_key, sensor_key, 'idxs_limit_points', dataset)
 
-                    from_frame = pattern['link']
-                    to_frame = sensor['parent']
-                    pattern_to_sensor = getTransform(from_frame, to_frame, collection['transforms'])
-                    detected_limit_points_in_pattern = np.dot(pattern_to_sensor, detected_limit_points_in_sensor)
+                    detected_limit_points_in_pattern = np.dot(lidar_to_pattern, detected_limit_points_in_sensor)
 
-                    pts = []
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['left'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['right'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['top'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['bottom'])
-                    ground_truth_limit_points_in_pattern = np.array([[pt['x'] for pt in pts], [pt['y'] for pt in pts]],
-                                                                    float)
+                    ground_truth_limit_points_in_pattern = getLimitPointsInPatternAsNPArray(pattern_key, dataset)
 
                     # Compute and save residuals
-                    for idx in range(detected_limit_points_in_pattern.shape[1]):
-                        m_pt = np.reshape(detected_limit_points_in_pattern[0:2, idx], (1, 2))
-                        rname = 'c' + collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_ld_' + str(idx)
-                        r[rname] = np.min(distance.cdist(m_pt,
-                                                         ground_truth_limit_points_in_pattern.transpose(), 'euclidean')) / \
-                            normalizer['lidar3d']
-                    # ------------------------------------------------------------------------------------------------
-                    # print('Objective function for ' + sensor_key + ' took ' + str((datetime.now() - now).total_seconds()) + ' secs.')
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'ld')] = \
+                        np.min(distance.cdist(detected_limit_points_in_pattern[0:2, :].transpose(),
+                                              ground_truth_limit_points_in_pattern.transpose(), 'euclidean'),
+                               axis=1) / normalizer['lidar3d']
 
                 elif sensor['modality'] == 'depth':
-                    now_i = datetime.now()
 
-                    # print("Depth calibration under construction")
                     points_in_sensor = getPointsInDepthSensorAsNPArray(
                         collection_key, pattern_key, sensor_key, 'idxs', dataset)
 
-                    # print('POINTS IN SENSOR ' + sensor_key + ' took ' + str((datetime.now() - now_i).total_seconds()) + ' secs.')
-                    now = datetime.now()
                     from_frame = dataset['calibration_config']['calibration_patterns'][pattern_key]['link']
                     to_frame = sensor['parent']
-                    depth_to_pattern = getTransform(from_frame, to_frame, collection['transforms'])
+                    depth_to_pattern = getCollectionTransform(from_frame, to_frame, collection_key)
 
                     # TODO we could also use the middle points ...
                     # points_in_pattern = np.dot(lidar_to_pattern, detected_middle_points_in_sensor)
 
                     points_in_pattern = np.dot(depth_to_pattern, points_in_sensor)
-                    # print('POINTS IN PATTERN ' + sensor_key + ' took ' + str(
-                    #     (datetime.now() - now).total_seconds()) + ' secs.')
-
-                    now = datetime.now()
-
-                    rname_pre = 'c' + collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_oe_'
-                    for idx in collection['labels'][pattern_key][sensor_key]['samples']:
-                        # Compute the residual: absolute of z component
-                        rname = rname_pre + str(idx)
-                        r[rname] = float(abs(points_in_pattern[2, idx])) / normalizer['depth']
-                        value = points_in_pattern[2, idx]
-                        if np.isnan(value):
-                            print('Sensor ' + sensor_key + ' residual ' + rname + ' is nan')
-                            print(value)
-
-                    # print('ORTOGONAL RESIDUALS ' + sensor_key + ' took ' + str(
-                    #     (datetime.now() - now).total_seconds()) + ' secs.')
+
+                    # Compute the residuals: absolute of z component
+                    samples = collection['labels'][pattern_key][sensor_key]['samples']
+                    values = points_in_pattern[2, samples]
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'oe')] = \
+                        np.abs(values) / normalizer['depth']
+                    if np.any(np.isnan(values)):
+                        print('Sensor ' + sensor_key + ' has nan orthogonal residuals in collection ' + collection_key)
+
                     # ------------------------------------------------------------------------------------------------
                     # --- Pattern Extrema Residuals: Distance from the extremas of the pattern to the extremas of the cloud
                     # ------------------------------------------------------------------------------------------------
-                    now = datetime.now()
                     detected_limit_points_in_sensor = getPointsInDepthSensorAsNPArray(
                         collection_key, pattern_key, sensor_key, 'idxs_limit_points', dataset)
-                    # print(detected_limit_points_in_sensor.shape)
-                    # print('POINTS IN SENSOR LIMITS ' + sensor_key + ' took ' + str(
-                    #     (datetime.now() - now).total_seconds()) + ' secs.')
-                    now = datetime.now()
 
-                    from_frame = dataset['calibration_config']['calibration_patterns'][pattern_key]['link']
-                    to_frame = sensor['parent']
-                    pattern_to_sensor = getTransform(from_frame, to_frame, collection['transforms'])
-                    detected_limit_points_in_pattern = np.dot(pattern_to_sensor, detected_limit_points_in_sensor)
-                    # print('POINTS IN PATTERN LIMITS ' + sensor_key + ' took ' + str(
-                    #     (datetime.now() - now).total_seconds()) + ' secs.')
-                    pts = []
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['left'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['right'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['top'])
-                    pts.extend(patterns[pattern_key]['frame']['lines_sampled']['bottom'])
-                    ground_truth_limit_points_in_pattern = np.array([[pt['x'] for pt in pts], [pt['y'] for pt in pts]],
-                                                                    float)
-                    now = datetime.now()
-                    # # print("objective function: ", detected_limit_points_in_pattern.shape[1])
-                    # # Compute and save residuals
-                    # # for idx in range(detected_limit_points_in_pattern.shape[1]):
-                    # if detected_limit_points_in_pattern[0:2, :].shape[1] != len(collection['labels'][sensor_key]['samples_longitudinal']) :
-                    #     print(collection['labels'][sensor_key]['samples_longitudinal'])
-                    #     print("Sensor: " + str(sensor_key))
-                    #     print("Collection: " + str(collection_key))
-                    #     print(detected_limit_points_in_pattern[0:2, :].shape)
-                    #     print(len(collection['labels'][sensor_key]['samples_longitudinal']))
-
-                    for idx in collection['labels'][pattern_key][sensor_key]['samples_longitudinal']:
-                        m_pt = np.reshape(detected_limit_points_in_pattern[0:2, idx], (1, 2))
-                        rname = 'c' + collection_key + '_' + "p_" + pattern_key + "_" + sensor_key + '_ld_' + str(idx)
-                        r[rname] = np.min(distance.cdist(m_pt,
-                                                         ground_truth_limit_points_in_pattern.transpose(), 'euclidean')) / \
-                            normalizer['depth']
-
-                    # print('LONGITUDINAL RESIDUALS ' + sensor_key + ' took ' + str((datetime.now() - now).total_seconds()) + ' secs.')
-                    # print('TOTAL TIME Objective function for ' + sensor_key + ' took ' + str(
-                    #     (datetime.now() - now_i).total_seconds()) + ' secs.')
-                    # TODO ortogonal e longitudinal
-                    # inspiração no LiDAR mas transformar xpix ypix em X,Y no ref da câmera
-                    # print(r.keys())
+                    detected_limit_points_in_pattern = np.dot(depth_to_pattern, detected_limit_points_in_sensor)
+
+                    ground_truth_limit_points_in_pattern = getLimitPointsInPatternAsNPArray(pattern_key, dataset)
+
+                    samples_longitudinal = collection['labels'][pattern_key][sensor_key]['samples_longitudinal']
+                    r[residual_layout.getSlice(collection_key, pattern_key, sensor_key, 'ld')] = \
+                        np.min(distance.cdist(detected_limit_points_in_pattern[0:2, samples_longitudinal].transpose(),
+                                              ground_truth_limit_points_in_pattern.transpose(), 'euclidean'),
+                               axis=1) / normalizer['depth']
 
                     # PROJECT CORNER POINTS TO SENSOR
                     pts_in_pattern = getDepthPointsInPatternAsNPArray(collection_key, pattern_key, sensor_key, dataset)
@@ -734,15 +557,14 @@ def objectiveFunction(data):
 
                     from_frame = sensor['parent']
                     to_frame = dataset['calibration_config']['calibration_patterns'][pattern_key]['link']
-                    sensor_to_pattern = getTransform(from_frame, to_frame, collection['transforms'])
+                    sensor_to_pattern = getCollectionTransform(from_frame, to_frame, collection_key)
                     pts_in_sensor = np.dot(sensor_to_pattern, pts_in_pattern)
 
                     pts_in_image, _, _ = projectToCamera(K, D, w, h, pts_in_sensor[0:3, :])
 
                     # Required by the visualization function to publish annotated images
-                    idxs_projected = []
-                    for idx in range(0, pts_in_image.shape[1]):
-                        idxs_projected.append({'x': pts_in_image[0][idx], 'y': pts_in_image[1][idx]})
+                    idxs_projected = [{'x': x, 'y': y} for x, y in zip(pts_in_image[0, :].tolist(),
+                                                                       pts_in_image[1, :].tolist())]
                     collection['labels'][pattern_key][sensor_key]['idxs_projected'] = idxs_projected  # store projections
 
                     # store the first projections
@@ -752,6 +574,6 @@ def objectiveFunction(data):
                     raise ValueError("Unknown sensor msg_type or modality")
 
     if args['verbose'] and data['status']['is_iteration']:
-        errorReport(dataset=dataset, residuals=r, normalizer=normalizer, args=args)
+        errorReport(dataset=dataset, residuals=r, normalizer=normalizer, args=args, residual_layout=residual_layout)
 
     return r  # Return the residuals
@@ -0,0 +1,102 @@
+"""
+Definition of the layout of the residuals vector.
+"""
+
+# -------------------------------------------------------------------------------
+# --- IMPORTS
+# -------------------------------------------------------------------------------
+
+# Standard imports
+from collections import OrderedDict
+
+import numpy as np
+
+
+# -------------------------------------------------------------------------------
+# --- CLASS
+# -------------------------------------------------------------------------------
+class ResidualLayout:
+    """
+    Compiled layout of the residuals vector. Residuals are organized in blocks, one per (collection, pattern, sensor,
+    kind) tuple, e.g. the corner reprojection errors of an rgb sensor, or the orthogonal errors of a depth sensor. The
+    slot of each block in the residuals vector is fixed once, when the optimization is configured, so that the
+    objective function can write the residuals of a block directly into a numpy array, without building dictionaries
+    of named residuals.
+
+    For reports, each residual is also labelled with the integer index of its collection, pattern, sensor and kind
+    (see getLabels), so that residuals are grouped with numpy reductions instead of searching the blocks.
+    """
+
+    fields = ('collection', 'pattern', 'sensor', 'kind')  # the fields of the key of a block, in order
+
+    def __init__(self):
+        self.blocks = OrderedDict()  # key=(collection_key, pattern_key, sensor_key, kind) value=slice in the vector
+        self.size = 0  # total number of residuals
+        self.labels = {}  # key=field value=(keys, labels), computed when first needed
+
+    def addBlock(self, collection_key, pattern_key, sensor_key, kind, number_of_residuals):
+        """ Appends a new block of residuals to the end of the residuals vector.
+
+        :param collection_key: the collection of the residuals
+        :param pattern_key: the pattern of the residuals
+        :param sensor_key: the sensor of the residuals
+        :param kind: the kind of residuals, e.g. 'corners', 'oe' (orthogonal error) or 'ld' (longitudinal distance)
+        :param number_of_residuals: how many residuals the block has
+        :return: the slice of the block in the residuals vector
+        """
+        key = (collection_key, pattern_key, sensor_key, kind)
+        if key in self.blocks:  # Cannot add a block that already exists
+            raise ValueError('Residual block ' + str(key) + ' already exists. Cannot add it.')
+
+        self.blocks[key] = slice(self.size, self.size + number_of_residuals)
+        self.size += number_of_residuals
+        self.labels = {}  # labels must be computed again
+        return self.blocks[key]
+
+    def getSlice(self, collection_key, pattern_key, sensor_key, kind):
+        """ Gets the slice of the residuals vector where a block of residuals is written. """
+        return self.blocks[(collection_key, pattern_key, sensor_key, kind)]
+
+    def allocate(self):
+        """ Allocates a residuals vector with the size of the layout. """
+        return np.zeros((self.size,), dtype=np.float64)
+
+    def getLabels(self, field):
+        """ Gets the label of each residual for one of the fields of the key of the blocks.
+
+        :param field: 'collection', 'pattern', 'sensor' or 'kind'
+        :return: a tuple (keys, labels), where keys is the list of the distinct values of the field, in order of
+        appearance, and labels is an integer array (size) with the index in keys of the value of each residual
+        """
+        if field not in self.labels:
+            field_idx = self.fields.index(field)
+            keys = list(OrderedDict.fromkeys([key[field_idx] for key in self.blocks]))
+            key_idxs = {key: idx for idx, key in enumerate(keys)}
+            block_labels = [key_idxs[key[field_idx]] for key in self.blocks]
+            block_sizes = [block.stop - block.start for block in self.blocks.values()]
+            self.labels[field] = (keys, np.repeat(np.array(block_labels, dtype=int), block_sizes))
+
+        return self.labels[field]
+
+    def groupedSums(self, residuals, fields, mask=None):
+        """ Sums the residuals grouped by one or more fields, e.g. by collection and sensor.
+
+        :param residuals: the residuals vector
+        :param fields: a tuple of fields, e.g. ('collection', 'sensor')
+        :param mask: a boolean array (size) with the residuals to account for. All if None.
+        :return: a tuple (keys, sums, counts), where keys is a list with the keys of each field (see getLabels), and
+        sums and counts are arrays with one dimension per field, with the sum and the number of the residuals of each
+        group
+        """
+        keys, labels = zip(*[self.getLabels(field) for field in fields])
+        shape = tuple([len(k) for k in keys])
+        group_labels = np.ravel_multi_index(labels, shape) if self.size > 0 else np.zeros((0,), dtype=int)
+
+        residuals = np.asarray(residuals, dtype=float)
+        if mask is not None:
+            group_labels, residuals = group_labels[mask], residuals[mask]
+
+        number_of_groups = int(np.prod(shape))
+        sums = np.bincount(group_labels, weights=residuals, minlength=number_of_groups).reshape(shape)
+        counts = np.bincount(group_labels, minlength=number_of_groups).reshape(shape)
+        return list(keys), sums, counts
@@ -8,6 +8,8 @@ import copy
 import math
 import os
 import pprint
+import threading
+from collections import namedtuple
 
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -43,10 +45,14 @@ from atom_core.naming import generateLabeledTopic, generateName
 from atom_core.system import execute
 from atom_core.config_io import uriReader
 from atom_core.xacro_io import readXacroFile
-from atom_core.dataset_io import (getCvImageFromDictionary, getCvImageFromDictionaryDepth,
-                                  getPointCloudMessageFromDictionary, genCollectionPrefix)
+from atom_core.dataset_io import genCollectionPrefix, getCvImageFromDataset
 from atom_calibration.calibration.objective_function import *
 
+# ------------------------
+# DATA STRUCTURES   ##
+# ------------------------
+VisualizationSnapshotT = namedtuple('VisualizationSnapshotT', 'transforms laser_beam_markers projections')
+
 # -------------------------------------------------------------------------------
 # --- FUNCTIONS
 # -------------------------------------------------------------------------------
@@ -54,8 +60,7 @@ from atom_calibration.calibration.objective_function import *
 
 @Cache(args_to_ignore=['dataset'])
 def getCvImageFromCollectionSensor(collection_key, sensor_key, dataset):
-    dictionary = dataset['collections'][collection_key]['data'][sensor_key]
-    return getCvImageFromDictionary(dictionary)
+    return getCvImageFromDataset(dataset, collection_key, sensor_key)
 
 
 def createPatternMarkers(frame_id, ns, collection_key, pattern_key, now, dataset, graphics):
@@ -574,18 +579,68 @@ def setupVisualization(dataset, args, selected_collection_key):
     return graphics
 
 
-def visualizationFunction(models):
-    # print(Fore.RED + 'Visualization function called.' + Style.RESET_ALL)
-    # Get the data from the meshes
+def takeVisualizationSnapshot(models):
+    """
+    Copies the state of the optimization which is visualized, i.e., the transforms of each collection, the points of
+    the laser beam markers and the projected labels. Nothing is drawn or converted to ros messages, so that this is
+    cheap enough to run inside the optimization.
+    """
     dataset = models['dataset']
-    args = models['args']
-    collections = models['dataset']['collections']
-    sensors = models['dataset']['sensors']
-    patterns = models['dataset']['patterns']
-    config = models['dataset']['calibration_config']
     graphics = models['graphics']
 
-    # print("args['initial_pose_ghost'])" + str(args['initial_pose_ghost']))
+    transforms = {collection_key: [(transform['parent'], transform['child'], list(transform['trans']),
+                                    list(transform['quat'])) for transform in collection['transforms'].values()]
+                  for collection_key, collection in dataset['collections'].items()}
+
+    # The objective function rebuilds the points of the laser beam markers at each call
+    laser_beam_markers = [copy.copy(marker) for marker in graphics['ros']['MarkersLaserBeams'].markers]
+    for marker in laser_beam_markers:
+        marker.points = list(marker.points)
+
+    # The objective function replaces (does not change) the lists of projected labels at each call
+    projections = {}
+    for collection_key, collection in dataset['collections'].items():
+        for pattern_key in dataset['calibration_config']['calibration_patterns']:
+            for sensor_key, labels in collection['labels'][pattern_key].items():
+                if 'idxs_projected' in labels:
+                    projections[(collection_key, pattern_key, sensor_key)] = labels['idxs_projected']
+
+    return VisualizationSnapshotT(transforms, laser_beam_markers, projections)
+
+
+def getImageKeys(dataset):
+    """ Gets the (collection_key, sensor_key) of the images to publish, those of the rgb and depth sensors which
+    detected at least one of the patterns in the collection. """
+    image_keys = []
+    for collection_key, collection in dataset['collections'].items():
+        for sensor_key, sensor in dataset['sensors'].items():
+            if sensor['modality'] not in ['rgb', 'depth']:
+                continue
+
+            if any([collection['labels'][pattern_key][sensor_key]['detected']
+                    for pattern_key in dataset['calibration_config']['calibration_patterns']]):
+                image_keys.append((collection_key, sensor_key))
+    return image_keys
+
+
+def visualizationFunction(models):
+    """ Publishes the visualization of the current state of the optimization, with all the images. """
+    dataset = models['dataset']
+    image_keys = getImageKeys(dataset) if models['args']['show_images'] else []
+    publishVisualization(dataset, models['args'], models['graphics'], takeVisualizationSnapshot(models), image_keys)
+
+
+def publishVisualization(dataset, args, graphics, snapshot, image_keys, throttle=True):
+    """
+    Publishes the transforms, markers and images of a snapshot of the optimization (see takeVisualizationSnapshot).
+
+    :param image_keys: a list of the (collection_key, sensor_key) of the images to publish.
+    :param throttle: if True, the markers and images are published only every other call, and the transforms at every
+    call. Not needed if the calls are already limited to a bounded rate.
+    """
+    collections = dataset['collections']
+    sensors = dataset['sensors']
+    config = dataset['calibration_config']
 
     now = rospy.Time.now()  # time used to publish all visualization messages
 
@@ -614,11 +669,9 @@ def visualizationFunction(models):
             transfoms.append(transform)
 
         # Publish all current transforms
-        for transform_key, transform in collection['transforms'].items():
-            parent = generateName(transform['parent'], prefix='c' + collection_key)
-            child = generateName(transform['child'], prefix='c' + collection_key)
-            x, y, z = transform['trans']
-            qx, qy, qz, qw = transform['quat']
+        for transform_parent, transform_child, (x, y, z), (qx, qy, qz, qw) in snapshot.transforms[collection_key]:
+            parent = generateName(transform_parent, prefix='c' + collection_key)
+            child = generateName(transform_child, prefix='c' + collection_key)
             transform = TransformStamped(header=Header(frame_id=parent, stamp=now),
                                          child_frame_id=child,
                                          transform=Transform(translation=Vector3(x=x, y=y, z=z),
@@ -640,7 +693,7 @@ def visualizationFunction(models):
     graphics['ros']['tf_broadcaster'].sendTransform(transfoms)
 
     # print("graphics['ros']['Counter'] = " + str(graphics['ros']['Counter']))
-    if graphics['ros']['Counter'] < 1:
+    if throttle and graphics['ros']['Counter'] < 1:
         graphics['ros']['Counter'] += 1
         return None
     else:
@@ -667,119 +720,182 @@ def visualizationFunction(models):
             graphics['ros']['sensors'][sensor_key]['MarkersLabeled'])
 
     # Publish Laser Beams
-    for marker in graphics['ros']['MarkersLaserBeams'].markers:
+    for marker in snapshot.laser_beam_markers:
         marker.header.stamp = now
-    graphics['ros']['PubLaserBeams'].publish(graphics['ros']['MarkersLaserBeams'])
+    graphics['ros']['PubLaserBeams'].publish(MarkerArray(markers=snapshot.laser_beam_markers))
 
     # ---------------------------------------------------------------------------------
     # Publish 2D labels
     # ---------------------------------------------------------------------------------
-    if args['show_images']:
-
-        for collection_key, collection in collections.items():
-            for sensor_key, sensor in sensors.items():
-
-                # check if sensor detects and of the patterns
-                flag_detects_at_leas_one_pattern = False
-                for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
-                    if collection['labels'][pattern_key][sensor_key]['detected']:
-                        flag_detects_at_leas_one_pattern = True
-
-                # If in this collection, sensor did not detect any of the patterns, continue
-                if flag_detects_at_leas_one_pattern == False:
-                    continue
-
-                if sensor['modality'] == 'rgb':
-                    image = copy.deepcopy(getCvImageFromCollectionSensor(collection_key, sensor_key, dataset))
-                    width = collection['data'][sensor_key]['width']
-                    height = collection['data'][sensor_key]['height']
-                    diagonal = math.sqrt(width ** 2 + height ** 2)
-
-                    for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
-
-                        cm = graphics['patterns'][pattern_key]['colormap']
-                        # Draw projected points (as dots)
-                        for idx, point in enumerate(collection['labels'][pattern_key][sensor_key]['idxs_projected']):
-                            x = int(round(point['x']))
-                            y = int(round(point['y']))
-                            color = (cm[idx, 2] * 255, cm[idx, 1] * 255, cm[idx, 0] * 255)
-                            cv2.line(image, (x, y), (x, y), color, int(6E-3 * diagonal))
-
-                        # Draw ground truth points (as squares)
-                        for idx, point in enumerate(collection['labels'][pattern_key][sensor_key]['idxs']):
-                            x = int(round(point['x']))
-                            y = int(round(point['y']))
-                            color = (cm[idx, 2] * 255, cm[idx, 1] * 255, cm[idx, 0] * 255)
-                            drawSquare2D(image, x, y, int(8E-3 * diagonal), color=color, thickness=2)
-
-                        # Draw initial projected points (as crosses)
-                        for idx, point in enumerate(collection['labels'][pattern_key][sensor_key]['idxs_initial']):
-                            x = int(round(point['x']))
-                            y = int(round(point['y']))
-                            color = (cm[idx, 2] * 255, cm[idx, 1] * 255, cm[idx, 0] * 255)
-                            drawCross2D(image, x, y, int(8E-3 * diagonal), color=color, thickness=1)
-
-                    msg = CvBridge().cv2_to_imgmsg(image, "bgr8")
-
-                    msg.header.frame_id = 'c' + collection_key + '_' + sensor['parent']
-                    graphics['collections'][collection_key][sensor_key]['publisher'].publish(msg)
-
-                    # Publish camera info message
-                    camera_info_msg = message_converter.convert_dictionary_to_ros_message('sensor_msgs/CameraInfo',
-                                                                                          sensor['camera_info'])
-                    camera_info_msg.header.frame_id = msg.header.frame_id
-                    graphics['collections'][collection_key][sensor_key]['publisher_camera_info'].publish(
-                        camera_info_msg)
-
-                elif sensor['modality'] == 'depth':
-                    # Shortcut variables
-                    collection = collections[collection_key]
-                    image = copy.deepcopy(
-                        getCvDepthImageFromCollectionSensor(collection_key, sensor_key, dataset, scale=10000.0))
-
-                    width = collection['data'][sensor_key]['width']
-                    height = collection['data'][sensor_key]['height']
-                    diagonal = math.sqrt(width ** 2 + height ** 2)/2
-                    # print(width, height)
-
-                    for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
-
-                        idxs = collection['labels'][pattern_key][sensor_key]['idxs']
-                        idxs_limit_points = collection['labels'][pattern_key][sensor_key]['idxs_limit_points']
-                        gui_image = np.zeros((height, width, 3), dtype=np.uint8)
-                        max_value = 5
-                        gui_image[:, :, 0] = image / max_value * 255
-                        gui_image[:, :, 1] = image / max_value * 255
-                        gui_image[:, :, 2] = image / max_value * 255
-
-                        for idx in idxs:
-                            # convert from linear idx to x_pix and y_pix indices.
-                            y = int(idx / width)
-                            x = int(idx - y * width)
-                            cv2.line(gui_image, (x, y), (x, y), (0, 200, 255), 3)
-                        for idx in idxs_limit_points:
-                            # convert from linear idx to x_pix and y_pix indices.
-                            y = int(idx / width)
-                            x = int(idx - y * width)
-                            drawSquare2D(gui_image, x, y, int(8E-3 * diagonal), (255, 0, 200), thickness=1)
-
-                        # Draw projected points (as dots)
-                        for idx, point in enumerate(collection['labels'][pattern_key][sensor_key]['idxs_projected']):
-                            x = int(round(point['x']))
-                            y = int(round(point['y']))
-                            if x < width - 1 and y < height - 1:
-                                cv2.line(gui_image, (x, y), (x, y), (0, 0, 255), 3)
-
-                    msg = CvBridge().cv2_to_imgmsg(gui_image, "passthrough")
-
-                    msg.header.frame_id = 'c' + collection_key + '_' + sensor['parent']
-                    graphics['collections'][collection_key][sensor_key]['publisher'].publish(msg)
-
-                    # Publish camera info message
-                    camera_info_msg = message_converter.convert_dictionary_to_ros_message('sensor_msgs/CameraInfo',
-                                                                                          sensor['camera_info'])
-                    camera_info_msg.header.frame_id = msg.header.frame_id
-                    graphics['collections'][collection_key][sensor_key]['publisher_camera_info'].publish(
-                        camera_info_msg)
-
-    graphics['ros']['Rate'].sleep()
+    for collection_key, sensor_key in image_keys:
+        collection = collections[collection_key]
+        sensor = sensors[sensor_key]
+
+        if sensor['modality'] == 'rgb':
+            image = getCvImageFromCollectionSensor(collection_key, sensor_key, dataset).copy()
+            width = collection['data'][sensor_key]['width']
+            height = collection['data'][sensor_key]['height']
+            diagonal = math.sqrt(width ** 2 + height ** 2)
+
+            for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
+
+                cm = graphics['patterns'][pattern_key]['colormap']
+                # Draw projected points (as dots)
+                for idx, point in enumerate(snapshot.projections.get((collection_key, pattern_key, sensor_key), [])):
+                    x = int(round(point['x']))
+                    y = int(round(point['y']))
+                    color = (cm[idx, 2] * 255, cm[idx, 1] * 255, cm[idx, 0] * 255)
+                    cv2.line(image, (x, y), (x, y), color, int(6E-3 * diagonal))
+
+                # Draw ground truth points (as squares)
+                for idx, point in enumerate(collection['labels'][pattern_key][sensor_key]['idxs']):
+                    x = int(round(point['x']))
+                    y = int(round(point['y']))
+                    color = (cm[idx, 2] * 255, cm[idx, 1] * 255, cm[idx, 0] * 255)
+                    drawSquare2D(image, x, y, int(8E-3 * diagonal), color=color, thickness=2)
+
+                # Draw initial projected points (as crosses)
+                for idx, point in enumerate(collection['labels'][pattern_key][sensor_key]['idxs_initial']):
+                    x = int(round(point['x']))
+                    y = int(round(point['y']))
+                    color = (cm[idx, 2] * 255, cm[idx, 1] * 255, cm[idx, 0] * 255)
+                    drawCross2D(image, x, y, int(8E-3 * diagonal), color=color, thickness=1)
+
+            msg = CvBridge().cv2_to_imgmsg(image, "bgr8")
+
+            msg.header.frame_id = 'c' + collection_key + '_' + sensor['parent']
+            graphics['collections'][collection_key][sensor_key]['publisher'].publish(msg)
+
+            # Publish camera info message
+            camera_info_msg = message_converter.convert_dictionary_to_ros_message('sensor_msgs/CameraInfo',
+                                                                                  sensor['camera_info'])
+            camera_info_msg.header.frame_id = msg.header.frame_id
+            graphics['collections'][collection_key][sensor_key]['publisher_camera_info'].publish(
+                camera_info_msg)
+
+        elif sensor['modality'] == 'depth':
+            image = getCvDepthImageFromCollectionSensor(collection_key, sensor_key, dataset, scale=10000.0)
+
+            width = collection['data'][sensor_key]['width']
+            height = collection['data'][sensor_key]['height']
+            diagonal = math.sqrt(width ** 2 + height ** 2)/2
+            # print(width, height)
+
+            for pattern_key, pattern in dataset['calibration_config']['calibration_patterns'].items():
+
+                idxs = collection['labels'][pattern_key][sensor_key]['idxs']
+                idxs_limit_points = collection['labels'][pattern_key][sensor_key]['idxs_limit_points']
+                gui_image = np.zeros((height, width, 3), dtype=np.uint8)
+                max_value = 5
+                gui_image[:, :, 0] = image / max_value * 255
+                gui_image[:, :, 1] = image / max_value * 255
+                gui_image[:, :, 2] = image / max_value * 255
+
+                for idx in idxs:
+                    # convert from linear idx to x_pix and y_pix indices.
+                    y = int(idx / width)
+                    x = int(idx - y * width)
+                    cv2.line(gui_image, (x, y), (x, y), (0, 200, 255), 3)
+                for idx in idxs_limit_points:
+                    # convert from linear idx to x_pix and y_pix indices.
+                    y = int(idx / width)
+                    x = int(idx - y * width)
+                    drawSquare2D(gui_image, x, y, int(8E-3 * diagonal), (255, 0, 200), thickness=1)
+
+                # Draw projected points (as dots)
+                for idx, point in enumerate(snapshot.projections.get((collection_key, pattern_key, sensor_key), [])):
+                    x = int(round(point['x']))
+                    y = int(round(point['y']))
+                    if x < width - 1 and y < height - 1:
+                        cv2.line(gui_image, (x, y), (x, y), (0, 0, 255), 3)
+
+            msg = CvBridge().cv2_to_imgmsg(gui_image, "passthrough")
+
+            msg.header.frame_id = 'c' + collection_key + '_' + sensor['parent']
+            graphics['collections'][collection_key][sensor_key]['publisher'].publish(msg)
+
+            # Publish camera info message
+            camera_info_msg = message_converter.convert_dictionary_to_ros_message('sensor_msgs/CameraInfo',
+                                                                                  sensor['camera_info'])
+            camera_info_msg.header.frame_id = msg.header.frame_id
+            graphics['collections'][collection_key][sensor_key]['publisher_camera_info'].publish(
+                camera_info_msg)
+
+
+# -------------------------------------------------------------------------------
+# --- CLASS
+# -------------------------------------------------------------------------------
+class VisualizationPublisher:
+    """
+    Publishes the ros visualization of the optimization in a background thread, at its own bounded rate, so that
+    visualization does not slow down the optimization. It is given to the optimizer as the visualization function:
+    each call only takes a snapshot of the state of the optimization (see takeVisualizationSnapshot), and the thread
+    publishes the latest snapshot at each tick, skipping those which were replaced in the meantime. Images are
+    published in turns, at most images_per_tick at each tick.
+    """
+
+    def __init__(self, rate=10, images_per_tick=4):
+        """
+        :param rate: maximum number of publications per second.
+        :param images_per_tick: maximum number of images drawn and published at each tick. All if None or 0.
+        """
+        self.rate = rate
+        self.images_per_tick = images_per_tick
+        self.lock = threading.Lock()
+        self.models = None
+        self.snapshot = None  # the latest snapshot, not yet published
+        self.image_keys = []
+        self.image_idx = 0  # the next image to publish
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __call__(self, models):
+        snapshot = takeVisualizationSnapshot(models)
+        with self.lock:
+            self.snapshot = snapshot
+
+        if self.thread is None:  # the first call starts the thread
+            self.models = models
+            if models['args']['show_images']:
+                self.image_keys = getImageKeys(models['dataset'])
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def getNextImageKeys(self):
+        """ Gets the images to publish in this tick, continuing from where the previous tick stopped. """
+        if not self.images_per_tick or self.images_per_tick >= len(self.image_keys):
+            return self.image_keys
+
+        image_keys = [self.image_keys[(self.image_idx + idx) % len(self.image_keys)]
+                      for idx in range(self.images_per_tick)]
+        self.image_idx = (self.image_idx + self.images_per_tick) % len(self.image_keys)
+        return image_keys
+
+    def publish(self, image_keys=None):
+        """ Publishes the latest snapshot, if there is one which was not published yet. """
+        with self.lock:
+            snapshot, self.snapshot = self.snapshot, None
+
+        if snapshot is not None:
+            image_keys = self.getNextImageKeys() if image_keys is None else image_keys
+            publishVisualization(self.models['dataset'], self.models['args'], self.models['graphics'], snapshot,
+                                 image_keys, throttle=False)  # the rate of the thread bounds the publications
+
+    def run(self):
+        rate = rospy.Rate(self.rate)
+        while not self.stopped.is_set() and not rospy.is_shutdown():
+            self.publish()
+            try:
+                rate.sleep()
+            except rospy.ROSInterruptException:
+                break
+
+    def stop(self):
+        """ Stops the thread, and publishes the latest snapshot, with all the images. """
+        if self.thread is None:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.publish(image_keys=self.image_keys)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Standard imports
+import copy
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# 3rd-party imports
+from colorama import Fore, Style
+
+# Atom imports
+from atom_core.dataset_io import (appendCollectionToJournal, createDataFile, filterJSONData, getJournalFragmentTexts,
+                                  joinJSONTexts, journal_suffix, NpEncoder, removeCollectionFromJournal,
+                                  writeFileAtomically)
+
+
+class CollectionWriter:
+    """
+    Writes the collections of a dataset being collected to the dataset folder, in the background. The dataset is kept
+    as a journal (see atom_core.dataset_io.appendCollectionToJournal): each collection is written only once, when it
+    is added, as an immutable fragment, and a line is appended to the journal file. The data files of the collection
+    are encoded and written by a pool of workers.
+
+    The json texts of the collections are kept, so the json of the dataset is assembled without encoding them again.
+    It is written to the dataset.json file every compaction_period changes, and when the writer is closed. If
+    collect_data is killed in between, loadResultsJSON loads the journal in place of the missing or outdated
+    dataset.json.
+
+    Jobs (adding or removing collections) run in order in a single writer thread, so the caller returns as soon as the
+    job is submitted. Jobs receive snapshots of the dataset taken when they are submitted, and the writer has its own
+    copy of the dataset, so the dictionaries of the caller are never read or changed by the writer thread.
+    """
+
+    def __init__(self, output_folder, number_of_workers=4, compaction_period=10):
+        self.output_folder = output_folder
+        self.output_file = output_folder + '/dataset.json'
+        self.journal_file = output_folder + '/dataset' + journal_suffix
+        self.compaction_period = compaction_period  # number of changes between writes of the dataset.json file
+        self.writer = ThreadPoolExecutor(max_workers=1)  # runs the jobs in order
+        self.workers = ThreadPoolExecutor(max_workers=number_of_workers)  # encode and write the data files
+
+        # The state of the writer, only used in the writer thread
+        self.dataset = None  # fields other than collections, and the transforms_initial of the patterns
+        self.collection_texts = {}  # key=collection key value=json text of the collection
+        self.dataset_text = None  # json text of the dataset, None if it must be assembled again
+        self.number_of_changes = 0
+
+    def addCollection(self, dataset, collection_key, prepare_function=None):
+        """ Writes a new collection of the dataset in the background.
+
+        :param dataset: the dataset. Only the new collection and the fields other than the collections are accessed,
+        and they are copied before this function returns. The messages in the collection are not copied, so they
+        must not be changed afterwards (ros messages are replaced, not changed, when new ones arrive).
+        :param collection_key: the key of the new collection
+        :param prepare_function: a function (dataset, collection_key) called in the writer thread before writing the
+        collection, e.g. to convert the messages of the collection or to estimate the pattern poses. It receives the
+        writer's copy of the dataset, with only the new collection.
+        :return: the future of the job
+        """
+        # The fields of the collection are replaced (not changed) by the writer thread, so a copy of each is enough
+        collection = {key: copy.copy(item) for key, item in dataset['collections'][collection_key].items()}
+        return self.submit(self.writeCollection, self.snapshotFields(dataset), collection_key, collection,
+                           prepare_function)
+
+    def removeCollection(self, dataset, collection_key):
+        """ Removes a collection from the journal in the background. The data files are kept. """
+        return self.submit(self.deleteCollection, self.snapshotFields(dataset), collection_key)
+
+    def snapshotFields(self, dataset):
+        """ Copies the fields of the dataset other than the collections, which are small. """
+        return copy.deepcopy({key: item for key, item in dataset.items() if key != 'collections'})
+
+    def submit(self, function, *args):
+        future = self.writer.submit(function, *args)
+        future.add_done_callback(self.reportError)
+        return future
+
+    def reportError(self, future):
+        if future.exception() is not None:
+            print(Fore.RED + 'Error writing the dataset: ' + str(future.exception()) + Style.RESET_ALL)
+
+    def wait(self):
+        """ Blocks until all the submitted jobs are done. """
+        self.writer.submit(lambda: None).result()
+
+    def getDatasetJSON(self):
+        """ Returns the json of the dataset written so far. It is assembled from the texts of the collections only
+        when the dataset changed since the last call. """
+        text = self.writer.submit(self.getDatasetText).result()
+        if text is None:
+            raise ValueError('No collections saved yet.')
+        return text
+
+    def close(self):
+        """ Waits for the submitted jobs and writes the dataset.json file. """
+        self.writer.submit(self.writeDatasetFile).result()
+        self.writer.shutdown(wait=True)
+        self.workers.shutdown(wait=True)
+
+    # -----------------------------------------------
+    # Functions which run in the writer thread
+    # -----------------------------------------------
+    def updateFields(self, fields):
+        """ Updates the writer's copy of the dataset with a snapshot of the fields, keeping the transforms_initial of
+        the patterns of the collections written so far. """
+        if self.dataset is not None:
+            for pattern_key, pattern in fields.get('patterns', {}).items():
+                if pattern_key in self.dataset['patterns']:
+                    pattern['transforms_initial'] = self.dataset['patterns'][pattern_key]['transforms_initial']
+        self.dataset = fields
+        self.dataset['collections'] = {}
+
+    def writeCollection(self, fields, collection_key, collection, prepare_function):
+        self.updateFields(fields)
+        self.dataset['collections'][collection_key] = collection
+
+        if prepare_function is not None:
+            prepare_function(self.dataset, collection_key)
+
+        futures = []
+        for sensor_key, sensor in self.dataset['sensors'].items():
+            futures.append(createDataFile(self.dataset, collection_key, sensor, sensor_key, self.output_folder,
+                                          executor=self.workers))
+
+        for future in futures:  # raise the errors of the writes, if any
+            if future is not None:
+                future.result()
+
+        texts = getJournalFragmentTexts(self.dataset, collection_key)
+        appendCollectionToJournal(self.journal_file, self.dataset, collection_key, texts=texts)
+        self.collection_texts[collection_key] = texts['collection']
+        self.dataset['collections'] = {}  # the collection is kept only as text
+        print('Saved collection ' + str(collection_key) + ' to ' + str(self.journal_file) + '.')
+        self.addChange()
+
+    def deleteCollection(self, fields, collection_key):
+        self.updateFields(fields)
+        removeCollectionFromJournal(self.journal_file, collection_key)
+        self.collection_texts.pop(str(collection_key), None)
+        for pattern in self.dataset.get('patterns', {}).values():
+            pattern.get('transforms_initial', {}).pop(str(collection_key), None)
+        self.addChange()
+
+    def addChange(self):
+        self.dataset_text = None
+        self.number_of_changes += 1
+        if self.number_of_changes % self.compaction_period == 0:
+            self.writeDatasetFile()
+
+    def getDatasetText(self):
+        if self.dataset is None:
+            return None
+
+        if self.dataset_text is None:
+            texts = {key: json.dumps(item, indent=2, sort_keys=True, cls=NpEncoder)
+                     for key, item in filterJSONData(self.dataset).items() if key != 'collections'}
+            texts['collections'] = joinJSONTexts(self.collection_texts)
+            self.dataset_text = joinJSONTexts(texts)
+        return self.dataset_text
+
+    def writeDatasetFile(self):
+        """ Writes the dataset.json file, the same as saveAtomDataset would. """
+        text = self.getDatasetText()
+        if text is not None:
+            writeFileAtomically(self.output_file, text)
+            print('Saved json output file to ' + str(self.output_file) + '.')
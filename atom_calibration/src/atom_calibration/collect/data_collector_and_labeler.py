@@ -33,8 +33,9 @@ from atom_core.ros_utils import printRosTime, getMaxTimeDelta, getMaxTime, getAv
 from atom_core.config_io import loadConfig
 from atom_core.system import execute, resolvePath
 from atom_core.xacro_io import readXacroFile
-from atom_calibration.collect.interactive_data_labeler import InteractiveDataLabeler
+from atom_calibration.collect.interactive_data_labeler import InteractiveDataLabeler, LabelingStatistics
 from atom_calibration.collect.configurable_tf_listener import ConfigurableTransformListener
+from atom_calibration.collect.collection_writer import CollectionWriter
 from sensor_msgs.msg import JointState
 
 
@@ -94,6 +95,8 @@ class DataCollectorAndLabeler:
         self.dataset_version = "3.0"  # included joint calibration
         self.collect_ground_truth = None
         self.joint_state_position_dict = {}
+        self.collection_writer = CollectionWriter(self.output_folder)  # writes the collections in the background
+        rospy.on_shutdown(self.collection_writer.close)  # write the final dataset.json file
 
         # print(args['calibration_file'])
         self.config = loadConfig(args['calibration_file'])
@@ -220,7 +223,8 @@ class DataCollectorAndLabeler:
                     args['marker_size'],
                     pattern,
                     color=tuple(self.cm_sensors[sensor_idx, :]),
-                    label_data=label_data[sensor_key])
+                    label_data=label_data[sensor_key],
+                    detection_max_size=args['detection_max_size'])
 
                 sensor_idx += 1
             self.sensor_labelers[pattern_key] = sensor_labeler
@@ -302,10 +306,7 @@ class DataCollectorAndLabeler:
             response.message = 'Collection ' + request.collection_name + ' deleted'
 
             # Save new dataset to json file
-            D = {'sensors': self.sensors, 'additional_sensor_data': self.additional_data,
-                 'collections': self.collections, 'calibration_config': self.config}
-            output_file = self.output_folder + '/dataset.json'
-            atom_core.dataset_io.saveAtomDataset(output_file, D)
+            self.collection_writer.removeCollection(self.getDataset(), collection_name_int)
 
             print(Fore.YELLOW + 'Deleted collection ' + request.collection_name + Style.RESET_ALL)
         else:
@@ -332,10 +333,8 @@ class DataCollectorAndLabeler:
     def callbackGetDataset(self, request):
         print('callbackGetDataset service called')
 
-        dataset_file = self.output_folder + '/dataset.json'
         try:
-            file = open(dataset_file, 'r')
-            dataset_stream = file.read()
+            dataset_stream = self.collection_writer.getDatasetJSON()
             success = True
         except:
             dataset_stream = ''
@@ -378,6 +377,33 @@ class DataCollectorAndLabeler:
                 self.sensor_labelers[pattern_key][sensor_name].lock.release()
         print("Unlocked all labelers ")
 
+    def getLabelingStatistics(self):
+        """ Gets the labeling statistics of all the labelers of each modality.
+
+        :return: a dictionary with key=modality value=LabelingStatistics
+        """
+        statistics = {}
+        for sensor_name, sensor in self.sensors.items():
+            for pattern_key in self.config['calibration_patterns'].keys():
+                labeler = self.sensor_labelers[pattern_key][sensor_name]
+                statistics.setdefault(sensor['modality'], LabelingStatistics()).add(labeler.statistics)
+        return statistics
+
+    def printLabelingStatistics(self):
+        print('Labeling statistics:')
+        for modality, statistics in self.getLabelingStatistics().items():
+            if statistics.labeled > 0:
+                times = ', average duration ' + '%.3f' % statistics.averageDuration() + ' secs, average latency ' + \
+                        '%.3f' % statistics.averageLatency() + ' secs (max ' + '%.3f' % statistics.max_latency + ' secs)'
+            else:
+                times = ''
+            print(Fore.BLUE + modality + Style.RESET_ALL + ': ' + str(statistics.received) + ' received, ' +
+                  str(statistics.labeled) + ' labeled, ' + str(statistics.dropped) + ' dropped' + times + '.')
+            if statistics.detections > 0:
+                print('    average pattern detection stage durations: ' +
+                      ', '.join([stage + ' %.3f secs' % duration
+                                 for stage, duration in statistics.averageStageDurations().items()]))
+
     def getLabelersTimeStatistics(self):
         stamps = []  # a list of the several time stamps of the stored messages
         for sensor_name, sensor in self.sensors.items():
@@ -417,6 +443,42 @@ class DataCollectorAndLabeler:
             else:  # test passed
                 rospy.loginfo('Max duration between msgs in collection is ' + str(max_delta.to_sec()))
 
+        all_sensor_labels_dict = {}
+        all_sensor_msgs = {}
+        all_additional_msgs = {}
+        # metadata={}
+
+        for pattern_key in self.config['calibration_patterns'].keys():
+            all_sensor_labels_dict[pattern_key] = {}
+            for sensor_key, sensor in self.sensors.items():
+                print('Collecting data from ' + Fore.BLUE + pattern_key +
+                      '_' + sensor_key + Style.RESET_ALL + ': sensor_key')
+
+                # Labelers replace (not change) the values of the labels, so a shallow copy is a snapshot
+                labels = copy.copy(self.sensor_labelers[pattern_key][sensor_key].labels)
+
+                # Update sensor labels ---------------------------------------------
+                # if sensor['msg_type'] in ['Image', 'LaserScan', 'PointCloud2']:
+                #     all_sensor_labels_dict[sensor_key] = labels
+                if sensor['modality'] in ['rgb', 'lidar2d', 'depth', 'lidar3d']:
+                    all_sensor_labels_dict[pattern_key][sensor_key] = labels
+                else:
+                    raise ValueError('Unknown message type.')
+
+        # Labelers replace (not change) their messages when new ones arrive, so the messages are kept as they are, and
+        # converted to dictionaries in the background
+        for sensor_key, sensor in self.sensors.items():
+            # Since the message should be the same for each pattern, save for the last pattern
+            all_sensor_msgs[sensor['_name']] = self.sensor_labelers[pattern_key][sensor_key].msg
+
+        for description, sensor in self.additional_data.items():
+            # Since the message should be the same for each pattern, save for the last pattern
+            all_additional_msgs[sensor['_name']] = self.sensor_labelers[pattern_key][description].msg
+
+        # The messages and labels are snapshotted, so the labelers may continue
+        self.unlockAllLabelers()
+        self.printLabelingStatistics()
+
         # collect all the transforms
         print('average_time=' + str(average_time))
         transforms = self.getTransforms(self.abstract_transforms,
@@ -487,65 +549,44 @@ class DataCollectorAndLabeler:
 
         # joint_state_dict = message_converter.convert_ros_message_to_dictionary(self.last_joint_state_msg)
 
-        all_sensor_data_dict = {}
-        all_sensor_labels_dict = {}
-        all_additional_data_dict = {}
-        # metadata={}
-
-        for pattern_key in self.config['calibration_patterns'].keys():
-            all_sensor_labels_dict[pattern_key] = {}
-            for sensor_key, sensor in self.sensors.items():
-                print('Collecting data from ' + Fore.BLUE + pattern_key +
-                      '_' + sensor_key + Style.RESET_ALL + ': sensor_key')
-
-                labels = copy.deepcopy(self.sensor_labelers[pattern_key][sensor_key].labels)
-
-                # Update sensor labels ---------------------------------------------
-                # if sensor['msg_type'] in ['Image', 'LaserScan', 'PointCloud2']:
-                #     all_sensor_labels_dict[sensor_key] = labels
-                if sensor['modality'] in ['rgb', 'lidar2d', 'depth', 'lidar3d']:
-                    all_sensor_labels_dict[pattern_key][sensor_key] = labels
-                else:
-                    raise ValueError('Unknown message type.')
-
-        for sensor_key, sensor in self.sensors.items():
-            # Update the data dictionary for this data stamp
-            # Since the message should be the same for each pattern, save for the last pattern
-            msg = copy.deepcopy(self.sensor_labelers[pattern_key][sensor_key].msg)
-            all_sensor_data_dict[sensor['_name']] = message_converter.convert_ros_message_to_dictionary(msg)
-
-        for description, sensor in self.additional_data.items():
-            # Since the message should be the same for each pattern, save for the last pattern
-            msg = copy.deepcopy(self.sensor_labelers[pattern_key][description].msg)
-            all_additional_data_dict[sensor['_name']] = message_converter.convert_ros_message_to_dictionary(msg)
-
-        collection_dict = {'data': all_sensor_data_dict, 'labels': all_sensor_labels_dict,
+        collection_dict = {'data': all_sensor_msgs, 'labels': all_sensor_labels_dict,
                            'transforms': transforms,
-                           'additional_data': all_additional_data_dict, 'joints': joints_dict}
+                           'additional_data': all_additional_msgs, 'joints': joints_dict}
         if self.collect_ground_truth:
             collection_dict['transforms_ground_truth'] = transforms_ground_truth
 
         collection_key = str(self.data_stamp).zfill(3)  # collection names are 000, 001, etc
         self.collections[collection_key] = collection_dict
+        self.data_stamp += 1
 
-        # Update pattern dict with transform_initial of this collection
-        dataset = {'_metadata': self.metadata,
-                   'calibration_config': self.config,
-                   'collections': self.collections,
-                   'additional_sensor_data': self.additional_data,
-                   'sensors': self.sensors,
-                   'patterns': self.patterns_dict}
+        # Convert the messages, estimate the pattern poses and save to json file in the background. The writer copies
+        # the collection, so the messages are dropped from ours to free their memory once they are written.
+        self.collection_writer.addCollection(self.getDataset(), collection_key, self.prepareCollection)
+        self.collections[collection_key] = {key: item for key, item in collection_dict.items()
+                                            if key not in ['data', 'additional_data']}
+
+    def prepareCollection(self, dataset, collection_key):
+        """ Converts the messages of a collection to dictionaries, using the workers of the collection writer, and
+        updates the pattern dict with the transforms_initial of the collection. Runs in the writer thread, with the
+        writer's copy of the dataset. """
+        collection = dataset['collections'][collection_key]
+        workers = self.collection_writer.workers
+        for field in ['data', 'additional_data']:
+            futures = {name: workers.submit(message_converter.convert_ros_message_to_dictionary, msg)
+                       for name, msg in collection[field].items()}
+            collection[field] = {name: future.result() for name, future in futures.items()}
 
         print('Estimating pattern poses for collection ...', end='')
         estimatePatternPosesForCollection(dataset, collection_key)
         atomPrintOK()
 
-        self.data_stamp += 1
-
-        # Save to json file.
-        output_file = self.output_folder + '/dataset.json'
-        atom_core.dataset_io.saveAtomDataset(output_file, dataset)
-        self.unlockAllLabelers()
+    def getDataset(self):
+        return {'_metadata': self.metadata,
+                'calibration_config': self.config,
+                'collections': self.collections,
+                'additional_sensor_data': self.additional_data,
+                'sensors': self.sensors,
+                'patterns': self.patterns_dict}
 
     def getAllAbstractTransforms(self):
 
@@ -4,7 +4,9 @@
 # stdlib
 import math
 import threading
+import traceback
 
+import atom_core.ros_numpy
 import atom_core.ros_utils
 
 # 3rd-party
@@ -17,12 +19,11 @@ import image_geometry
 import atom_core.utilities
 from cv_bridge import CvBridge
 from matplotlib import cm
-from sensor_msgs import point_cloud2
 from std_msgs.msg import Header
 from visualization_msgs.msg import Marker, InteractiveMarker, InteractiveMarkerControl
 from rospy_message_converter import message_converter
 from sensor_msgs.msg import *
-from sensor_msgs.msg import PointField, CameraInfo, Image
+from sensor_msgs.msg import PointField, CameraInfo, Image, PointCloud2
 from interactive_markers.interactive_marker_server import InteractiveMarkerServer
 from geometry_msgs.msg import PointStamped
 
@@ -39,6 +40,9 @@ FIELDS_XYZ = [
 FIELDS_XYZRGB = FIELDS_XYZ + \
     [PointField(name='rgb', offset=12, datatype=PointField.UINT32, count=1)]
 
+# The data structure of each point in the labeling point clouds: x + y + z + rgba
+CLOUD_DTYPE_XYZRGBA = np.dtype([('x', np.float32), ('y', np.float32), ('z', np.float32), ('rgba', np.uint32)])
+
 # Bit operations
 BIT_MOVE_16 = 2 ** 16
 BIT_MOVE_8 = 2 ** 8
@@ -65,6 +69,48 @@ def createRosCloud(points, stamp, frame_id, colours=None):
     return pc2.create_cloud(header, fields, cloud_data)
 
 
+def createColoredCloudMsg(points, colors, stamp, frame_id):
+    """
+    Creates a ros PointCloud2 message with colored points from a numpy structured array, without packing each point.
+    :param points: an array (n x 2) or (n x 3) with the coordinates of the points. If 2D, z is zero.
+    :param colors: an array (n x 4) with the r, g, b, a values (0-255) of each point, or a single (r, g, b, a) color
+    :param stamp: the stamp of the message
+    :param frame_id: the frame id of the message
+    """
+    if len(points) == 0:  # e.g. when nothing was labeled
+        points = np.zeros((0, 3))
+    points = np.asarray(points).reshape((-1, np.shape(points)[-1]))
+    cloud_arr = np.zeros(len(points), dtype=CLOUD_DTYPE_XYZRGBA)
+    for idx, axis in enumerate(['x', 'y', 'z'][:points.shape[1]]):
+        cloud_arr[axis] = points[:, idx]
+
+    colors = np.broadcast_to(np.asarray(colors, dtype=np.uint32), (len(points), 4))
+    cloud_arr['rgba'] = (colors[:, 3] << 24) | (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+    return atom_core.ros_numpy.msgify(PointCloud2, cloud_arr, stamp=stamp, frame_id=frame_id)
+
+
+def clusterLaserScan(xs, ys, ranges, minimum_range_value, threshold):
+    """
+    Clusters the points of a 2D laser scan. Consecutive points belong to the same cluster, unless the distance between
+    them is larger than the threshold. Points with a range (or with the previous range) smaller than the
+    minimum_range_value are discarded.
+    :param xs: array with the x coordinates of the scan points
+    :param ys: array with the y coordinates of the scan points
+    :param ranges: the ranges of the scan
+    :param minimum_range_value: distance to assume a range value is valid
+    :param threshold: point to point distance to create a new cluster
+    :return: an array with the idxs of the valid points, and an array with the cluster of each of them (0, 1, ...)
+    """
+    ranges = np.asarray(ranges)
+    invalid = ranges < minimum_range_value
+    idxs = np.flatnonzero(~(invalid | np.roll(invalid, 1)))
+
+    distances = np.hypot(np.diff(xs[idxs]), np.diff(ys[idxs]))
+    cluster_labels = np.zeros(len(idxs), dtype=int)
+    cluster_labels[1:] = np.cumsum(distances > threshold)
+    return idxs, cluster_labels
+
+
 # ------------------------
 #      BASE CLASSES      #
 # ------------------------
@@ -72,20 +118,55 @@ def createRosCloud(points, stamp, frame_id, colours=None):
 # return Fore.GREEN + self.parent + Style.RESET_ALL + ' to ' + Fore.GREEN + self.child + Style.RESET_ALL + ' (' +
 # self.joint_type + ')'
 
-class LaserScanCluster:
+class LabelingStatistics:
     """
-    An auxiliary class for storing information about 2D laser clusters
+    Statistics of the labeling of the messages of a sensor: how many messages were received, labeled and dropped
+    (replaced by a newer message before being labeled), the labeling duration, and the latency, i.e. the age of a
+    message when its labels are ready.
     """
 
-    def __init__(self, cluster_count, idx):
-        self.cluster_count = cluster_count
-        self.idxs = [idx]
-
-    def pushIdx(self, idx):
-        self.idxs.append(idx)
-
-    def __str__(self):
-        return "Cluster " + str(self.cluster_count) + " contains idxs = " + str(self.idxs)
+    def __init__(self):
+        self.received = 0
+        self.labeled = 0
+        self.dropped = 0
+        self.total_duration = 0.0  # [secs]
+        self.total_latency = 0.0  # [secs]
+        self.max_latency = 0.0  # [secs]
+        self.detections = 0  # number of pattern detections run, for rgb sensors
+        self.total_stage_durations = {}  # key=detection stage value=total duration [secs]
+
+    def addLabeling(self, duration, latency):
+        self.labeled += 1
+        self.total_duration += duration
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def addDetectionTimings(self, timings):
+        """ Adds the duration of each stage of a pattern detection, see the timings of ChessboardPattern. """
+        self.detections += 1
+        for stage, duration in timings.items():
+            self.total_stage_durations[stage] = self.total_stage_durations.get(stage, 0.0) + duration
+
+    def add(self, other):
+        """ Adds the statistics of another labeler, e.g. to get the statistics of all labelers of a modality. """
+        self.received += other.received
+        self.labeled += other.labeled
+        self.dropped += other.dropped
+        self.total_duration += other.total_duration
+        self.total_latency += other.total_latency
+        self.max_latency = max(self.max_latency, other.max_latency)
+        self.detections += other.detections
+        for stage, duration in other.total_stage_durations.items():
+            self.total_stage_durations[stage] = self.total_stage_durations.get(stage, 0.0) + duration
+
+    def averageDuration(self):
+        return self.total_duration / self.labeled if self.labeled > 0 else None
+
+    def averageLatency(self):
+        return self.total_latency / self.labeled if self.labeled > 0 else None
+
+    def averageStageDurations(self):
+        return {stage: duration / self.detections for stage, duration in self.total_stage_durations.items()}
 
 
 class InteractiveDataLabeler:
@@ -100,9 +181,14 @@ class InteractiveDataLabeler:
                 calibration pattern and the pattern is tracked from that seed point using a propagation mask. The
                 pattern is tracked automatically from there onward by assuming that the centroid of the calibration
                 pattern's shape is the seed point in  the next frame.
+
+    Messages are labeled by a worker thread, not in the subscriber callback. The callback only keeps the newest
+    message, replacing (dropping) the one waiting to be labeled if the labeling cannot keep up, so that labels are
+    always computed for a recent message instead of lagging behind.
     """
 
-    def __init__(self, server, menu_handler, sensor_dict, marker_scale, calib_pattern, color, label_data=True):
+    def __init__(self, server, menu_handler, sensor_dict, marker_scale, calib_pattern, color, label_data=True,
+                 detection_max_size=None):
         """
         Class constructor. Initializes several variables and ros stuff.
         :param server: an interactive marker server
@@ -112,6 +198,7 @@ class InteractiveDataLabeler:
         :param chess_numx: chessboard size in x
         :param chess_numy: chessboard size in y
         :param color: tuple with the values of the three color channels (0-1)
+        :param detection_max_size: if given, images are downscaled to at most this size for the pattern detection
         """
         print('Creating an InteractiveDataLabeler for sensor ' + str(sensor_dict['_name']))
 
@@ -129,14 +216,19 @@ class InteractiveDataLabeler:
         self.tic_manual_seed = rospy.Time.now()
         # self.server = server
         self.server = InteractiveMarkerServer(self.name + "/data_labeler")
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # held while the message and labels are changed
+        self.new_msg_condition = threading.Condition()  # to notify the worker of a new message
+        self.new_msg = None  # the newest message, waiting to be labeled
+        self.statistics = LabelingStatistics()
 
         # self.calib_pattern = calib_pattern
         if calib_pattern['pattern_type'] == 'chessboard':
-            self.pattern = patterns.ChessboardPattern(calib_pattern['dimension'], calib_pattern['size'])
+            self.pattern = patterns.ChessboardPattern(calib_pattern['dimension'], calib_pattern['size'],
+                                                      detection_max_size=detection_max_size)
         elif calib_pattern['pattern_type'] == 'charuco':
             self.pattern = patterns.CharucoPattern(calib_pattern['dimension'], calib_pattern['size'],
-                                                   calib_pattern['inner_size'], calib_pattern['dictionary'])
+                                                   calib_pattern['inner_size'], calib_pattern['dictionary'],
+                                                   detection_max_size=detection_max_size)
             print(calib_pattern['dictionary'])
         else:
             print("Unknown pattern type '{}'".format(calib_pattern['pattern_type']))
@@ -230,6 +322,10 @@ class InteractiveDataLabeler:
         # https://github.com/lmb-freiburg/rgbd-pose3d/issues/5
         # TODO figure out which is the adequate size, this was trial and error
         # self.subscriber = rospy.Subscriber(self.topic, self.msg_type, self.sensorDataReceivedCallback, queue_size=1, buff_size=10000000000)
+        if self.label_data:
+            self.worker = threading.Thread(target=self.labelingWorker, daemon=True)
+            self.worker.start()
+
         self.subscriber = rospy.Subscriber(self.topic, self.msg_type, self.sensorDataReceivedCallback, queue_size=1,
                                            buff_size=10000000000)
         # self.subscriber = rospy.Subscriber(self.topic, self.msg_type, self.sensorDataReceivedCallback, queue_size=1)
@@ -241,27 +337,43 @@ class InteractiveDataLabeler:
         # print('Setting new seed point for sensor ' + self.name + ' to ' + str(self.seed))
 
     def sensorDataReceivedCallback(self, msg):
-        # rospy.loginfo(self.name + ' (Before lock) received msg which is ' + str((rospy.Time.now() - msg.header.stamp).to_sec()) + ' secs.')
-
-        stamp_before_lock = rospy.Time.now()
-        self.lock.acquire()  # use semaphores to make sure the data is not being written on two sides simultaneously
-
-        # print(self.name + ' lock acquired')
-
-        # self.lock.acquire(blocking=False)  # use semaphores to make sure the data is not being written on two sides simultaneously
-        self.msg = msg  # make a local copy of sensor data
-        now = rospy.Time.now()
-
-        # time.sleep(5)
-
-        # print(self.name + ' label data is ' + str(self.label_data))
-        if self.label_data:
-            # print(self.name + ' calling label data')
-            self.labelData()  # label the data
-            # print('labeling data for ' + self.name + ' took ' + str((rospy.Time.now() - now).to_sec()) + ' secs.')
+        # rospy.loginfo(self.name + ' received msg which is ' + str((rospy.Time.now() - msg.header.stamp).to_sec()) + ' secs.')
+        if not self.label_data:  # nothing to label, just keep the message
+            with self.lock:
+                self.msg = msg
+                self.statistics.received += 1
+            return
+
+        # Keep only the newest message. If the worker did not label the previous one yet, it is dropped.
+        with self.new_msg_condition:
+            self.statistics.received += 1
+            if self.new_msg is not None:
+                self.statistics.dropped += 1
+            self.new_msg = msg
+            self.new_msg_condition.notify()
+
+    def labelingWorker(self):
+        """ Labels the newest message received, waiting for one if there is none. Runs in a thread of its own. """
+        while not rospy.is_shutdown():
+            with self.new_msg_condition:
+                if self.new_msg is None:
+                    self.new_msg_condition.wait(timeout=0.1)  # with a timeout, to check for shutdown
+                    continue
+                msg, self.new_msg = self.new_msg, None
+
+            stamp_before_labeling = rospy.Time.now()
+            with self.lock:  # use semaphores to make sure the data is not being written on two sides simultaneously
+                self.msg = msg  # make a local copy of sensor data
+                try:
+                    self.labelData()  # label the data
+                except Exception:  # log the error and keep labeling the next messages
+                    rospy.logerr('Error labeling data for sensor ' + self.name + ':\n' + traceback.format_exc())
+                    continue
 
-        self.lock.release()  # release lock
-        # rospy.loginfo('(With Lock) labeling data for ' + self.name + ' took ' + str((rospy.Time.now() - stamp_before_lock).to_sec()) + ' secs.')
+            now = rospy.Time.now()
+            self.statistics.addLabeling(duration=(now - stamp_before_labeling).to_sec(),
+                                        latency=(now - msg.header.stamp).to_sec())
+            # rospy.loginfo('labeling data for ' + self.name + ' took ' + str((now - stamp_before_labeling).to_sec()) + ' secs.')
 
     def labelData(self):
         # print('labeling data for sensor ' + self.name)
@@ -275,55 +387,23 @@ class InteractiveDataLabeler:
             # associate one of the clusters with the calibration pattern by selecting the cluster which is closest to
             # the rviz interactive marker.
 
-            clusters = []  # initialize cluster list to empty
-            cluster_counter = 0  # init counter
-            points = []  # init points
-
             # Compute cartesian coordinates
             xs, ys = atom_core.utilities.laser_scan_msg_to_xy(self.msg)
 
-            # Clustering:
-            first_iteration = True
-            for idx, r in enumerate(self.msg.ranges):
-                # Skip if either this point or the previous have range smaller than minimum_range_value
-                if r < self.minimum_range_value or self.msg.ranges[idx - 1] < self.minimum_range_value:
-                    continue
+            # Clustering: the scan is split where the distance between consecutive points is larger than threshold
+            idxs, cluster_labels = clusterLaserScan(xs, ys, self.msg.ranges, self.minimum_range_value, self.threshold)
+            if len(idxs) == 0:  # no valid ranges in this scan
+                return
 
-                if first_iteration:  # if first iteration, create a new cluster
-                    clusters.append(LaserScanCluster(cluster_counter, idx))
-                    first_iteration = False
-                else:  # check if new point belongs to current cluster, create new cluster if not
-                    x = xs[clusters[-1].idxs[-1]]  # x coordinate of last point of last cluster
-                    y = ys[clusters[-1].idxs[-1]]  # y coordinate of last point of last cluster
-                    distance = math.sqrt((xs[idx] - x) ** 2 + (ys[idx] - y) ** 2)
-                    if distance > self.threshold:  # if distance larger than threshold, create new cluster
-                        cluster_counter += 1
-                        clusters.append(LaserScanCluster(cluster_counter, idx))
-                    else:  # same cluster, push this point into the same cluster
-                        clusters[-1].pushIdx(idx)
-
-            # Association stage: find out which cluster is closer to the marker
+            # Association stage: find out which cluster is closer to the marker, i.e., contains the closest point
             x_marker, y_marker = self.marker.pose.position.x, self.marker.pose.position.y  # interactive marker pose
-            idx_closest_cluster = 0
-            min_dist = sys.maxint
-            for cluster_idx, cluster in enumerate(clusters):  # cycle all clusters
-                for idx in cluster.idxs:  # cycle each point in the cluster
-                    x, y = xs[idx], ys[idx]
-                    dist = math.sqrt((x_marker - x) ** 2 + (y_marker - y) ** 2)
-                    if dist < min_dist:
-                        idx_closest_cluster = cluster_idx
-                        min_dist = dist
-
-            closest_cluster = clusters[idx_closest_cluster]
+            distances = np.hypot(xs[idxs] - x_marker, ys[idxs] - y_marker)
+            distances[np.isnan(distances)] = np.inf
+            closest_idxs = idxs[cluster_labels == cluster_labels[np.argmin(distances)]]
 
             # Find the coordinate of the middle point in the closest cluster and bring the marker to that point
-            x_sum, y_sum = 0, 0
-            for idx in closest_cluster.idxs:
-                x_sum += xs[idx]
-                y_sum += ys[idx]
-
-            self.marker.pose.position.x = x_sum / float(len(closest_cluster.idxs))
-            self.marker.pose.position.y = y_sum / float(len(closest_cluster.idxs))
+            self.marker.pose.position.x = float(np.mean(xs[closest_idxs]))
+            self.marker.pose.position.y = float(np.mean(ys[closest_idxs]))
             self.marker.pose.position.z = 0
             self.menu_handler.reApply(self.server)
             self.server.applyChanges()
@@ -332,48 +412,23 @@ class InteractiveDataLabeler:
             self.labels['detected'] = True
 
             percentage_points_to_remove = 0.0  # remove x% of data from each side
-            number_of_idxs = len(clusters[idx_closest_cluster].idxs)
+            number_of_idxs = len(closest_idxs)
             idxs_to_remove = int(percentage_points_to_remove * float(number_of_idxs))
-            clusters[idx_closest_cluster].idxs_filtered = clusters[idx_closest_cluster].idxs[
-                idxs_to_remove:number_of_idxs - idxs_to_remove]
+            selected_idxs = closest_idxs[idxs_to_remove:number_of_idxs - idxs_to_remove]
 
-            self.labels['idxs'] = clusters[idx_closest_cluster].idxs_filtered
+            self.labels['idxs'] = selected_idxs.tolist()
 
             # Create and publish point cloud message with the colored clusters (just for debugging)
-            cmap = cm.prism(np.linspace(0, 1, len(clusters)))
-            points = []
-            z, a = 0, 255
-            for cluster in clusters:
-                for idx in cluster.idxs:
-                    x, y = xs[idx], ys[idx]
-                    r, g, b = int(cmap[cluster.cluster_count, 0] * 255.0), \
-                        int(cmap[cluster.cluster_count, 1] * 255.0), \
-                        int(cmap[cluster.cluster_count, 2] * 255.0)
-                    rgb = struct.unpack('I', struct.pack('BBBB', b, g, r, a))[0]
-                    pt = [x, y, z, rgb]
-                    points.append(pt)
-
-            fields = [PointField('x', 0, PointField.FLOAT32, 1), PointField('y', 4, PointField.FLOAT32, 1),
-                      PointField('z', 8, PointField.FLOAT32, 1), PointField('rgba', 12, PointField.UINT32, 1)]
-            header = Header()
-            header.frame_id = self.parent
-            header.stamp = self.msg.header.stamp
-            pc_msg = point_cloud2.create_cloud(header, fields, points)
+            cmap = cm.prism(np.linspace(0, 1, cluster_labels[-1] + 1))
+            colors = (cmap[cluster_labels] * 255.0).astype(np.uint32)
+            colors[:, 3] = 255
+            pc_msg = createColoredCloudMsg(np.column_stack((xs[idxs], ys[idxs])), colors, self.msg.header.stamp,
+                                           self.parent)
             self.publisher_clusters.publish(pc_msg)
 
             # Create and publish point cloud message containing only the selected calibration pattern points
-            points = []
-            for idx in clusters[idx_closest_cluster].idxs_filtered:
-                x_marker, y_marker, z_marker = xs[idx], ys[idx], 0
-                r = int(0 * 255.0)
-                g = int(0 * 255.0)
-                b = int(1 * 255.0)
-                a = 255
-                rgb = struct.unpack('I', struct.pack('BBBB', b, g, r, a))[0]
-                pt = [x_marker, y_marker, z_marker, rgb]
-                points.append(pt)
-
-            pc_msg = point_cloud2.create_cloud(header, fields, points)
+            pc_msg = createColoredCloudMsg(np.column_stack((xs[selected_idxs], ys[selected_idxs])), (0, 0, 255, 255),
+                                           self.msg.header.stamp, self.parent)
             self.publisher_selected_points.publish(pc_msg)
 
         elif self.modality == 'rgb':
@@ -383,6 +438,7 @@ class InteractiveDataLabeler:
             # Convert to opencv image and save image to disk
             image = self.bridge.imgmsg_to_cv2(self.msg, "bgr8")
             result = self.pattern.detect(image, equalize_histogram=False)
+            self.statistics.addDetectionTimings(result['timings'])
 
             if result['detected']:
                 c = []
@@ -425,30 +481,12 @@ class InteractiveDataLabeler:
             # publish the points that belong to the cluster (use idxs to show annotations)
             point_cloud = numpyFromPointCloudMsg(self.msg)
 
-            # Add idxs points
-            r, g, b = int(1 * 255.0), int(1 * 255.0), int(1 * 255.0)
-            a = 200
-            rgb = struct.unpack('I', struct.pack('BBBB', b, g, r, a))[0]
-            points = []
-            for idx in self.labels['idxs']:
-                pt = [point_cloud[idx, 0], point_cloud[idx, 1], point_cloud[idx, 2], rgb]
-                points.append(pt)
-
-            # Add idx_limit_points (darker)
-            r, g, b = int(1 * 25.0), int(1 * 25.0), int(1 * 25.0)
-            a = 150
-            rgb = struct.unpack('I', struct.pack('BBBB', b, g, r, a))[0]
-            for idx in self.labels['idxs_limit_points']:
-                pt = [point_cloud[idx, 0], point_cloud[idx, 1], point_cloud[idx, 2], rgb]
-                points.append(pt)
-
-            fields = [PointField('x', 0, PointField.FLOAT32, 1), PointField('y', 4, PointField.FLOAT32, 1),
-                      PointField('z', 8, PointField.FLOAT32, 1), PointField('rgba', 12, PointField.UINT32, 1)]
-            header = Header()
-            header.frame_id = self.parent
-            header.stamp = self.msg.header.stamp
-            pc_msg = point_cloud2.create_cloud(header, fields, points)
-            # print('Publishing labelled cloud with ' + str(len(points)) + ' points.')
+            # Add idxs points, and idx_limit_points (darker)
+            idxs = self.labels['idxs'] + self.labels['idxs_limit_points']
+            colors = np.repeat([[255, 255, 255, 200], [25, 25, 25, 150]],
+                               [len(self.labels['idxs']), len(self.labels['idxs_limit_points'])], axis=0)
+            pc_msg = createColoredCloudMsg(point_cloud[idxs, :], colors, self.msg.header.stamp, self.parent)
+            # print('Publishing labelled cloud with ' + str(len(idxs)) + ' points.')
             self.publisher_selected_points.publish(pc_msg)
 
             # Update the interactive marker pose
@@ -1,7 +1,6 @@
 # Standard imports
 import copy
 import math
-import random
 
 import numpy as np
 import cv2
@@ -11,12 +10,13 @@ import cv_bridge
 import rospy
 import atom_core.ros_numpy
 from scipy import ndimage, spatial
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
 from std_msgs.msg import Header, ColorRGBA
 from cv_bridge import CvBridge
 from visualization_msgs.msg import Marker, MarkerArray
 from geometry_msgs.msg import Point
 from sensor_msgs.msg import CameraInfo, Image
-from skimage.draw import line
 
 # Atom imports
 
@@ -45,26 +45,9 @@ def denseToSparsePointCloud(dense_pc):
         _type_: _description_
     """
 
-    dense_npoints = dense_pc.shape[0]
-    xs = []
-    ys = []
-    zs = []
-    sparse_idxs = []
-
-    for idx in range(0, dense_npoints):
-        x = dense_pc[idx, 0]
-        y = dense_pc[idx, 1]
-        z = dense_pc[idx, 2]
-
-        if x != 0 and y != 0 and z != 0:
-            xs.append(x)
-            ys.append(y)
-            zs.append(z)
-            sparse_idxs.append(idx)
-
-    sparse_npoints = len(sparse_idxs)
-    sparse_pc = np.array([xs, ys, zs]).transpose()
-    sparse_idxs = np.array(sparse_idxs, dtype=np.uint).transpose()
+    valid = np.logical_and(np.logical_and(dense_pc[:, 0] != 0, dense_pc[:, 1] != 0), dense_pc[:, 2] != 0)
+    sparse_idxs = np.flatnonzero(valid).astype(np.uint)
+    sparse_pc = dense_pc[sparse_idxs, 0:3]
 
     return sparse_pc, sparse_idxs
 
@@ -87,9 +70,89 @@ def numpyFromPointCloudMsg(msg):
     return points
 
 
+def fitPlaneRANSAC(pts, ransac_iterations, ransac_threshold, batch_size=256):
+    """Fits a plane to a set of points with RANSAC. Hypotheses are sampled and scored in batches, i.e., the distances
+    of all points to a batch of planes are computed in a single numpy call.
+
+    Args:
+        pts: Numpy array of shape (npoints, 3)
+        ransac_iterations: number of plane hypotheses
+        ransac_threshold: point to plane distance below which a point is an inlier
+        batch_size: number of hypotheses scored at once, to bound the memory used (batch_size x npoints)
+
+    Returns:
+        The Hessian coefficients (A, B, C, D) of the plane with most inliers, or None if no valid plane was found.
+    """
+    number_points = pts.shape[0]
+    best_plane, best_n_inliers = None, 0
+    for start in range(0, ransac_iterations, batch_size):
+        n = min(batch_size, ransac_iterations - start)
+
+        # Randomly select three points per hypothesis. Coincident or collinear points give a null normal vector,
+        # and those hypotheses are discarded
+        pt1, pt2, pt3 = pts[np.random.randint(0, number_points, size=(3, n)), :]
+
+        # ABC Hessian coefficients and given by the external product between two vectors lying on the plane
+        normals = np.cross(pt2 - pt1, pt3 - pt1)
+        denominators = np.linalg.norm(normals, axis=1)
+        valid = denominators > 0
+        if not np.any(valid):
+            continue
+        normals, denominators, pt1 = normals[valid], denominators[valid], pt1[valid]
+
+        # Hessian parameter D is computed using one point that lies on the plane
+        ds = -np.sum(normals * pt1, axis=1)
+
+        # Compute the distance from all points to all planes, and the number of inliers of each plane hypothesis
+        distances = np.abs(np.dot(normals, pts.transpose()) + ds[:, np.newaxis]) / denominators[:, np.newaxis]
+        n_inliers = np.sum(distances < ransac_threshold, axis=1)
+
+        # Store the best hypothesis if the number of inliers is larger than the previous max
+        best = np.argmax(n_inliers)
+        if n_inliers[best] > best_n_inliers:
+            best_n_inliers = n_inliers[best]
+            best_plane = (normals[best, 0], normals[best, 1], normals[best, 2], ds[best])
+
+    return best_plane
+
+
+def getLimitPointsIdxs(points):
+    """Gets the limit points of a pattern labelled in a LiDAR point cloud. Points are clustered by the theta component
+    of their spherical coordinates (i.e. by LiDAR ring), and the limit points of each cluster are those with minimum
+    and maximum phi values. We use the convention commonly used in physics, i.e:
+    https://en.wikipedia.org/wiki/Spherical_coordinate_system
+
+    Args:
+        points: Numpy array of shape (npoints, 3) with the labelled points
+
+    Returns:
+        The indices (in points) of the limit points, in ascending order.
+    """
+    if points.shape[0] == 0:
+        return np.zeros((0,), dtype=int)
+
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    phis = np.arctan2(y, x)
+    thetas = np.round(np.arctan2(np.sqrt(x ** 2 + y ** 2), z), 4)  # Round to be able to cluster by finding equal
+    # theta values.
+
+    # Cluster points based on theta values
+    _, clusters = np.unique(thetas, return_inverse=True)
+
+    # Sort points by cluster and phi. Sorting is stable, so for equal phis the first point is kept, and the first
+    # point of each cluster in the sorted order is the one with minimum (or maximum) phi.
+    limit = np.zeros(points.shape[0], dtype=bool)
+    for sorted_phis in [phis, -phis]:
+        order = np.lexsort((sorted_phis, clusters))
+        sorted_clusters = clusters[order]
+        firsts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_clusters)) + 1))
+        limit[order[firsts]] = True
+
+    return np.flatnonzero(limit)
+
+
 def labelPointCloud2Msg(msg, seed_x, seed_y, seed_z, threshold, ransac_iterations,
                         ransac_threshold):
-    n_inliers = 0
     labels = {}
 
     points_in = numpyFromPointCloudMsg(msg)
@@ -101,8 +164,8 @@ def labelPointCloud2Msg(msg, seed_x, seed_y, seed_z, threshold, ransac_iteration
     # Extract the points close to the seed point from the entire PCL
     marker_point = np.array([[seed_x, seed_y, seed_z]])
     dist = spatial.distance.cdist(marker_point, points, metric='euclidean')
-    pts = points[np.transpose(dist < threshold)[:, 0], :]
-    idx = np.where(np.transpose(dist < threshold)[:, 0])[0]
+    idx = np.where(dist[0, :] < threshold)[0]
+    pts = points[idx, :]
     npoints_close = len(pts)
     # print('Found ' + str(npoints_close) + ' close to the marker (x=' + str(seed_x) + ' y=' + str(seed_y) + ' z=' + str(seed_z) + ') ')
 
@@ -110,14 +173,7 @@ def labelPointCloud2Msg(msg, seed_x, seed_y, seed_z, threshold, ransac_iteration
     # iteration
     seed_point = []
     if 0 < len(pts):
-        x_sum, y_sum, z_sum = 0, 0, 0
-        for i in range(0, len(pts)):
-            x_sum += pts[i, 0]
-            y_sum += pts[i, 1]
-            z_sum += pts[i, 2]
-        seed_point.append(x_sum / len(pts))
-        seed_point.append(y_sum / len(pts))
-        seed_point.append(z_sum / len(pts))
+        seed_point = list(np.mean(pts, axis=0))
 
     # RANSAC - eliminate the tracker outliers
     number_points = pts.shape[0]
@@ -127,140 +183,32 @@ def labelPointCloud2Msg(msg, seed_x, seed_y, seed_z, threshold, ransac_iteration
         seed_point = [seed_x, seed_y, seed_z]
         return labels, seed_point, []
 
-    A, B, C, D = None, None, None, None
-    # RANSAC iterations
-    for i in range(0, ransac_iterations):
-
-        # print('ransac iteration ' + str(i))
-        # print('number of points ' + str(number_points))
-        # Randomly select three points that cannot be coincident
-        # nor collinear
-        while True:
-            idx1 = random.randint(0, number_points - 1)
-            idx2 = random.randint(0, number_points - 1)
-            idx3 = random.randint(0, number_points - 1)
-            pt1, pt2, pt3 = pts[[idx1, idx2, idx3], :]
-
-            # Compute the norm of position vectors
-            ab = np.linalg.norm(pt2 - pt1)
-            bc = np.linalg.norm(pt3 - pt2)
-            ac = np.linalg.norm(pt3 - pt1)
-            # Check if points are colinear
-            if (ab + bc) == ac:
-                continue
-            # Check if are coincident
-            if idx2 == idx1:
-                continue
-            if idx3 == idx1 or idx3 == idx2:
-                continue
-
-            # If all the conditions are satisfied, we can end the loop
-            break
-
-        # ABC Hessian coefficients and given by the external product between two vectors lying on hte plane
-        Ai, Bi, Ci = np.cross(pt2 - pt1, pt3 - pt1)
-        # Hessian parameter D is computed using one point that lies on the plane
-        Di = - (Ai * pt1[0] + Bi * pt1[1] + Ci * pt1[2])
-        # Compute the distance from all points to the plane
-        # from https://www.geeksforgeeks.org/distance-between-a-point-and-a-plane-in-3-d/
-        denominator = math.sqrt(Ai * Ai + Bi * Bi + Ci * Ci)
-
-        if not denominator == 0:
-            distances = abs((Ai * pts[:, 0] + Bi * pts[:, 1] + Ci * pts[:, 2] + Di)) / denominator
-            # Compute number of inliers for this plane hypothesis.
-            # Inliers are points which have distance to the plane less than a tracker_threshold
-            n_inliers_i = (distances < ransac_threshold).sum()
-            # Store this as the best hypothesis if the number of inliers is larger than the previous max
-            if n_inliers_i > n_inliers:
-                n_inliers = n_inliers_i
-                A = Ai
-                B = Bi
-                C = Ci
-                D = Di
-
-    if A is None:
+    plane = fitPlaneRANSAC(pts, ransac_iterations, ransac_threshold)
+    if plane is None:
         labels = {'detected': False, 'idxs': [], 'idxs_limit_points': []}
         seed_point = [seed_x, seed_y, seed_z]
         return labels, seed_point, []
 
     # Extract the inliers
+    A, B, C, D = plane
     distances = abs((A * pts[:, 0] + B * pts[:, 1] + C * pts[:, 2] + D)) / \
                 (math.sqrt(A * A + B * B + C * C))
-    inliers = pts[np.where(distances < ransac_threshold)]
-    # Create dictionary [pcl point index, distance to plane] to select the pcl indexes of the inliers
-    idx_map = dict(zip(idx, distances))
-    final_idx = []
-    for key in idx_map:
-        if idx_map[key] < ransac_threshold:
-            final_idx.append(key)
+    is_inlier = distances < ransac_threshold
+    inliers = pts[is_inlier]
+    final_idx = idx[is_inlier]  # pcl indexes (in the sparse point cloud) of the inliers
 
     # -------------------------------------- End of RANSAC ----------------------------------------- #
 
-    # Update the dictionary with the labels (to be saved if the user selects the option)
-    labels['detected'] = True
-    labels['idxs'] = final_idx
-
     # ------------------------------------------------------------------------------------------------
     # -------- Extract the labelled LiDAR points on the pattern
     # ------------------------------------------------------------------------------------------------
-    # STEP 1: Get labelled points into a list of dictionaries format which is suitable for later processing.
-    # cloud_msg = getPointCloudMessageFromDictionary(collection['data'][sensor_key])
-    # pc = atom_core.ros_numpy.numpify(cloud_msg)
-    # pc is computed above from the input ros msg.
-
-    ps = []  # list of points, each containing a dictionary with all the required information.
-    for count, idx in enumerate(labels['idxs']):  # iterate all points
-        # x, y, z = pc['x'][idx], pc['y'][idx], pc['z'][idx]
-        x, y, z = points[idx][0], points[idx][1], points[idx][2]
-        ps.append({'idx': idx, 'idx_in_labelled': count, 'x': x, 'y': y, 'z': z, 'limit': False})
-
-    # STEP 2: Cluster points in pattern into groups using the theta component of the spherical coordinates.
-    # We use the convention commonly used in physics, i.e:
-    # https://en.wikipedia.org/wiki/Spherical_coordinate_system
-
-    # STEP 2.1: Convert to spherical coordinates
-    for p in ps:  # iterate all points
-        x, y, z = p['x'], p['y'], p['z']
-        p['r'] = math.sqrt(x ** 2 + y ** 2 + z ** 2)
-        p['phi'] = math.atan2(y, x)
-        p['theta'] = round(math.atan2(math.sqrt(x ** 2 + y ** 2), z), 4)  # Round to be able to cluster by
-        # finding equal theta values. Other possibilities of computing theta, check link above.
-
-    # STEP 2.2: Cluster points based on theta values
-    unique_thetas = list(set([item['theta'] for item in ps]))  # Going from list of thetas to set and back
-    # to list gives us the list of unique theta values.
+    limit_idx = final_idx[getLimitPointsIdxs(points[final_idx, :])]
 
-    for p in ps:  # iterate all points and give an "idx_cluster" to each
-        p['idx_cluster'] = unique_thetas.index(p['theta'])
-
-    # STEP 3: For each cluster, get limit points, i.e. those which have min and max phi values
-
-    for unique_theta in unique_thetas:
-        ps_in_cluster = [item for item in ps if item['theta'] == unique_theta]
-        # Get list of points with
-        phis_in_cluster = [item['phi'] for item in ps_in_cluster]
-
-        min_phi_idx_in_cluster = phis_in_cluster.index(min(phis_in_cluster))
-        ps[ps_in_cluster[min_phi_idx_in_cluster]['idx_in_labelled']]['limit'] = True
-
-        max_phi_idx_in_cluster = phis_in_cluster.index(max(phis_in_cluster))
-        ps[ps_in_cluster[max_phi_idx_in_cluster]['idx_in_labelled']]['limit'] = True
-
-    labels['idxs_limit_points'] = [item['idx'] for item in ps if item['limit']]
-
-    # Count the number of limit points (just for debug)
-    number_of_limit_points = len(labels['idxs_limit_points'])
-
-    # Convert indexation from sparse to dense point cloud
-    dense_idxs = []
-    for idx in labels['idxs']:
-        dense_idxs.append(points_idxs[idx])
-    labels['idxs'] = dense_idxs
-
-    dense_idxs = []
-    for idx in labels['idxs_limit_points']:
-        dense_idxs.append(points_idxs[idx])
-    labels['idxs_limit_points'] = dense_idxs
+    # Update the dictionary with the labels (to be saved if the user selects the option), converting indexation from
+    # sparse to dense point cloud
+    labels['detected'] = True
+    labels['idxs'] = points_idxs[final_idx].tolist()
+    labels['idxs_limit_points'] = points_idxs[limit_idx].tolist()
 
     # print('Found ' + str(len(labels['idxs'])) + ' pattern points')
     # print('Found ' + str(len(labels['idxs_limit_points'])) + ' limit points')
@@ -347,6 +295,86 @@ def getLinearIndexWidth(x, y, width):
     return x + y * width
 
 
+def floodFillDepth(diff_up, diff_down, diff_left, diff_right, seeds):
+    """ Grows a region from the seed points over the graph of pixels where each pixel is connected to its four
+    neighbors, with propagation to a neighbor allowed if the difference image of that direction is True there. The
+    region is computed with a single breadth first search (in compiled code) from a virtual node connected to all
+    seeds, instead of one iteration per wavefront.
+
+    :param diff_up: mask of the pixels to which propagation from the pixel below is allowed
+    :param diff_down: mask of the pixels to which propagation from the pixel above is allowed
+    :param diff_left: mask of the pixels to which propagation from the pixel on the right is allowed
+    :param diff_right: mask of the pixels to which propagation from the pixel on the left is allowed
+    :param seeds: array (2 x n) with the x, y coordinates of the seed points
+    :return: a boolean mask of the region reached from the seeds
+    """
+    height, width = diff_up.shape
+    number_of_pixels = height * width
+    pixel_idxs = np.arange(number_of_pixels).reshape((height, width))
+
+    # Directed edges (from, to) of the propagation graph, one set per direction
+    edges_from, edges_to = [], []
+    for from_idxs, to_idxs, allowed in [(pixel_idxs[1:, :], pixel_idxs[:-1, :], diff_up[:-1, :]),  # up
+                                        (pixel_idxs[:-1, :], pixel_idxs[1:, :], diff_down[1:, :]),  # down
+                                        (pixel_idxs[:, 1:], pixel_idxs[:, :-1], diff_left[:, :-1]),  # left
+                                        (pixel_idxs[:, :-1], pixel_idxs[:, 1:], diff_right[:, 1:])]:  # right
+        edges_from.append(from_idxs[allowed])
+        edges_to.append(to_idxs[allowed])
+
+    # A virtual source node (the last one) connected to all the seeds which are inside the image
+    seeds = np.asarray(seeds, dtype=int)
+    inside = np.logical_and(np.logical_and(seeds[0, :] >= 0, seeds[0, :] < width),
+                            np.logical_and(seeds[1, :] >= 0, seeds[1, :] < height))
+    seed_idxs = seeds[1, inside] * width + seeds[0, inside]
+    edges_from.append(np.full(seed_idxs.shape, number_of_pixels))
+    edges_to.append(seed_idxs)
+
+    edges_from, edges_to = np.concatenate(edges_from), np.concatenate(edges_to)
+    graph = csr_matrix((np.ones(edges_from.shape, dtype=bool), (edges_from, edges_to)),
+                       shape=(number_of_pixels + 1, number_of_pixels + 1))
+
+    reached = breadth_first_order(graph, number_of_pixels, directed=True, return_predecessors=False)
+    region_mask = np.zeros(number_of_pixels + 1, dtype=bool)
+    region_mask[reached] = True
+    return region_mask[:-1].reshape((height, width))
+
+
+def refineContourPoints(contour_xs, contour_ys, center, valid_mask):
+    """ Moves each contour point to the first valid pixel in the scan line that goes from the point to the center.
+    All scan lines are sampled at once, one pixel per step along the largest coordinate difference.
+
+    :param contour_xs: array with the x coordinates of the contour points
+    :param contour_ys: array with the y coordinates of the contour points
+    :param center: the x, y coordinates of the center
+    :param valid_mask: boolean mask of the valid pixels
+    :return: the refined x and y coordinates. Points without valid pixels in the scan line are not changed.
+    """
+    contour_xs = np.asarray(contour_xs, dtype=int)
+    contour_ys = np.asarray(contour_ys, dtype=int)
+    if contour_xs.size == 0:
+        return contour_xs, contour_ys
+
+    delta_xs = center[0] - contour_xs
+    delta_ys = center[1] - contour_ys
+    number_of_steps = np.maximum(np.abs(delta_xs), np.abs(delta_ys))
+
+    # Sample each line with as many steps as the longest one, repeating its last pixel (the center) in the end
+    steps = np.arange(np.max(number_of_steps) + 1)[np.newaxis, :]
+    fractions = np.minimum(steps, number_of_steps[:, np.newaxis]) / np.maximum(number_of_steps[:, np.newaxis], 1)
+    xis = np.rint(contour_xs[:, np.newaxis] + fractions * delta_xs[:, np.newaxis]).astype(int)
+    yis = np.rint(contour_ys[:, np.newaxis] + fractions * delta_ys[:, np.newaxis]).astype(int)
+
+    valid = valid_mask[yis, xis]
+    first = np.argmax(valid, axis=1)
+    found = valid[np.arange(valid.shape[0]), first]
+    rows = np.arange(valid.shape[0])[found]
+
+    refined_xs, refined_ys = contour_xs.copy(), contour_ys.copy()
+    refined_xs[found] = xis[rows, first[found]]
+    refined_ys[found] = yis[rows, first[found]]
+    return refined_xs, refined_ys
+
+
 def labelDepthMsg(msg, seed=None, propagation_threshold=0.2, bridge=None, pyrdown=0,
                   scatter_seed=False, scatter_seed_radius=8, subsample_solid_points=1, debug=False,
                   limit_sample_step=5, filter_border_edges=0.025, pattern_mask=None, remove_nan_border=False):
@@ -462,84 +490,24 @@ def labelDepthMsg(msg, seed=None, propagation_threshold=0.2, bridge=None, pyrdow
         else:
             initial_seeds = np.array([[seed_x], [seed_y]], dtype=int)
 
-        to_visit_mask = np.ones(image.shape, dtype=bool)
-        seeds_mask = np.zeros(image.shape, dtype=bool)
-        seeds = copy.copy(initial_seeds)
-
         if debug:
             cv2.namedWindow('Original', cv2.WINDOW_NORMAL)
             imageShowUInt16OrFloat32OrBool(image, 'Original')
-            # cv2.namedWindow('DiffUp', cv2.WINDOW_NORMAL)
-            # cv2.namedWindow('DiffDown', cv2.WINDOW_NORMAL)
-            # cv2.namedWindow('DiffLeft', cv2.WINDOW_NORMAL)
-            # cv2.namedWindow('DiffRight', cv2.WINDOW_NORMAL)
-            cv2.namedWindow('to_visit_mask', cv2.WINDOW_NORMAL)
             cv2.namedWindow('seeds_mask', cv2.WINDOW_NORMAL)
             cv2.namedWindow('ResultImage', cv2.WINDOW_NORMAL)
 
         # -------------------------------------
-        # Step 3: Flood fill (supersonic mode - hopefully ... )
+        # Step 3: Flood fill (a single pass over the propagation graph)
         # -------------------------------------
         if debug:
             now = rospy.Time.now()
 
-        while True:  # flood fill loop
-            # up direction
-            seeds_up = copy.copy(seeds)  # make a copy
-            seeds_up[1, :] -= 1  # upper row
-            mask_up = np.logical_and(diff_up[seeds_up[1, :], seeds_up[0, :]],
-                                     to_visit_mask[seeds_up[1, :], seeds_up[0, :]])
-            propagated_up = seeds_up[:, mask_up]
-
-            # down direction
-            seeds_down = copy.copy(seeds)  # make a copy
-            seeds_down[1, :] += 1  # lower row
-            mask_down = np.logical_and(diff_down[seeds_down[1, :], seeds_down[0, :]],
-                                       to_visit_mask[seeds_down[1, :], seeds_down[0, :]])
-            propagated_down = seeds_down[:, mask_down]
-
-            # left direction
-            seeds_left = copy.copy(seeds)  # make a copy
-            seeds_left[0, :] -= 1  # left column
-            mask_left = np.logical_and(diff_left[seeds_left[1, :], seeds_left[0, :]],
-                                       to_visit_mask[seeds_left[1, :], seeds_left[0, :]])
-            propagated_left = seeds_left[:, mask_left]
-
-            # right direction
-            seeds_right = copy.copy(seeds)  # make a copy
-            seeds_right[0, :] += 1  # right column
-            mask_right = np.logical_and(diff_right[seeds_right[1, :], seeds_right[0, :]],
-                                        to_visit_mask[seeds_right[1, :], seeds_right[0, :]])
-            propagated_right = seeds_right[:, mask_right]
-
-            # set the seed points for the next iteration
-            seeds = np.hstack((propagated_up, propagated_down, propagated_left, propagated_right))
-            # print(seeds.shape)
-            if seeds.shape[1] != 0:
-                seeds = np.unique(seeds, axis=1)  # make sure the points are unique
-
-            # Mark the visited points
-            to_visit_mask[seeds_up[1, :], seeds_up[0, :]] = False
-            to_visit_mask[seeds_down[1, :], seeds_down[0, :]] = False
-            to_visit_mask[seeds_left[1, :], seeds_left[0, :]] = False
-            to_visit_mask[seeds_right[1, :], seeds_right[0, :]] = False
-
-            # seeds_mask = np.zeros(image.shape, dtype=bool) # Uncomment this to see the seed points on each iteration
-            seeds_mask[seeds[1, :], seeds[0, :]] = True
-
-            if debug:
-                # imageShowUInt16OrFloat32OrBool(diff_up, 'DiffUp')
-                # imageShowUInt16OrFloat32OrBool(diff_down, 'DiffDown')
-                # imageShowUInt16OrFloat32OrBool(diff_right, 'DiffRight')
-                # imageShowUInt16OrFloat32OrBool(diff_left, 'DiffLeft')
-                imageShowUInt16OrFloat32OrBool(to_visit_mask, 'to_visit_mask')
-                imageShowUInt16OrFloat32OrBool(seeds_mask, 'seeds_mask')
-                cv2.waitKey(5)
-
-            if not seeds.size:  # termination condition: no more seed points
-                break
+        seeds_mask = floodFillDepth(diff_up, diff_down, diff_left, diff_right, initial_seeds)
+        seeds_mask[np.isnan(image)] = False  # a seed may fall on a nan pixel
 
         if debug:
+            imageShowUInt16OrFloat32OrBool(seeds_mask, 'seeds_mask')
+            cv2.waitKey(5)
             print(
                 'Time taken in floodfill (using debug=' + str(debug) + ') is ' + str((rospy.Time.now() - now).to_sec()))
 
@@ -649,23 +617,12 @@ def labelDepthMsg(msg, seed=None, propagation_threshold=0.2, bridge=None, pyrdow
         if remove_nan_border:
             # Create a mask where there is information in the image
             # 644 https://github.com/lardemua/atom/issues/644
-            mask_rectangle = (np.logical_not(np.isnan(image))).astype(np.uint8) * 255
-            max_x = -width
-            min_x = width * 10
-            max_y = -height
-            min_y = height * 10
-            for x in range(0, width):
-                for y in range(0, height):
-                    if mask_rectangle[y, x] == 255:
-                        if x < min_x:
-                            min_x = x
-                        elif x > max_x:
-                            max_x = x
-
-                        if y < min_y:
-                            min_y = y
-                        elif y > max_y:
-                            max_y = y
+            not_nan_rows, not_nan_cols = np.where(np.logical_not(np.isnan(image)))
+            if not_nan_rows.size:
+                min_x, max_x = np.min(not_nan_cols), np.max(not_nan_cols)
+                min_y, max_y = np.min(not_nan_rows), np.max(not_nan_rows)
+            else:
+                min_x, max_x, min_y, max_y = width * 10, -width, height * 10, -height
 
         # ------------------------------------------------------
         # Solid mask coordinates
@@ -678,12 +635,9 @@ def labelDepthMsg(msg, seed=None, propagation_threshold=0.2, bridge=None, pyrdow
             idxs_rows = idxs_rows * (2 * pyrdown)  # compensate the pyr down
             idxs_cols = idxs_cols * (2 * pyrdown)
 
-        # Filter out NaN values in the original image
-        labels['idxs'] = []
-        for row, col in zip(list(idxs_rows), list(idxs_cols)):
-            if not np.isnan(original_image[row, col]):
-                # store linear index
-                labels['idxs'].append(col + original_width * row)
+        # Filter out NaN values in the original image, and store linear indices
+        not_nan = np.logical_not(np.isnan(original_image[idxs_rows, idxs_cols]))
+        labels['idxs'] = (idxs_cols[not_nan] + original_width * idxs_rows[not_nan]).tolist()
 
         # ------------------------------------------------------
         # Edges mask coordinates computed from the contours
@@ -703,60 +657,25 @@ def labelDepthMsg(msg, seed=None, propagation_threshold=0.2, bridge=None, pyrdow
 
         border_tolerance = int(width * filter_border_edges)
         # print("border_tolerance = " + str(border_tolerance))
-        idxs_rows = []
-        idxs_cols = []
-        external_contour = contours[0]
-        for value in external_contour:  # for each value in contours, correct it by analyzing a scan line that goes from the center to the point.
-
-            x = value[0][0]
-            y = value[0][1]
-
-            discrete_line = list(zip(*line(*(x, y), *center)))
-            for xi, yi in discrete_line:
-
-                if pattern_mask is not None:
-                    if pattern_mask[yi, xi] == 255 and not np.isnan(image[yi, xi]):
-                        x, y = xi, yi
-                        break
-                else:
-                    if pattern_solid_mask[yi, xi] == 255 and not np.isnan(image[yi, xi]):
-                        x, y = xi, yi
-                        break
-
-            # if np.isnan(image[y, x]):  # if x,y is nan in depth image, find nearest white pixel
-            #     closest_not_nan_pixel = find_nearest_white(pattern_solid_mask, (y, x))
-            #     x = closest_not_nan_pixel[1]
-            #     y = closest_not_nan_pixel[0]
-
-            if remove_nan_border:
-                # Estimate a tolerance from the maximum
-                if x < (max_x - border_tolerance) and x > (min_x + border_tolerance):
-                    if y < (max_y - border_tolerance) and y > (min_y + border_tolerance):
-                        if np.isnan(image[y,x]) == False:
-                            idxs_rows.append(y)
-                            idxs_cols.append(x)
-            else:
-                if x < (width - border_tolerance) and x > (0 + border_tolerance):
-                    if y < (height - border_tolerance) and y > (0 + border_tolerance):
-                        if np.isnan(image[y,x]) == False:
-                            idxs_rows.append(y)
-                            idxs_cols.append(x)
-                        # idxs_rows.append(y)
-                        # idxs_cols.append(x)
-                        # if np.isnan(image[y,x]):
-                        #     print("IS NAN")
+        external_contour = np.array(contours[0], dtype=int).reshape((-1, 2))
 
-                            # print(image[y,x])
-
-
-            # Add point only if it is far away from the image borders
-            # if x < (width - 1 - (width - 1) * filter_border_edges) and x > (width - 1) * filter_border_edges:
-            #     if y < (height - 1 - (height - 1) * filter_border_edges) and y > (height - 1) * filter_border_edges:
-            #         idxs_rows.append(y)
-            #         idxs_cols.append(x)
-
-        idxs_rows = np.array(idxs_rows)
-        idxs_cols = np.array(idxs_cols)
+        # Correct each value in contours by analyzing a scan line that goes from the center to the point.
+        not_nan_mask = np.logical_not(np.isnan(image))
+        if pattern_mask is not None:
+            valid_mask = np.logical_and(pattern_mask == 255, not_nan_mask)
+        else:
+            valid_mask = np.logical_and(pattern_solid_mask == 255, not_nan_mask)
+        xs, ys = refineContourPoints(external_contour[:, 0], external_contour[:, 1], center, valid_mask)
+
+        # Add point only if it is far away from the image borders (or from the nan border), and not nan
+        if not remove_nan_border:
+            min_x, max_x, min_y, max_y = 0, width, 0, height
+        far_from_border = np.logical_and(
+            np.logical_and(xs < (max_x - border_tolerance), xs > (min_x + border_tolerance)),
+            np.logical_and(ys < (max_y - border_tolerance), ys > (min_y + border_tolerance)))
+        selected = np.logical_and(far_from_border, not_nan_mask[ys, xs])
+        idxs_rows = ys[selected]
+        idxs_cols = xs[selected]
 
         if pyrdown > 0:
             idxs_rows = idxs_rows * (2 * pyrdown)  # compensate the pyr down
@@ -790,17 +709,14 @@ def labelDepthMsg(msg, seed=None, propagation_threshold=0.2, bridge=None, pyrdow
             gui_image = gui_image.astype(np.uint8)
 
         # show subsampled points
-        for idx in labels['idxs']:
-            y = int(idx / original_width)
-            x = int(idx - y * original_width)
-
-            if pyrdown > 0:
-                y = int(y / (2 * pyrdown))
-                x = int(x / (2 * pyrdown))
+        ys, xs = np.divmod(np.array(labels['idxs'], dtype=int), original_width)
+        if pyrdown > 0:
+            ys = (ys / (2 * pyrdown)).astype(int)
+            xs = (xs / (2 * pyrdown)).astype(int)
 
-            gui_image[y, x, 0] = 0
-            gui_image[y, x, 1] = 200
-            gui_image[y, x, 2] = 255
+        gui_image[ys, xs, 0] = 0
+        gui_image[ys, xs, 1] = 200
+        gui_image[ys, xs, 2] = 255
 
         # # Draw the Canny boundary
         # mask_canny = pattern_edges_mask.astype(bool)
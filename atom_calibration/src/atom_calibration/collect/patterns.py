@@ -1,5 +1,6 @@
 from copy import deepcopy
 import math
+import time
 import cv2
 import numpy as np
 from atom_core.utilities import atomError
@@ -11,12 +12,83 @@ from atom_calibration.collect import patterns as opencv_patterns
 import atom_core.atom
 
 
+def getPyramidLevels(shape, max_size):
+    """ Number of levels the image pyramid must go down so that the width and height of an image are at most max_size.
+    """
+    levels = 0
+    while max(shape[0], shape[1]) / 2 ** levels > max_size:
+        levels += 1
+    return levels
+
+
+def buildPyramid(gray, levels):
+    """ Builds an image pyramid, a list with the image and each of its downscaled (by 2) versions. """
+    pyramid = [gray]
+    for _ in range(levels):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def refineCornersInPyramid(pyramid, corners, level, criteria):
+    """ Refines corners detected in a level of the image pyramid, going up the pyramid to the full resolution image.
+    At each level, the corners are upscaled and refined with sub pixel accuracy in a small window, so the last
+    refinement is always done at full resolution.
+
+    :param pyramid: the image pyramid (see buildPyramid)
+    :param corners: the corners detected at level, an array (n x 1 x 2)
+    :param level: the level of the pyramid in which the corners were detected
+    :param criteria: the termination criteria of the refinement at full resolution
+    :return: the corners at full resolution
+    """
+    corners = np.array(corners, dtype=np.float32)
+    coarse_criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    for idx in range(level, -1, -1):
+        if idx < level:
+            corners = corners * 2
+        corners = cv2.cornerSubPix(pyramid[idx], corners, (5, 5), (-1, -1), criteria if idx == 0 else coarse_criteria)
+    return corners
+
+
+def getRegionOfInterest(points, shape, margin=0.5):
+    """ Gets the bounding box of a set of image points, enlarged by a margin on each side, so that the pattern can
+    be searched in the next frame in the same region even if it moves.
+
+    :param points: an array (n x 1 x 2) of image points
+    :param shape: the shape of the image
+    :param margin: enlargement on each side, as a fraction of the size of the bounding box
+    :return: a tuple (x0, y0, x1, y1)
+    """
+    points = np.asarray(points).reshape((-1, 2))
+    x0, y0 = np.min(points, axis=0)
+    x1, y1 = np.max(points, axis=0)
+    margin_x, margin_y = (x1 - x0) * margin, (y1 - y0) * margin
+    return (int(max(0, x0 - margin_x)), int(max(0, y0 - margin_y)),
+            int(min(shape[1], x1 + margin_x + 1)), int(min(shape[0], y1 + margin_y + 1)))
+
+
+def getSearchRegions(roi, shape):
+    """ The regions where to search for the pattern: the tracked region of interest, if any, and then the image. """
+    image_region = (0, 0, shape[1], shape[0])
+    return [image_region] if roi is None else [roi, image_region]
+
+
 class ChessboardPattern(object):
-    def __init__(self, size, length):
+    def __init__(self, size, length, detection_max_size=None):
+        """
+        :param detection_max_size: if given, the pattern is detected in a downscaled level of the image pyramid with
+        width and height of at most detection_max_size, first inside the region of the previous detection, and then
+        refined at full resolution. Much faster for high resolution images.
+        """
         self.size = (size["x"], size["y"])
         self.length = length
+        self.detection_max_size = detection_max_size
+        self.criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 500, 0.0001)
+        self.roi = None  # region of the previous detection (x0, y0, x1, y1), used with detection_max_size
+        self.timings = {}  # duration in secs of each stage of the last detection
 
     def detect(self, image, equalize_histogram=False):
+        tic = time.perf_counter()
+        self.timings = {}
 
         if len(image.shape) == 3:  # convert to gray if it is an rgb image
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -25,17 +97,49 @@ class ChessboardPattern(object):
 
         if equalize_histogram:
             gray = cv2.equalizeHist(gray)
+        tic = self.addTiming('preprocessing', tic)
 
         # Find chessboard corners
-        found, corners = cv2.findChessboardCorners(gray, self.size)
+        if self.detection_max_size is None:
+            found, corners = cv2.findChessboardCorners(gray, self.size)
+            tic = self.addTiming('detection', tic)
+            if found:
+                corners = cv2.cornerSubPix(gray, corners, (5, 5), (-1, -1), self.criteria)
+                self.addTiming('refinement', tic)
+        else:
+            found, corners = self.detectInPyramid(gray, tic)
+
         if not found:
-            return {"detected": False, 'keypoints': corners, 'ids': []}
+            return {"detected": False, 'keypoints': corners, 'ids': [], 'timings': self.timings}
+
+        return {"detected": True, 'keypoints': corners, 'ids': range(0, len(corners)), 'timings': self.timings}
+
+    def detectInPyramid(self, gray, tic):
+        """ Detects the corners in a downscaled level of the image pyramid, searching first in the region of the
+        previous detection, and refines them at full resolution. """
+        for x0, y0, x1, y1 in getSearchRegions(self.roi, gray.shape):
+            crop = gray[y0:y1, x0:x1]
+            level = getPyramidLevels(crop.shape, self.detection_max_size)
+            pyramid = buildPyramid(crop, level)
+            found, corners = cv2.findChessboardCorners(pyramid[level], self.size)
+            if found:
+                break
+        tic = self.addTiming('detection', tic)
 
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 500, 0.0001)
-        sub_pixel_corners = cv2.cornerSubPix(gray, corners, (5, 5), (-1, -1), criteria)
-        sub_pixel_corners = corners
+        if not found:
+            self.roi = None  # pattern lost, search the whole image next time
+            return False, None
+
+        corners = refineCornersInPyramid(pyramid, corners, level, self.criteria) + np.array([x0, y0], np.float32)
+        self.roi = getRegionOfInterest(corners, gray.shape)
+        self.addTiming('refinement', tic)
+        return True, corners
 
-        return {"detected": True, 'keypoints': sub_pixel_corners, 'ids': range(0, len(sub_pixel_corners))}
+    def addTiming(self, stage, tic):
+        """ Stores the duration of a detection stage started at tic, and returns the time at which it ended. """
+        toc = time.perf_counter()
+        self.timings[stage] = toc - tic
+        return toc
 
     def drawKeypoints(self, image, result, K=None, D=None):
         if result['keypoints'] is None or len(result['keypoints']) == 0:
@@ -75,7 +179,12 @@ class ChessboardPattern(object):
 
 
 class CharucoPattern(object):
-    def __init__(self, size, length, marker_length, dictionary='DICT_5X5_100'):
+    def __init__(self, size, length, marker_length, dictionary='DICT_5X5_100', detection_max_size=None):
+        """
+        :param detection_max_size: if given, the markers are detected in a downscaled level of the image pyramid with
+        width and height of at most detection_max_size, first inside the region of the previous detection, and then
+        refined at full resolution. Much faster for high resolution images.
+        """
 
         # string to charuco dictionary conversion
         charuco_dict = {
@@ -115,7 +224,55 @@ class CharucoPattern(object):
             self.board = cv2.aruco.CharucoBoard((size["y"] + 1, size["x"] + 1), length, marker_length,
                                                 self.dictionary)
 
+        # The detector is created once and used for all images
+        # https://github.com/lardemua/atom/issues/629
+        if cv2.__version__ == '4.6.0':
+            self.parameters = cv2.aruco.DetectorParameters_create()
+        else:
+            self.detector = cv2.aruco.ArucoDetector(self.dictionary, cv2.aruco.DetectorParameters())
+
+        self.detection_max_size = detection_max_size
+        self.criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.001)
+        self.roi = None  # region of the previous detection (x0, y0, x1, y1), used with detection_max_size
+        self.timings = {}  # duration in secs of each stage of the last detection
+
+    def detectMarkers(self, gray):
+        if cv2.__version__ == '4.6.0':
+            corners, ids, _ = cv2.aruco.detectMarkers(gray, self.dictionary, parameters=self.parameters)
+            # cv2.aruco.refineDetectedMarkers(gray, self.board, corners, ids, rejected)
+        else:
+            corners, ids, _ = self.detector.detectMarkers(gray)
+        return corners, ids
+
+    def detectMarkersInPyramid(self, gray):
+        """ Detects the markers in a downscaled level of the image pyramid, searching first in the region of the
+        previous detection, and refines their corners at full resolution. """
+        for x0, y0, x1, y1 in getSearchRegions(self.roi, gray.shape):
+            crop = gray[y0:y1, x0:x1]
+            level = getPyramidLevels(crop.shape, self.detection_max_size)
+            pyramid = buildPyramid(crop, level)
+            corners, ids = self.detectMarkers(pyramid[level])
+            if len(corners) > 4:
+                break
+
+        if len(corners) <= 4:
+            return corners, ids
+
+        # Refine the corners of all markers at once
+        marker_corners = refineCornersInPyramid(pyramid, np.concatenate(corners).reshape((-1, 1, 2)), level,
+                                                self.criteria) + np.array([x0, y0], np.float32)
+        corners = tuple(marker_corners.reshape((-1, 1, 4, 2)))
+        return corners, ids
+
+    def addTiming(self, stage, tic):
+        """ Stores the duration of a detection stage started at tic, and returns the time at which it ended. """
+        toc = time.perf_counter()
+        self.timings[stage] = toc - tic
+        return toc
+
     def detect(self, image, equalize_histogram=False):
+        tic = time.perf_counter()
+        self.timings = {}
 
         if len(image.shape) == 3:  # convert to gray if it is an rgb image
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -124,34 +281,33 @@ class CharucoPattern(object):
 
         if equalize_histogram:  # equalize image histogram
             gray = cv2.equalizeHist(gray)
+        tic = self.addTiming('preprocessing', tic)
 
-        # https://github.com/lardemua/atom/issues/629
-        if cv2.__version__ == '4.6.0':
-            params = cv2.aruco.DetectorParameters_create()
-            corners, ids, rejected = cv2.aruco.detectMarkers(gray, self.dictionary, parameters=params)
-            # cv2.aruco.refineDetectedMarkers(gray, self.board, corners, ids, rejected)
+        if self.detection_max_size is None:
+            corners, ids = self.detectMarkers(gray)
         else:
-            params = cv2.aruco.DetectorParameters()
-            detector = cv2.aruco.ArucoDetector(self.dictionary, params)
-            corners, ids, rejected = detector.detectMarkers(gray)
+            corners, ids = self.detectMarkersInPyramid(gray)
+        tic = self.addTiming('detection', tic)
 
         if len(corners) <= 4:  # Must have more than 3 corner detections
-            return {"detected": False, 'keypoints': np.array([]), 'ids': []}
+            self.roi = None
+            return {"detected": False, 'keypoints': np.array([]), 'ids': [], 'timings': self.timings}
 
-        # Interpolation of charuco corners
+        # Interpolation of charuco corners, refined at full resolution
         ret, ccorners, cids = cv2.aruco.interpolateCornersCharuco(corners, ids, gray, self.board)
+        self.addTiming('refinement', tic)
 
         # Produce results dictionary -------------------------
 
-        if ccorners is None:  # Must have interpolation running ok
-            return {"detected": False, 'keypoints': np.array([]), 'ids': []}
-
-        # A valid detection must have at least 25% of the total number of corners.
-        if len(ccorners) <= self.number_of_corners / 4:
-            return {"detected": False, 'keypoints': np.array([]), 'ids': []}
+        # Must have interpolation running ok, and a valid detection must have at least 25% of the total number of
+        # corners.
+        if ccorners is None or len(ccorners) <= self.number_of_corners / 4:
+            self.roi = None
+            return {"detected": False, 'keypoints': np.array([]), 'ids': [], 'timings': self.timings}
 
         # If all above works, return detected corners.
-        return {'detected': True, 'keypoints': ccorners, 'ids': cids.ravel().tolist()}
+        self.roi = getRegionOfInterest(ccorners, gray.shape)
+        return {'detected': True, 'keypoints': ccorners, 'ids': cids.ravel().tolist(), 'timings': self.timings}
 
     def drawKeypoints(self, image, result, K=None, D=None):
         if result['keypoints'] is None or len(result['keypoints']) == 0:
@@ -25,8 +25,8 @@ from atom_calibration.dataset_playback.depth_manual_labeling import drawLabelsOn
 from atom_core.cache import Cache
 from atom_core.system import execute
 from atom_core.xacro_io import readXacroFile
-from atom_core.dataset_io import (genCollectionPrefix, getCvImageFromDictionary, getCvImageFromDictionaryDepth,
-                                  getPointCloudMessageFromDictionary)
+from atom_core.dataset_io import (genCollectionPrefix, getCvImageFromDataset, getDepthImageFromDataset,
+                                  getPointCloudArrayFromDataset)
 from atom_core.drawing import drawCross2D, drawSquare2D
 from atom_core.naming import generateLabeledTopic, generateName
 from atom_core.rospy_urdf_to_rviz_converter import urdfToMarkerArray
@@ -108,10 +108,8 @@ def createDepthMarkers3D(dataset, sensor_key, collection_key, pattern_key, color
 
 def getPointsInSensorAsNPArray_local(_collection_key, _sensor_key, _label_key, _dataset):
     # TODO: #395 Daniel, we should you told me about this one but I would like to talk to you again ... although this function is somewhere else, in the other place it uses the dataset as cache...
-    cloud_msg = getPointCloudMessageFromDictionary(
-        _dataset['collections'][_collection_key]['data'][_sensor_key])
     idxs = _dataset['collections'][_collection_key]['labels'][_sensor_key][_label_key]
-    pc = atom_core.ros_numpy.numpify(cloud_msg)[idxs]
+    pc = getPointCloudArrayFromDataset(_dataset, _collection_key, _sensor_key)[idxs]
     points = np.zeros((4, pc.shape[0]))
     points[0, :] = pc['x']
     points[1, :] = pc['y']
@@ -121,13 +119,11 @@ def getPointsInSensorAsNPArray_local(_collection_key, _sensor_key, _label_key, _
 
 
 def getCvImageFromCollectionSensor(collection_key, sensor_key, dataset):
-    dictionary = dataset['collections'][collection_key]['data'][sensor_key]
-    return getCvImageFromDictionary(dictionary)
+    return getCvImageFromDataset(dataset, collection_key, sensor_key)
 
 
 def getCvDepthImageFromCollectionSensor(collection_key, sensor_key, dataset, scale=1000.0):
-    dictionary = dataset['collections'][collection_key]['data'][sensor_key]
-    return getCvImageFromDictionaryDepth(dictionary, scale=scale)
+    return getDepthImageFromDataset(dataset, collection_key, sensor_key, scale=scale)
 
 
 def createPatternMarkers(frame_id, ns, collection_key, now, dataset, graphics):
@@ -413,22 +409,9 @@ def setupVisualization(dataset, args, selected_collection_key):
                 frame_id = genCollectionPrefix(collection_key, collection['data'][sensor_key]['header']['frame_id'])
 
                 # Add 3D lidar data
-                original_pointcloud_msg = getPointCloudMessageFromDictionary(
-                    dataset['collections'][collection_key]['data'][sensor_key])
-
-                # print('original_pointcloud_msg.width = ' + str(original_pointcloud_msg.width))
-                # print('original_pointcloud_msg.height = ' + str(original_pointcloud_msg.height))
-
-                # exit(0)
-                final_pointcloud_msg = PointCloud2(header=Header(frame_id=frame_id, stamp=now),
-                                                height=original_pointcloud_msg.height,
-                                                width=original_pointcloud_msg.width,
-                                                fields=original_pointcloud_msg.fields,
-                                                is_bigendian=original_pointcloud_msg.is_bigendian,
-                                                point_step=original_pointcloud_msg.point_step,
-                                                row_step=original_pointcloud_msg.row_step,
-                                                data=original_pointcloud_msg.data,
-                                                is_dense=original_pointcloud_msg.is_dense)
+                final_pointcloud_msg = atom_core.ros_numpy.msgify(
+                    PointCloud2, getPointCloudArrayFromDataset(dataset, collection_key, sensor_key), stamp=now,
+                    frame_id=frame_id)
 
                 labeled_topic = generateLabeledTopic(dataset['sensors'][sensor_key]['topic'], type='3d')
                 graphics['sensors'][sensor_key]['PubPointCloud'] = rospy.Publisher(
@@ -744,7 +727,7 @@ def visualizationFunction(models, selection, clicked_points=None):
                 clicked_sensor_points = clicked_points[selected_collection_key][sensor_key]['points']
 
                 # Create image to draw on top
-                image = getCvImageFromDictionaryDepth(collection['data'][sensor_key])
+                image = getDepthImageFromDataset(dataset, selected_collection_key, sensor_key)
                 gui_image = normalizeDepthImage(image, max_value=5)
                 for pattern_key in dataset['calibration_config']['calibration_patterns'].keys():
                     gui_image = drawLabelsOnImage(collection['labels'][pattern_key][sensor_key], gui_image)
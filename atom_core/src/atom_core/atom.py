@@ -1,26 +1,55 @@
 import numpy as np
 import networkx as nx
 from atom_core.naming import generateKey
-from atom_core.geometry import translationQuaternionToTransform
+from atom_core.geometry import (translationQuaternionToTransform, translationsQuaternionsToTransforms,
+                                invertRigidTransforms)
 
 
-def getChain(from_frame, to_frame, transform_pool):
-    """ Gets a chain of transforms given two reference frames and a se of transformations. Computes a graph from the
-    set of transforms, and then finds a path in the graph betweem the two given links.
+class TransformGraphIndex:
+    """
+    Index of the chains of transforms between pairs of frames. The topology of a transform pool is given by its set of
+    transform keys (parent-child), and it does not change when the values of the transforms do (e.g. during an
+    optimization). Thus, the graph of each set of transform keys is built only once, and the chain between two frames
+    is cached with key (from_frame, to_frame, set of transform keys).
+    """
+
+    def __init__(self):
+        self.graphs = {}  # key=frozenset of transform keys, value=networkx graph
+        self.chains = {}  # key=(from_frame, to_frame, frozenset of transform keys), value=chain
+
+    def getChain(self, from_frame, to_frame, transform_pool):
+        transform_keys = frozenset(transform_pool.keys())
+        key = (from_frame, to_frame, transform_keys)
+        if key not in self.chains:
+            if transform_keys not in self.graphs:
+                graph = nx.Graph()  # build a graph of transforms and then use it to find the path
+                for transform_key, transform in transform_pool.items():  # create the graph from the transform_pool
+                    graph.add_edge(transform['parent'], transform['child'])
+                self.graphs[transform_keys] = graph
+
+            self.chains[key] = computeChain(from_frame, to_frame, self.graphs[transform_keys])
+
+        return self.chains[key]
+
+    def clear(self):
+        self.graphs = {}
+        self.chains = {}
+
+
+transform_graph_index = TransformGraphIndex()  # shared by all calls to getChain
+
+
+def computeChain(from_frame, to_frame, graph):
+    """ Finds the chain of transforms between two reference frames in a graph of transforms.
 
     @param from_frame: initial frame
     @param to_frame: final frame
-    @param transform_pool: a dictionary containing several transforms
-    @return:  a chain of transforms The standard we have is to use a list of dictionaries, each containing
-    # information about the transform: [{'parent': parent, 'child': child, 'key': 'parent-child'}, {...}]
+    @param graph: a networkx graph where nodes are frames and edges are transforms
+    @return: a chain of transforms, as a list of dictionaries
     """
     chain = []  # initialized to empty list. The standard we have is to use a list of dictionaries, each containing
     # information about the transform: [{'parent': parent, 'child': child, 'key': 'parent-child'}, {...}]
 
-    graph = nx.Graph()  # build a graph of transforms and then use it to find the path
-    for transform_key, transform in transform_pool.items():  # create the graph from the transform_pool
-        graph.add_edge(transform['parent'], transform['child'])
-
     # Debug stuff, just for drawing
     # nx.draw(graph, with_labels=True)
     # import matplotlib.pyplot as plt
@@ -35,6 +64,20 @@ def getChain(from_frame, to_frame, transform_pool):
     return chain
 
 
+def getChain(from_frame, to_frame, transform_pool):
+    """ Gets a chain of transforms given two reference frames and a se of transformations. Computes a graph from the
+    set of transforms, and then finds a path in the graph betweem the two given links. Graphs and chains are cached in
+    the transform graph index, so the returned chain must not be modified.
+
+    @param from_frame: initial frame
+    @param to_frame: final frame
+    @param transform_pool: a dictionary containing several transforms
+    @return:  a chain of transforms The standard we have is to use a list of dictionaries, each containing
+    # information about the transform: [{'parent': parent, 'child': child, 'key': 'parent-child'}, {...}]
+    """
+    return transform_graph_index.getChain(from_frame, to_frame, transform_pool)
+
+
 def getAggregateTransform(chain, transforms):
     """ Multiplies local transforms in a chain to get the global transform of the chain
 
@@ -76,3 +119,64 @@ def getTransform(from_frame, to_frame, transforms):
     """
     chain = getChain(from_frame, to_frame, transforms)
     return getAggregateTransform(chain, transforms)
+
+
+def getAggregateTransformForCollections(chain, collections):
+    """ Multiplies local transforms in a chain to get the global transform of the chain, for all collections at once.
+    The local transforms of each link are stacked across collections, and reverse links are inverted in closed form.
+
+    @param chain: a list of transforms
+    @param collections: dictionary of collections, each with a pool of transformations
+    @return: an array (number of collections x 4 x 4) with the global transformations, in the order of collections
+    """
+    transforms = np.tile(np.eye(4, dtype=float), (len(collections), 1, 1))
+
+    for link in chain:
+        key = generateKey(link['parent'], link['child'])
+        inverse_key = generateKey(link['child'], link['parent'])
+        try:
+            if all(key in collection['transforms'] for collection in collections.values()):
+                local_transforms = [collection['transforms'][key] for collection in collections.values()]
+                parent_T_child = translationsQuaternionsToTransforms([t['trans'] for t in local_transforms],
+                                                                     [t['quat'] for t in local_transforms])
+            else:  # the reverse transform may exist
+                local_transforms = [collection['transforms'][inverse_key] for collection in collections.values()]
+                parent_T_child = invertRigidTransforms(
+                    translationsQuaternionsToTransforms([t['trans'] for t in local_transforms],
+                                                        [t['quat'] for t in local_transforms]))
+        except KeyError:
+            raise ValueError('Transform from ' + link['parent'] + ' to ' + link['child'] + ' does not exist.')
+
+        transforms = np.matmul(transforms, parent_T_child)
+
+    return transforms
+
+
+def getTransformForCollections(from_frame, to_frame, collections):
+    """ Gets the transformation between any two frames for all collections at once. Collections are grouped by their
+    set of transform keys, and the chain of each group is computed from the transforms of that group, so collections
+    may have different transforms (e.g. after filtering out additional tfs).
+
+    @param from_frame: Starting frame
+    @param to_frame: Ending frame
+    @param collections: dictionary of collections, each with a dictionary of several transforms
+    @return: an array (number of collections x 4 x 4) with the global transformations, in the order of collections
+    """
+    if not collections:
+        return np.zeros((0, 4, 4), dtype=float)
+
+    groups = {}  # key=frozenset of transform keys, value=list of (index, collection key) of the collections
+    for idx, (collection_key, collection) in enumerate(collections.items()):
+        groups.setdefault(frozenset(collection['transforms'].keys()), []).append((idx, collection_key))
+
+    if len(groups) == 1:  # all collections have the same transforms, the usual case
+        chain = getChain(from_frame, to_frame, next(iter(collections.values()))['transforms'])
+        return getAggregateTransformForCollections(chain, collections)
+
+    transforms = np.zeros((len(collections), 4, 4), dtype=float)
+    for members in groups.values():
+        group_collections = {collection_key: collections[collection_key] for _, collection_key in members}
+        chain = getChain(from_frame, to_frame, collections[members[0][1]]['transforms'])
+        transforms[[idx for idx, _ in members]] = getAggregateTransformForCollections(chain, group_collections)
+
+    return transforms
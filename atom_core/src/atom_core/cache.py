@@ -66,6 +66,7 @@ class Cache:
                 print('Current cache keys:\n' + str(self.cache.keys()))
             return r
 
+        wrapper.clearCache = self.clearCache  # so that the cache of a decorated function can be cleared
         return wrapper
 
     def clearCache(self):
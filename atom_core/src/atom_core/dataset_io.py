@@ -1,9 +1,12 @@
 import copy
 
 # Standard imports
+import hashlib
+import io
 import json
 import os
-from os.path import exists
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 
@@ -14,8 +17,6 @@ import cv2
 import rospy
 import tf
 import atom_core.pypcd as pypcd
-import sensor_msgs.point_cloud2 as pc2
-from sensor_msgs.msg import PointCloud2, PointField, sensor_msgs
 
 # Atom imports
 from cv_bridge import CvBridge
@@ -24,6 +25,8 @@ from rospy_message_converter import message_converter
 from std_msgs.msg import Header
 from atom_core.config_io import uriReader
 from atom_core.naming import generateName, generateKey
+from atom_core.sensor_data_store import SensorDataStore
+import atom_core.ros_numpy
 from atom_calibration.collect.label_messages import (convertDepthImage32FC1to16UC1, convertDepthImage16UC1to32FC1,
                                                      numpyFromPointCloudMsg)
 
@@ -37,16 +40,39 @@ def printImageInfo(image, text=None):
               '\n\tmin value = ' + str(np.nanmin(image)))
 
 
-def loadResultsJSON(json_file, collection_selection_function=None):
+def loadResultsJSON(json_file, collection_selection_function=None, use_sensor_data_store=False,
+                    number_of_workers=1, lazy_loading=False, max_cached_frames=None, memory_map=True):
+    """
+    Loads a dataset from a json file, and the images and point clouds from the data files it points to.
+    :param json_file: the json file of the dataset.
+    :param collection_selection_function: a function which receives a collection key and returns True if its data
+    should be loaded.
+    :param use_sensor_data_store: if True, images, depth images and 3D point clouds are kept as numpy arrays in a
+    SensorDataStore (dataset['_sensor_data']) instead of in the 'data' fields of the dataset. Use the accessors
+    getCvImageFromDataset, getDepthImageFromDataset and getPointCloudArrayFromDataset to read them.
+    :param number_of_workers: number of threads used to decode the data files.
+    :param lazy_loading: if True (requires use_sensor_data_store), data files are decoded only when their data is
+    accessed for the first time, so data which is never used is never read from disk.
+    :param max_cached_frames: with lazy loading, maximum number of decoded frames kept in memory. None for no limit.
+    :param memory_map: for datasets in the binary format, if True the long label lists (e.g. idxs) are read only
+    memory mapped arrays. If False they are lists, as when loaded from a json file, so they can be edited.
+    :return: the dataset and the json file.
+    """
 
-    dataset = loadJSONFile(json_file)
-    dataset_folder = os.path.dirname(json_file)
-    bridge = CvBridge()
+    if lazy_loading and not use_sensor_data_store:
+        raise ValueError('Lazy loading of the dataset requires the sensor data store.')
+
+    dataset = loadJSONFile(json_file, memory_map=memory_map)
+    dataset_folder = os.path.dirname(str(json_file).rstrip('/'))  # binary datasets are folders, maybe with a trailing /
+
+    if use_sensor_data_store:
+        dataset['_sensor_data'] = SensorDataStore(max_cached_frames=max_cached_frames)
 
     # Load images from files into memory. Images in the json file are stored in separate png files and in their place
     # a field "data_file" is saved with the path to the file. We must load the images from the disk.
     # Do the same for point clouds saved in pcd files
     skipped_loading = []
+    files_to_load = []  # list of tuples (collection_key, sensor_key, modality, filename)
     for collection_key, collection in dataset['collections'].items():
 
         # Check if collection is listed to be ignored by csf and do not load image and point cloud if it is
@@ -63,94 +89,105 @@ def loadResultsJSON(json_file, collection_selection_function=None):
 
             # Check if we really need to load the file.
             if 'data' in collection['data'][sensor_key]:
-                load_file = False
+                continue
             elif 'data_file' in collection['data'][sensor_key]:
                 filename = dataset_folder + '/' + collection['data'][sensor_key]['data_file']
-                if os.path.isfile(filename):
-                    load_file = True
-                else:
+                if not os.path.isfile(filename):
                     raise ValueError('Datafile points to ' + collection['data'][sensor_key]['data_file'] +
                                      ' but file ' + filename + ' does not exist.')
             else:
                 raise ValueError('Dataset does not contain data nor data_file folders.')
 
-            if load_file and (sensor['modality'] == 'rgb'):  # Load image.
-
-                filename = os.path.dirname(json_file) + '/' + collection['data'][sensor_key]['data_file']
-                cv_image = cv2.imread(filename)  # Load image from file
-                dict_image = getDictionaryFromCvImage(cv_image)  # from opencv image to dictionary
-
-                # Check if loaded image has the same properties as the dataset in collection['data'][sensor_key]
-                assert collection['data'][sensor_key]['height'] == dict_image['height'], 'Image height must be the same'
-                assert collection['data'][sensor_key]['width'] == dict_image['width'], 'Image width must be the same'
-
-                collection['data'][sensor_key]['data'] = dict_image['data']  # set data field of collection
-                collection['data'][sensor_key]['encoding'] = dict_image['encoding']
-                collection['data'][sensor_key]['step'] = dict_image['step']
-                # Previous code, did not preserve frame_id and other properties
-                # collection['data'][sensor_key].update(getDictionaryFromCvImage(cv_image))
-
-            elif load_file and sensor['modality'] == 'depth':
-                filename = os.path.dirname(json_file) + '/' + collection['data'][sensor_key]['data_file']
-
-                # print(collection['data'][sensor_key]['header']['frame_id'])
-                cv_image_int16_tenths_of_millimeters = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
-                cv_image_float32_meters = convertDepthImage16UC1to32FC1(cv_image_int16_tenths_of_millimeters,
-                                                                        scale=10000.0)
-                # collection['data'][sensor_key]['encoding']='32FC1'
-
-                # cv2.imshow("cv_image_float32_meters", cv_image_int16_tenths_of_millimeters)
-                # cv2.waitKey(0)
-                # imageShowUInt16OrFloat32OrBool(cv_image_float32_meters, "float32_load_file")
-                # cv2.waitKey(5)
-
-                # printImageInfo(cv_image_int16_tenths_of_millimeters, text='cv_image_int16_tenths_of_millimeters')
-                # printImageInfo(cv_image_float32_meters, text='cv_image_float32_meters')
-
-                # collection['data'][sensor_key].update(getDictionaryFromDepthImage(cv_image_float32_meters))
-
-                dict = getDictionaryFromDepthImage(cv_image_float32_meters)
-
-                collection['data'][sensor_key]['data'] = dict['data']
-                collection['data'][sensor_key]['encoding'] = dict['encoding']
-                collection['data'][sensor_key]['step'] = dict['step']
-                # del dict['data']
-                # del collection['data'][sensor_key]['data']
-                # print(dict)
-                # print(collection['data'][sensor_key])
-                # exit(0)
-                # msg_33 = message_converter.convert_dictionary_to_ros_message('sensor_msgs/Image', dict)
-                # image_33=bridge.imgmsg_to_cv2(msg_33, desired_encoding='passthrough')
-                # imageShowUInt16OrFloat32OrBool(image_33, "load_file_dic")
-                # cv2.waitKey(5)
-
-                # TODO eliminate data_file
-                # TODO Why this is not needed for rgb? Should be done as well
-
-                # print(collection['data'][sensor_key]['header']['frame_id'])
-                # print(collection['data'][sensor_key].keys())
-                # TODO verify if values in the dataset or ok
-                # exit(0)
-
-            # Load point cloud.
-            elif load_file and (sensor['modality'] == 'lidar3d' or sensor['modality'] == 'lidar2d'):
-                filename = os.path.dirname(json_file) + '/' + collection['data'][sensor_key]['data_file']
-                frame_id = str(collection['data'][sensor_key]['header']['frame_id'])
-
-                # setup header for point cloud from existing dictionary data
-                header = Header()
-                header.frame_id = frame_id
-                time = rospy.Time()
-                time.secs = collection['data'][sensor_key]['header']['stamp']['secs']
-                time.nsecs = collection['data'][sensor_key]['header']['stamp']['nsecs']
-                header.stamp = time
-                header.seq = collection['data'][sensor_key]['header']['seq']
-
-                # read point cloud from dist
-                msg = read_pcd(filename, cloud_header=header)
-
-                # convert to dictionary
-                collection['data'][sensor_key].update(message_converter.convert_ros_message_to_dictionary(msg))
+            files_to_load.append((collection_key, sensor_key, sensor['modality'], filename))
+
+    # With lazy loading, the store gets a loader for each data file instead of the data. The lidar2d data is always
+    # loaded to the dictionaries.
+    if lazy_loading:
+        for collection_key, sensor_key, modality, filename in files_to_load:
+            if modality == 'lidar2d':
+                continue
+            collection_data = dataset['collections'][collection_key]['data'][sensor_key]
+            if modality == 'rgb':
+                collection_data['encoding'] = 'bgr8'
+                collection_data['step'] = collection_data['width'] * 3
+            elif modality == 'depth':
+                collection_data['encoding'] = '32FC1'
+                collection_data['step'] = collection_data['width'] * 4
+            dataset['_sensor_data'].setLoader(collection_key, sensor_key, sensorDataKind(modality),
+                                              partial(readSensorDataArray, filename, modality))
+
+        files_to_load = [f for f in files_to_load if f[2] == 'lidar2d']
+
+    # Decode the data files, in parallel if requested. Decoding is mostly done by opencv and numpy, which release the
+    # GIL, so threads are enough.
+    filenames_and_modalities = [(filename, modality) for _, _, modality, filename in files_to_load]
+    if number_of_workers > 1 and len(files_to_load) > 1:
+        with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+            decoded_data = list(executor.map(lambda f: readSensorDataFile(*f), filenames_and_modalities))
+    else:
+        decoded_data = [readSensorDataFile(*f) for f in filenames_and_modalities]
+
+    for (collection_key, sensor_key, modality, filename), data in zip(files_to_load, decoded_data):
+        collection_data = dataset['collections'][collection_key]['data'][sensor_key]
+
+        if modality == 'rgb':  # Load image.
+            cv_image = data
+
+            # Check if loaded image has the same properties as the dataset in collection['data'][sensor_key]
+            assert collection_data['height'] == cv_image.shape[0], 'Image height must be the same'
+            assert collection_data['width'] == cv_image.shape[1], 'Image width must be the same'
+
+            if use_sensor_data_store:  # keep the image as is, and set only the image properties of the dictionary
+                dataset['_sensor_data'].setImage(collection_key, sensor_key, cv_image)
+                collection_data['encoding'] = 'bgr8'
+                collection_data['step'] = cv_image.shape[1] * 3
+                continue
+
+            dict_image = getDictionaryFromCvImage(cv_image)  # from opencv image to dictionary
+            collection_data['data'] = dict_image['data']  # set data field of collection
+            collection_data['encoding'] = dict_image['encoding']
+            collection_data['step'] = dict_image['step']
+            # Previous code, did not preserve frame_id and other properties
+            # collection['data'][sensor_key].update(getDictionaryFromCvImage(cv_image))
+
+        elif modality == 'depth':
+            cv_image_float32_meters = data
+
+            if use_sensor_data_store:  # keep the image as is, and set only the image properties of the dictionary
+                dataset['_sensor_data'].setDepthImage(collection_key, sensor_key, cv_image_float32_meters)
+                collection_data['encoding'] = '32FC1'
+                collection_data['step'] = cv_image_float32_meters.shape[1] * 4
+                continue
+
+            dict = getDictionaryFromDepthImage(cv_image_float32_meters)
+            collection_data['data'] = dict['data']
+            collection_data['encoding'] = dict['encoding']
+            collection_data['step'] = dict['step']
+            # TODO eliminate data_file
+            # TODO Why this is not needed for rgb? Should be done as well
+
+        # Load point cloud.
+        elif modality == 'lidar3d' or modality == 'lidar2d':
+            pc = data
+
+            if use_sensor_data_store and modality == 'lidar3d':  # keep the points as a numpy array
+                dataset['_sensor_data'].setPointCloud(collection_key, sensor_key, pc.pc_data)
+                continue
+
+            # setup header for point cloud from existing dictionary data
+            header = Header()
+            header.frame_id = str(collection_data['header']['frame_id'])
+            time = rospy.Time()
+            time.secs = collection_data['header']['stamp']['secs']
+            time.nsecs = collection_data['header']['stamp']['nsecs']
+            header.stamp = time
+            header.seq = collection_data['header']['seq']
+
+            msg = pc.to_msg()
+            msg.header = header
+
+            # convert to dictionary
+            collection_data.update(message_converter.convert_ros_message_to_dictionary(msg))
 
     if skipped_loading:  # list is not empty
         print('Skipped loading images and point clouds for collections: ' + str(skipped_loading) + '.')
@@ -158,35 +195,191 @@ def loadResultsJSON(json_file, collection_selection_function=None):
     return dataset, json_file
 
 
-def saveAtomDataset(output_file, dataset_in, freeze_dataset=False):
+def sensorDataKind(modality):
+    """ The kind of data in the sensor data store for each sensor modality. """
+    return {'rgb': 'image', 'depth': 'depth', 'lidar3d': 'point_cloud'}[modality]
+
+
+def readSensorDataFile(filename, modality):
+    """
+    Decodes the data file of a sensor.
+    :param filename: the data file.
+    :param modality: the modality of the sensor.
+    :return: for rgb a bgr8 opencv image, for depth a float32 image in meters, and for lidar3d and lidar2d a pypcd
+    point cloud. The points of binary pcd files are memory mapped, not read until used.
+    """
+    if modality == 'rgb':
+        return cv2.imread(filename)  # Load image from file
+    elif modality == 'depth':
+        cv_image_int16_tenths_of_millimeters = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+        return convertDepthImage16UC1to32FC1(cv_image_int16_tenths_of_millimeters, scale=10000.0)
+    elif modality == 'lidar3d' or modality == 'lidar2d':
+        return pypcd.PointCloud.from_path(filename)
+    else:
+        raise ValueError('Cannot read data file for modality ' + str(modality))
+
+
+def readSensorDataArray(filename, modality):
+    """ Decodes the data file of a sensor into the numpy array kept in the sensor data store. """
+    data = readSensorDataFile(filename, modality)
+    return data.pc_data if modality == 'lidar3d' else data
+
+
+def saveAtomDataset(output_file, dataset_in, freeze_dataset=False, number_of_workers=1, compact=False,
+                    source_folder=None):
+    """
+    Saves a dataset to a json file, and its images and point clouds to separate data files.
+    :param output_file: the json file.
+    :param dataset_in: the dataset.
+    :param freeze_dataset: if True, the given dataset is not changed.
+    :param number_of_workers: number of threads used to encode and write the data files.
+    :param compact: if True, the json is written without indentation, which is faster to write and read.
+    :param source_folder: the folder of the dataset the data was loaded from, if its data was not changed. Data files
+    which exist in it are not written again, the json points to them instead (by a path relative to the output folder).
+    """
     if freeze_dataset:  # to make sure our changes only affect the dictionary to save
-        dataset = copy.deepcopy(dataset_in)
+        dataset = copyDataDictionaries(dataset_in)
     else:
         dataset = dataset_in
 
-    output_folder = os.path.dirname(output_file)
+    output_folder = os.path.dirname(str(output_file).rstrip('/'))
     if output_folder == '':
         output_folder = './'
 
-    bridge = CvBridge()
-
     # Process the dataset to remove data from the data fields and, if needed, write the files.
+    executor = ThreadPoolExecutor(max_workers=number_of_workers) if number_of_workers > 1 else None
+    futures = []
     for collection_key, collection in dataset['collections'].items():
         for sensor_key, sensor in dataset['sensors'].items():
             # print('Saving  collection ' + collection_key + ' sensor ' + sensor_key)
-            createDataFile(dataset, collection_key, sensor, sensor_key, output_folder)
+            futures.append(createDataFile(dataset, collection_key, sensor, sensor_key, output_folder,
+                                          executor=executor, source_folder=source_folder))
 
         # Do the same for additional data topics ...
         # for description, sensor in dataset['additional_sensor_data'].items():
         #     createDataFile(dataset_in, collection_key, sensor, description, output_folder, 'additional_data')
 
-    createJSONFile(output_file, dataset)  # write dictionary to json
+    if executor is not None:
+        executor.shutdown(wait=True)
+        for future in futures:  # raise the errors of the writes, if any
+            if future is not None:
+                future.result()
+
+    createJSONFile(output_file, dataset, compact=compact)  # write dictionary to json
+
+
+def copyDataDictionaries(dataset_in):
+    """
+    Copies the dictionaries of a dataset which saveAtomDataset changes, i.e. the data dictionaries of the sensors in
+    each collection (see createDataFile), and the dictionaries which contain them. All other fields, and the data in
+    the data dictionaries (e.g. images), are shared with the given dataset, not copied.
+    :return: the copy of the dataset.
+    """
+    dataset = dict(dataset_in)
+    dataset['collections'] = {}
+    for collection_key, collection in dataset_in['collections'].items():
+        dataset['collections'][collection_key] = dict(collection)
+        dataset['collections'][collection_key]['data'] = {sensor_key: dict(data) for sensor_key, data in
+                                                          collection['data'].items()}
+    return dataset
+
 
+def writeDataFile(filename, encoder, executor=None, matches=None):
+    """
+    Encodes and writes a data file, unless the file already exists with the same content.
+    :param filename: the data file.
+    :param encoder: a function without arguments which returns the bytes of the file.
+    :param executor: if given, the file is encoded and written by the executor.
+    :param matches: a function which receives the existing file name and returns True if it has the same content.
+    Needed for lossy formats, e.g. jpg, since reencoding an image does not give the bytes of its file. If not given,
+    the bytes are compared.
+    :return: a future if an executor is given, None otherwise.
+    """
+    def write():
+        # Skip files with the same content, before encoding (and losing quality) if possible
+        if matches is not None and os.path.isfile(filename) and matches(filename):
+            print('File ' + filename + ' already exists with the same content, skipping save ...')
+            return
+
+        data = encoder()
+
+        # Otherwise compare the sizes first and then the hashes of the bytes
+        if matches is None and os.path.isfile(filename) and os.path.getsize(filename) == len(data):
+            with open(filename, 'rb') as f:
+                if hashlib.sha1(f.read()).digest() == hashlib.sha1(data).digest():
+                    print('File ' + filename + ' already exists with the same content, skipping save ...')
+                    return
+
+        # Write to a temporary file which then replaces the data file, so that point clouds memory mapped from the
+        # previous file are not changed
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_filename, filename)
+        print('Saved file ' + filename + '.')
+
+    if executor is None:
+        write()
+        return None
+    else:
+        return executor.submit(write)
 
-def createDataFile(dataset, collection_key, sensor, sensor_key, output_folder, data_type='data'):
+
+def encodeImage(cv_image, extension):
+    """ Encodes an opencv image to the bytes of an image file, e.g. extension '.jpg' or '.png'. """
+    success, buffer = cv2.imencode(extension, cv_image)
+    if not success:
+        raise ValueError('Could not encode image to ' + extension)
+    return buffer.tobytes()
+
+
+def imageFileHasPixels(cv_image, filename):
+    """ Checks if an image file decodes to exactly the pixels of an opencv image. """
+    file_image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    return file_image is not None and file_image.shape == cv_image.shape and np.array_equal(file_image, cv_image)
+
+
+def encodeDepthImage(cv_image):
+    """ Encodes a float32 depth image in meters to the bytes of an uint16 png file in tenths of millimeters. """
+    return encodeImage(convertDepthImage32FC1to16UC1(cv_image, scale=10000), '.png')  # Better to use tenths of milimeters
+
+
+def encodePointCloud(cloud):
+    """ Encodes a point cloud (structured numpy array) to the bytes of a binary pcd file with fields x, y and z. """
+    # Flattened (height=1) before saving to pcd, because pypcd cannot save non flattened pointclouds to pcd.
+    # https://github.com/lardemua/atom/issues/520
+    points = np.empty((cloud.size,), dtype=[('x', np.float32), ('y', np.float32), ('z', np.float32)])
+    points['x'] = cloud['x'].reshape(-1)
+    points['y'] = cloud['y'].reshape(-1)
+    points['z'] = cloud['z'].reshape(-1)
+
+    pc = pypcd.PointCloud.from_array(points)
+    buffer = io.BytesIO()
+    pc.save_pcd_to_fileobj(buffer, compression='binary')
+    return buffer.getvalue()
+
+
+def createDataFile(dataset, collection_key, sensor, sensor_key, output_folder, data_type='data', executor=None,
+                   source_folder=None):
+    """
+    Creates the data file of a sensor in a collection if needed, and replaces the data in the collection by the name
+    of the data file.
+    :param executor: if given, the data file is encoded and written by the executor.
+    :param source_folder: if given, and the data file of the collection exists in this folder, the data file is not
+    created, and the collection points to the existing file by a path relative to the output folder.
+    :return: a future if the data file is written by the executor, None otherwise.
+    """
     if not (sensor['modality'] == 'rgb' or sensor['modality'] == 'lidar3d' or
             sensor['modality'] == 'lidar2d' or sensor['modality'] == 'depth'):
-        return
+        return None
+
+    # Point to the data file in the source folder, if it exists, instead of writing a copy of it
+    if source_folder is not None and 'data_file' in dataset['collections'][collection_key][data_type][sensor_key]:
+        source_filename = os.path.join(source_folder,
+                                       dataset['collections'][collection_key][data_type][sensor_key]['data_file'])
+        if os.path.isfile(source_filename):
+            dataset['collections'][collection_key][data_type][sensor_key]['data_file'] = \
+                os.path.relpath(source_filename, output_folder)
 
     # Check if data_file has to be created based on the existence of the field 'data_file' and the file itself.
     if 'data_file' in dataset['collections'][collection_key][data_type][sensor_key]:
@@ -201,28 +394,19 @@ def createDataFile(dataset, collection_key, sensor, sensor_key, output_folder, d
     else:
         create_data_file = True
 
-    if create_data_file:
-        # print('Collection ' + str(collection_key) + '. Creating data file for sensor ' + str(sensor_key)
-        #   + ' msg type ' + sensor['msg_type'])
-        pass
-
+    future = None
     if create_data_file and sensor['modality'] == 'rgb':  # save image.
-        # Save image to disk if it does not exist
+        # Save image to disk, unless it exists with the same content
         filename = output_folder + '/' + sensor['_name'] + '_' + str(collection_key) + '.jpg'
-        if not os.path.isfile(filename):  # Write rgb image file
-            cv_image = getCvImageFromDictionary(dataset['collections'][collection_key][data_type][sensor_key])
-
-            # flip color channels if needed
-            if dataset['collections'][collection_key][data_type][sensor_key]['encoding'] == 'rgb8':
-                cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
-                dataset['collections'][collection_key][data_type][sensor_key]['encoding'] = 'bgr8'
-
-            if not exists(filename):
-                # print('Starting to save file ' + filename + '.')
-                cv2.imwrite(filename, cv_image)
-                print('Saved file ' + filename + '.')
-            else:
-                print('File ' + filename + ' already exists, skipping save ...')
+        cv_image = getCvImageFromDataset(dataset, collection_key, sensor_key)
+
+        # flip color channels if needed
+        if dataset['collections'][collection_key][data_type][sensor_key]['encoding'] == 'rgb8':
+            cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
+            dataset['collections'][collection_key][data_type][sensor_key]['encoding'] = 'bgr8'
+
+        future = writeDataFile(filename, partial(encodeImage, cv_image, '.jpg'), executor,
+                               matches=partial(imageFileHasPixels, cv_image))
 
         # Add data_file field, and remove data field
         filename_relative = sensor['_name'] + '_' + str(collection_key) + '.jpg'
@@ -232,14 +416,10 @@ def createDataFile(dataset, collection_key, sensor, sensor_key, output_folder, d
 
     elif create_data_file and sensor['modality'] == 'lidar3d':  # save point cloud
         # sensor['modality'] == 'lidar2d':  # TODO Add for lidar 2D
-        # Save file if it does not exist
+        # Save file, unless it exists with the same content
         filename = output_folder + '/' + sensor['_name'] + '_' + str(collection_key) + '.pcd'
-        if not os.path.isfile(filename):  # Write pointcloud to pcd file
-            # TODO must remove this or True, just for debugging
-            # from: dictionary -> ros_message -> PointCloud2() -> pcd file
-            msg = getPointCloudMessageFromDictionary(dataset['collections'][collection_key][data_type][sensor_key])
-            write_pcd(filename, msg)
-            print('Saved file ' + filename + '.')
+        cloud = getPointCloudArrayFromDataset(dataset, collection_key, sensor_key)
+        future = writeDataFile(filename, partial(encodePointCloud, cloud), executor)
 
         # Add data_file field, and remove data field
         filename_relative = sensor['_name'] + '_' + str(collection_key) + '.pcd'
@@ -249,18 +429,10 @@ def createDataFile(dataset, collection_key, sensor, sensor_key, output_folder, d
             del dataset['collections'][collection_key][data_type][sensor_key]['data']
 
     elif create_data_file and sensor['modality'] == 'depth':
-        # print('i dont know what im doing')
-        # Save image to disk if it does not exist
+        # Save image to disk, unless it exists with the same content
         filename = output_folder + '/' + sensor['_name'] + '_' + str(collection_key) + '.png'
-        # filename_np=output_folder + '/' + sensor['_name'] + '_' + str(collection_key) + '.npy'
-        if not os.path.isfile(filename):  # Write pointcloud to pcd file
-            cv_image = getCvImageFromDictionaryDepth(dataset['collections'][collection_key][data_type][sensor_key])
-            # print("image from getimage")
-            # print(cv_image.dtype)
-            cv_image = convertDepthImage32FC1to16UC1(cv_image, scale=10000)  # Better to use tenths of milimeters
-            # cv2.normalize(cv_image, cv_image, 0, 65535, cv2.NORM_MINMAX)
-            cv2.imwrite(filename, cv_image)
-            print('Saved file ' + filename + '.')
+        cv_image = getDepthImageFromDataset(dataset, collection_key, sensor_key)
+        future = writeDataFile(filename, partial(encodeDepthImage, cv_image), executor)
 
         # Add data_file field, and remove data field
         filename_relative = sensor['_name'] + '_' + str(collection_key) + '.png'
@@ -269,6 +441,8 @@ def createDataFile(dataset, collection_key, sensor, sensor_key, output_folder, d
         if 'data' in dataset['collections'][collection_key][data_type][sensor_key]:  # Delete data field from dictionary
             del dataset['collections'][collection_key][data_type][sensor_key]['data']
 
+    return future
+
 
 def getDictionaryFromCvImage(cv_image):
     """
@@ -374,6 +548,64 @@ def getPointCloudMessageFromDictionary(dictionary_in):
     return msg
 
 
+def getCvImageFromDataset(dataset, collection_key, sensor_key):
+    """
+    Gets the opencv image of a sensor in a collection, from the sensor data store if the dataset has one, or else by
+    converting the dictionary of the collection's data.
+    :return: an opencv image.
+    """
+    if '_sensor_data' in dataset and (collection_key, sensor_key) in dataset['_sensor_data']:
+        return dataset['_sensor_data'].getImage(collection_key, sensor_key)
+
+    return getCvImageFromDictionary(dataset['collections'][collection_key]['data'][sensor_key])
+
+
+def getDepthImageFromDataset(dataset, collection_key, sensor_key, scale=1000.0):
+    """
+    Gets the depth image (float32, in meters) of a sensor in a collection, from the sensor data store if the dataset
+    has one, or else by converting the dictionary of the collection's data.
+    :param scale: used to convert the image from the dictionary if its values are uint16.
+    :return: an opencv image.
+    """
+    if '_sensor_data' in dataset and (collection_key, sensor_key) in dataset['_sensor_data']:
+        return dataset['_sensor_data'].getDepthImage(collection_key, sensor_key)
+
+    return getCvImageFromDictionaryDepth(dataset['collections'][collection_key]['data'][sensor_key], scale=scale)
+
+
+def getPointCloudArrayFromDataset(dataset, collection_key, sensor_key):
+    """
+    Gets the point cloud of a sensor in a collection, as a structured numpy array (a single row) with fields such as
+    'x', 'y' and 'z', from the sensor data store if the dataset has one, or else by converting the dictionary of the
+    collection's data.
+    :return: a structured numpy array.
+    """
+    if '_sensor_data' in dataset and (collection_key, sensor_key) in dataset['_sensor_data']:
+        return dataset['_sensor_data'].getPointCloud(collection_key, sensor_key)
+
+    cloud_msg = getPointCloudMessageFromDictionary(dataset['collections'][collection_key]['data'][sensor_key])
+    return atom_core.ros_numpy.numpify(cloud_msg).reshape((-1,))
+
+
+def getLabeledPointsFromDataset(dataset, collection_key, pattern_key, sensor_key, label_key='idxs'):
+    """
+    Gets the points of a point cloud labelled as belonging to a pattern, e.g. label_key='idxs' for all the points of the
+    pattern or label_key='idxs_limit_points' for its limits. With a sensor data store, points are read directly from
+    the loaded point cloud, and cached in the store.
+    :return: an array (4 x n) with the homogeneous coordinates of the points, in the frame of the sensor.
+    """
+    def getPoints():
+        idxs = dataset['collections'][collection_key]['labels'][pattern_key][sensor_key][label_key]
+        cloud = getPointCloudArrayFromDataset(dataset, collection_key, sensor_key)[idxs]
+        return np.vstack((cloud['x'], cloud['y'], cloud['z'], np.ones(cloud.shape))).astype(float)
+
+    if '_sensor_data' in dataset and (collection_key, sensor_key) in dataset['_sensor_data']:
+        return dataset['_sensor_data'].getDerived(collection_key, sensor_key, ('labeled_points', pattern_key, label_key),
+                                                  getPoints)
+
+    return getPoints()
+
+
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.integer):
@@ -388,36 +620,371 @@ class NpEncoder(json.JSONEncoder):
 
 # json.dumps(data, cls=NpEncoder)
 
-def createJSONFile(output_file, data):
+def createJSONFile(output_file, data, compact=False):
     """
-    Creates the json file containing the results data.
+    Creates the json file containing the results data. If the output file has suffix '.atom', the dataset is saved in
+    the binary format instead (see createBinaryDatasetFile), and with suffix '.journal' as a journal (see
+    createJournalFile).
     :param output_file: output file.
     :param data: data in dict format to save.
+    :param compact: if True, the json is written without indentation.
     """
-    D = copy.deepcopy(data)
-    walk(D)
+    if isJournalFile(output_file):
+        createJournalFile(output_file, data)
+        return
+    elif isBinaryDatasetFile(output_file):
+        createBinaryDatasetFile(output_file, data)
+        return
 
-    f = open(output_file, 'w')
-    json.encoder.FLOAT_REPR = lambda f: ("%.6f" % f)  # to get only four decimal places on the json file
-    # print >> f, json.dumps(D, indent=2, sort_keys=True)
-    f.write(json.dumps(D, indent=2, sort_keys=True, cls=NpEncoder))
-    f.close()
+    D = filterJSONData(data)  # copies only the dictionaries, not the data in them
+
+    # json.dump writes the json to the file as it is encoded, so the text of the whole dataset is never in memory
+    with open(output_file, 'w') as f:
+        if compact:
+            json.dump(D, f, separators=(',', ':'), sort_keys=True, cls=NpEncoder)
+        else:
+            json.dump(D, f, indent=2, sort_keys=True, cls=NpEncoder)
     print("Saved json output file to " + str(output_file) + ".")
 
-def loadJSONFile(json_file):
+
+def filterJSONData(node):
+    """
+    Copies the dictionaries of the data to save in the json file, without the data which is not saved in it: numpy
+    arrays in 'data' fields (images) and the sensor data store. Other values are not copied, but shared.
+    :param node: a dictionary.
+    :return: the filtered copy of the dictionary.
+    """
+    filtered = {}
+    for key, item in node.items():
+        if key == '_sensor_data':  # the sensor data is saved in separate files
+            continue
+        elif isinstance(item, dict):
+            filtered[key] = filterJSONData(item)
+        elif isinstance(item, np.ndarray) and key == 'data':  # to avoid saving images in the json
+            continue
+        else:
+            filtered[key] = item  # numpy arrays are converted to lists by the NpEncoder
+    return filtered
+
+
+def loadJSONFile(json_file, memory_map=True):
     """
-    Loads the json file containing the dataset, without the data.
-    :param json_file: json file to load.
+    Loads the json file containing the dataset, without the data. Datasets in the binary format (see
+    createBinaryDatasetFile) and journals (see createJournalFile) are also accepted.
+    :param json_file: json file (or binary dataset folder, or journal manifest) to load.
+    :param memory_map: for the binary format, if True the arrays are memory mapped (read only). Otherwise, they are
+    read as lists.
     """
 
     json_file, _, _ = uriReader(json_file)
 
+    # If the json file was not written (e.g. collect_data did not shutdown properly), load the journal, if any
+    journal_file = os.path.splitext(str(json_file).rstrip('/'))[0] + journal_suffix
+    if not os.path.exists(json_file) and os.path.isfile(journal_file):
+        print(Fore.YELLOW + 'Dataset ' + str(json_file) + ' does not exist, loading its journal ' + journal_file +
+              '.' + Style.RESET_ALL)
+        json_file = journal_file
+
+    if isJournalFile(json_file):
+        return loadJournalFile(json_file)
+    elif isBinaryDatasetFile(json_file):
+        return loadBinaryDatasetFile(json_file, memory_map=memory_map)
+
     f = open(json_file, 'r')
     dataset = json.load(f)
 
     return dataset
 
 
+# -------------------------------------------------------------------------------
+# --- BINARY DATASET FORMAT
+# -------------------------------------------------------------------------------
+# A binary dataset is a folder with suffix '.atom', used in place of the json file of the dataset. It contains:
+#   - dataset.json: the dictionary of the dataset, where each long numeric list (e.g. the idxs of the labels) is
+#     replaced by a reference {"__npy__": "arrays/<number>.npy"}
+#   - arrays/<number>.npy: the typed arrays, which are memory mapped on load instead of parsed from the json.
+binary_dataset_suffix = '.atom'
+binary_dataset_json = 'dataset.json'
+binary_dataset_arrays_folder = 'arrays'
+binary_array_min_size = 100  # shorter lists (e.g. transforms, joints) are cheap to parse and stay in the json
+
+
+def isBinaryDatasetFile(filename):
+    """
+    Returns True if the filename is (or should be saved as) a dataset in the binary format, i.e., it has the suffix
+    '.atom' or it is a folder with the binary dataset json and arrays folder. Other folders are not binary datasets.
+    """
+    filename = str(filename).rstrip('/')
+    if filename.endswith(binary_dataset_suffix):
+        return True
+    return os.path.isfile(os.path.join(filename, binary_dataset_json)) and \
+        os.path.isdir(os.path.join(filename, binary_dataset_arrays_folder))
+
+
+def numericListToArray(item):
+    """
+    Converts a list of numbers into a typed array, integer if all are integers and float otherwise.
+    :return: the array, or None if the list is not a list of numbers.
+    """
+    if all(isinstance(x, (int, np.integer)) and not isinstance(x, bool) for x in item):
+        return np.array(item, dtype=np.int64)
+    elif all(isinstance(x, (int, float, np.integer, np.floating)) and not isinstance(x, bool) for x in item):
+        return np.array(item, dtype=np.float64)
+    return None
+
+
+def createBinaryDatasetFile(output_folder, data):
+    """
+    Creates a dataset in the binary format, where long numeric lists and numpy arrays are saved as npy files.
+    :param output_folder: the dataset folder, with suffix '.atom'.
+    :param data: data in dict format to save.
+    """
+    arrays_folder = os.path.join(output_folder, binary_dataset_arrays_folder)
+    os.makedirs(arrays_folder, exist_ok=True)
+    for filename in os.listdir(arrays_folder):  # remove the arrays of a previous save
+        if filename.endswith('.npy'):
+            os.remove(os.path.join(arrays_folder, filename))
+
+    count = [0]
+
+    def extractArrays(node):
+        if isinstance(node, dict):
+            return {key: extractArrays(item) for key, item in node.items()}
+        elif isinstance(node, (list, np.ndarray)):
+            array = node if isinstance(node, np.ndarray) else None
+            if array is None and len(node) >= binary_array_min_size:
+                array = numericListToArray(node)
+
+            if array is not None and array.dtype != object:
+                filename = binary_dataset_arrays_folder + '/' + str(count[0]).zfill(6) + '.npy'
+                np.save(os.path.join(output_folder, filename), np.ascontiguousarray(array))
+                count[0] += 1
+                return {'__npy__': filename}
+            elif isinstance(node, list):
+                return [extractArrays(item) for item in node]
+        return node
+
+    D = extractArrays(filterJSONData(data))
+
+    f = open(os.path.join(output_folder, binary_dataset_json), 'w')
+    json.dump(D, f, separators=(',', ':'), sort_keys=True, cls=NpEncoder)
+    f.close()
+    print('Saved binary dataset to ' + str(output_folder) + ' (' + str(count[0]) + ' arrays).')
+
+
+def loadBinaryDatasetFile(dataset_folder, memory_map=True):
+    """
+    Loads a dataset in the binary format.
+    :param dataset_folder: the dataset folder, with suffix '.atom'.
+    :param memory_map: if True the arrays are given as read only memory mapped numpy arrays, so only the parts which
+    are used are read from the disk. Otherwise, they are read into lists, so the dataset is the same as if loaded from
+    its json (e.g. the labels can be edited, as dataset_playback does).
+    """
+    dataset_folder = str(dataset_folder).rstrip('/')
+
+    def loadArray(node):
+        if '__npy__' in node and len(node) == 1:
+            if memory_map:
+                return np.load(dataset_folder + '/' + node['__npy__'], mmap_mode='r')
+            return np.load(dataset_folder + '/' + node['__npy__']).tolist()
+        return node
+
+    f = open(dataset_folder + '/' + binary_dataset_json, 'r')
+    dataset = json.load(f, object_hook=loadArray)
+    f.close()
+
+    return dataset
+
+
+# -------------------------------------------------------------------------------
+# --- DATASET JOURNAL
+# -------------------------------------------------------------------------------
+# A journal is a dataset written incrementally, one collection at a time. It is made of:
+#   - a journal file with suffix '.journal' (in the dataset folder, used in place of the json file of the dataset).
+#     Its first line, the header, has all the fields of the dataset except the collections (and the transforms_initial
+#     of the patterns, which are kept with the collections). It is written once. Each of the next lines is a record
+#     {"add": <collection key>, "fragment": <fragment file>} or {"remove": <collection key>}, appended to the file
+#     when a collection is added or removed.
+#   - the fragments, <journal name>_fragments/<collection key>.json, one per collection, with the collection and the
+#     transforms_initial of the patterns for that collection. A fragment is never changed while it is in the journal,
+#     and it is deleted when its collection is removed.
+# Adding a collection writes its fragment and appends one line, instead of writing the whole dataset. Fragments are
+# written to a temporary file and renamed, and a record is appended only after its fragment is written, so a crash
+# never leaves a partially written collection in the journal (a partially appended last line is ignored on load).
+# Use convert_atom_dataset_format to compact a journal to a single json file.
+journal_suffix = '.journal'
+
+
+def isJournalFile(filename):
+    """ Returns True if the filename is (or should be saved as) a dataset journal. """
+    return str(filename).endswith(journal_suffix)
+
+
+def writeFileAtomically(filename, text):
+    temporary_file = filename + '.tmp'
+    with open(temporary_file, 'w') as f:
+        f.write(text)
+    os.replace(temporary_file, filename)
+
+
+def joinJSONTexts(texts):
+    """
+    Joins the json texts of the values of a dictionary into the json text of the dictionary, the same as
+    json.dumps(dictionary, indent=2, sort_keys=True) would give, without encoding the values again.
+    :param texts: a dictionary with string keys and values the texts from json.dumps(value, indent=2, sort_keys=True)
+    :return: the json text of the dictionary.
+    """
+    if not texts:
+        return '{}'
+    return '{\n' + ',\n'.join(['  ' + json.dumps(key) + ': ' + texts[key].replace('\n', '\n  ')
+                                for key in sorted(texts.keys())]) + '\n}'
+
+
+def getJournalFragmentsFolder(journal_file):
+    return os.path.splitext(journal_file)[0] + '_fragments'
+
+
+def getJournalFragmentFile(journal_file, collection_key):
+    """ The fragment file of a collection, relative to the folder of the journal. """
+    return os.path.basename(getJournalFragmentsFolder(journal_file)) + '/' + str(collection_key) + '.json'
+
+
+def getJournalHeader(data):
+    """ Gets the fields of a dataset which are written in the header of a journal: all except the collections and the
+    transforms_initial of the patterns. """
+    D = filterJSONData({key: item for key, item in data.items() if key != 'collections'})
+    for pattern in D.get('patterns', {}).values():
+        pattern.pop('transforms_initial', None)
+    return D
+
+
+def writeJournalHeader(journal_file, data):
+    """ Creates a journal without collections, with the header from the data. An existing journal is replaced. """
+    writeFileAtomically(journal_file, json.dumps(getJournalHeader(data), sort_keys=True, cls=NpEncoder) + '\n')
+
+
+def getJournalFragmentTexts(data, collection_key):
+    """
+    Encodes the fragment of a collection of a journal.
+    :return: a dictionary with the json texts of the collection and of the transforms_initial of the patterns for the
+    collection. Use joinJSONTexts to get the text of the fragment.
+    """
+    transforms_initial = {pattern_key: pattern['transforms_initial'][collection_key]
+                          for pattern_key, pattern in data.get('patterns', {}).items()
+                          if collection_key in pattern.get('transforms_initial', {})}
+    return {'collection': json.dumps(filterJSONData(data['collections'][collection_key]), indent=2, sort_keys=True,
+                                     cls=NpEncoder),
+            'transforms_initial': json.dumps(transforms_initial, indent=2, sort_keys=True, cls=NpEncoder)}
+
+
+def appendJournalRecords(journal_file, records):
+    with open(journal_file, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        text = '' if f.read(1) == b'\n' else '\n'  # start a new line after a partially written record, if any
+        text += ''.join([json.dumps(record, sort_keys=True) + '\n' for record in records])
+        f.write(text.encode())
+
+
+def readJournal(journal_file):
+    """
+    Reads a journal.
+    :return: the header and a dictionary with key the collection key and value the fragment file, relative to the
+    folder of the journal.
+    """
+    with open(journal_file, 'r') as f:
+        lines = f.read().split('\n')
+
+    header = json.loads(lines[0])
+    fragments = {}
+    for line in lines[1:]:
+        if line == '':
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError:  # the last record, if a crash happened while it was appended
+            print(Fore.YELLOW + 'Ignoring a partially written record of journal ' + str(journal_file) + '.' +
+                  Style.RESET_ALL)
+            continue
+
+        if 'add' in record:
+            fragments[record['add']] = record['fragment']
+        elif 'remove' in record:
+            fragments.pop(record['remove'], None)
+
+    return header, fragments
+
+
+def appendCollectionToJournal(journal_file, data, collection_key, texts=None):
+    """
+    Adds a collection to a journal, writing its fragment and appending a record to the journal file. The other
+    collections are not written again. If the journal does not exist, it is created with the header from the data.
+    :param journal_file: the journal file.
+    :param data: the dataset.
+    :param collection_key: the key of the collection to add.
+    :param texts: the texts of the fragment, from getJournalFragmentTexts. Computed if not given.
+    :return: the texts of the fragment.
+    """
+    if not os.path.isfile(journal_file):
+        writeJournalHeader(journal_file, data)
+
+    fragment_file = getJournalFragmentFile(journal_file, collection_key)
+    filename = os.path.join(os.path.dirname(journal_file), fragment_file)
+    if os.path.exists(filename):
+        raise ValueError('Collection ' + str(collection_key) + ' already exists in journal ' + journal_file + '.')
+
+    if texts is None:
+        texts = getJournalFragmentTexts(data, collection_key)
+
+    os.makedirs(getJournalFragmentsFolder(journal_file), exist_ok=True)
+    writeFileAtomically(filename, joinJSONTexts(texts))
+    appendJournalRecords(journal_file, [{'add': str(collection_key), 'fragment': fragment_file}])
+    return texts
+
+
+def removeCollectionFromJournal(journal_file, collection_key):
+    """ Removes a collection from a journal, appending a record to the journal file and deleting its fragment. """
+    appendJournalRecords(journal_file, [{'remove': str(collection_key)}])
+
+    filename = os.path.join(os.path.dirname(journal_file), getJournalFragmentFile(journal_file, collection_key))
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def createJournalFile(journal_file, data):
+    """ Creates a journal with all the collections of the dataset, replacing the existing one, if any. """
+    fragments_folder = getJournalFragmentsFolder(journal_file)
+    if os.path.isdir(fragments_folder):
+        for filename in os.listdir(fragments_folder):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(fragments_folder, filename))
+
+    writeJournalHeader(journal_file, data)
+    for collection_key in data['collections']:
+        appendCollectionToJournal(journal_file, data, collection_key)
+    print('Saved journal to ' + str(journal_file) + ' (' + str(len(data['collections'])) + ' collections).')
+
+
+def loadJournalFile(journal_file):
+    """ Loads a journal, merging the fragments of the collections into the dataset. """
+    dataset, fragments = readJournal(journal_file)
+
+    dataset['collections'] = {}
+    for pattern in dataset.get('patterns', {}).values():
+        pattern['transforms_initial'] = {}
+
+    for collection_key, fragment_file in fragments.items():
+        f = open(os.path.join(os.path.dirname(journal_file), fragment_file), 'r')
+        fragment = json.load(f)
+        f.close()
+
+        dataset['collections'][collection_key] = fragment['collection']
+        for pattern_key, transform in fragment['transforms_initial'].items():
+            dataset['patterns'][pattern_key]['transforms_initial'][collection_key] = transform
+
+    return dataset
+
+
 def is_jsonable(x):
     try:
         json.dumps(x)
@@ -426,19 +993,6 @@ def is_jsonable(x):
         return False
 
 
-def walk(node):
-    for key, item in node.items():
-        if isinstance(item, dict):
-            walk(item)
-        else:
-            if isinstance(item, np.ndarray) and key == 'data':  # to avoid saving images in the json
-                del node[key]
-
-            elif isinstance(item, np.ndarray):
-                node[key] = item.tolist()
-            pass
-
-
 def write_pcd(filename, pointcloud, mode='binary'):
     """
     This is meant to replace the old write_pcd from Andre which broke when migrating to python3.
@@ -447,21 +1001,15 @@ def write_pcd(filename, pointcloud, mode='binary'):
     :return:
     """
 
-    print('Reading point cloud from ' + Fore.BLUE + filename + Style.RESET_ALL)
+    print('Writing point cloud to ' + Fore.BLUE + filename + Style.RESET_ALL)
 
     # Convert to flattened (height=1) before saving to pcd, because pypcd cannot save non flattened pointclouds to pcd.
     # https://github.com/lardemua/atom/issues/520
     pc_np = numpyFromPointCloudMsg(pointcloud)
-    points = []  # Build a list of points.
-    for idx in range(0, pc_np.shape[0]):
-        points.append([pc_np[idx, 0], pc_np[idx, 1], pc_np[idx, 2]])
-
-    fields = [PointField('x', 0, PointField.FLOAT32, 1),
-              PointField('y', 4, PointField.FLOAT32, 1),
-              PointField('z', 8, PointField.FLOAT32, 1)]
-    flattened_point_cloud = pc2.create_cloud(pointcloud.header, fields, points)
+    points = np.empty((pc_np.shape[0],), dtype=[('x', np.float32), ('y', np.float32), ('z', np.float32)])
+    points['x'], points['y'], points['z'] = pc_np[:, 0], pc_np[:, 1], pc_np[:, 2]
 
-    pc = pypcd.PointCloud.from_msg(flattened_point_cloud)
+    pc = pypcd.PointCloud.from_array(points)
     pc.save_pcd(filename, compression=mode)
 
 
@@ -98,6 +98,31 @@ def rodriguesToMatrix(r):
     return matrix[0]
 
 
+def skewSymmetricMatrix(v):
+    return np.array([[0.0, -v[2], v[1]],
+                     [v[2], 0.0, -v[0]],
+                     [-v[1], v[0], 0.0]], dtype=float)
+
+
+def rodriguesToMatrixDerivatives(r):
+    """Return the derivatives of the rotation matrix of a Rodrigues vector w.r.t. each component of the vector.
+    Uses the closed form from Gallego and Yezzi, "A compact formula for the derivative of a 3-D rotation in
+    exponential coordinates", 2015.
+
+    :param r: the Rodrigues vector (r1, r2, r3)
+    :return: an array of shape (3, 3, 3), where element i is the 3x3 derivative dR/dri
+    """
+    v = np.array(r, dtype=float).reshape(3)
+    theta_squared = np.dot(v, v)
+    if theta_squared < 1e-16:  # near the identity the derivatives are the generators of so(3)
+        return np.array([skewSymmetricMatrix(e) for e in np.eye(3)])
+
+    R = rodriguesToMatrix(v)
+    identity_minus_R = np.eye(3) - R
+    return np.array([np.dot(v[i] * skewSymmetricMatrix(v) + skewSymmetricMatrix(np.cross(v, identity_minus_R[:, i])),
+                            R) / theta_squared for i in range(3)])
+
+
 def traslationRodriguesToTransform(translation, rodrigues):
     R = rodriguesToMatrix(rodrigues)
     T = np.zeros((4, 4), dtype=float)
@@ -137,3 +162,58 @@ def quaternionMatrix(quaternion):
         (q[0, 2]-q[1, 3],     q[1, 2]+q[0, 3], 1.0-q[0, 0]-q[1, 1], 0.0),
         (0.0,                 0.0,                 0.0, 1.0)
     ), dtype=np.float64)
+
+
+def quaternionMatrices(quaternions):
+    """Return stacked homogeneous rotation matrices from stacked quaternions (x, y, z, w), as in quaternionMatrix.
+
+    :param quaternions: an array (N x 4) of quaternions
+    :return: an array (N x 4 x 4) of homogeneous rotation matrices
+    """
+    _EPS = np.finfo(float).eps * 4.0
+
+    q_ = np.array(quaternions, dtype=np.float64).reshape((-1, 4))
+    nq = np.sum(q_ * q_, axis=1)
+    valid = nq >= _EPS
+    q_[valid] *= np.sqrt(2.0 / nq[valid])[:, np.newaxis]
+    q_[~valid] = 0.0  # null quaternions give the identity, as in quaternionMatrix
+    q = q_[:, :, np.newaxis] * q_[:, np.newaxis, :]  # stacked outer products
+
+    matrices = np.zeros((q_.shape[0], 4, 4), dtype=np.float64)
+    matrices[:, 0, 0] = 1.0 - q[:, 1, 1] - q[:, 2, 2]
+    matrices[:, 0, 1] = q[:, 0, 1] - q[:, 2, 3]
+    matrices[:, 0, 2] = q[:, 0, 2] + q[:, 1, 3]
+    matrices[:, 1, 0] = q[:, 0, 1] + q[:, 2, 3]
+    matrices[:, 1, 1] = 1.0 - q[:, 0, 0] - q[:, 2, 2]
+    matrices[:, 1, 2] = q[:, 1, 2] - q[:, 0, 3]
+    matrices[:, 2, 0] = q[:, 0, 2] - q[:, 1, 3]
+    matrices[:, 2, 1] = q[:, 1, 2] + q[:, 0, 3]
+    matrices[:, 2, 2] = 1.0 - q[:, 0, 0] - q[:, 1, 1]
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+
+def translationsQuaternionsToTransforms(translations, quaternions):
+    """Return stacked homogeneous transforms from stacked translations and quaternions (x, y, z, w).
+
+    :param translations: an array (N x 3) of translations
+    :param quaternions: an array (N x 4) of quaternions
+    :return: an array (N x 4 x 4) of homogeneous transforms
+    """
+    transforms = quaternionMatrices(quaternions)
+    transforms[:, 0:3, 3] = np.array(translations, dtype=np.float64).reshape((-1, 3))
+    return transforms
+
+
+def invertRigidTransforms(transforms):
+    """Return the inverses of stacked rigid homogeneous transforms, computed in closed form, i.e. [R^T, -R^T t].
+
+    :param transforms: an array (N x 4 x 4) of rigid homogeneous transforms
+    :return: an array (N x 4 x 4) of the inverse transforms
+    """
+    rotations_transposed = np.transpose(transforms[:, 0:3, 0:3], (0, 2, 1))
+    inverses = np.zeros_like(transforms)
+    inverses[:, 0:3, 0:3] = rotations_transposed
+    inverses[:, 0:3, 3] = -np.einsum('nij,nj->ni', rotations_transposed, transforms[:, 0:3, 3])
+    inverses[:, 3, 3] = 1.0
+    return inverses
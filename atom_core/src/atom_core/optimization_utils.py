@@ -15,7 +15,7 @@ from colorama import Fore, Style
 from pytictoc import TicToc
 from numpy import inf
 from scipy.optimize import least_squares
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 from atom_core.key_press_manager import WindowManager
 
 # ------------------------
@@ -77,15 +77,18 @@ class Optimizer:
         self.data_models = {}  # a dict with a set of variables or structures to be used by the objective function
         # groups of params an ordered dict where key={name} and value = namedtuple('ParamT')
         self.groups = OrderedDict()
+        self.param_columns = {}  # a dict where key={param name} and value = column of the param in the x vector
 
         self.x = []  # a list of floats (the actual parameters)
         self.x0 = []  # the initial value of the parameters
         self.xf = []  # the final value of the parameters
 
         self.residuals = OrderedDict()  # ordered dict: key={residual} value = [params that influence this residual]
+        self.residual_columns = []  # blocks of consecutive residuals, as tuples (number of residuals, param columns)
         self.sparse_matrix = None
         self.result = None  # to contain the optimization result
         self.objective_function = None  # to contain the objective function
+        self.jacobian_function = None  # to contain the (optional) analytic jacobian of the objective function
         # self.visualization_function = None
         self.first_call_of_objective_function = True
 
@@ -141,6 +144,7 @@ class Optimizer:
         idx = [len(self.x)]
         self.groups[group_name] = ParamT(param_names, idx, data_key, getter, setter, [bound_max],
                                          [bound_min])  # add to group dict
+        self.param_columns.update(zip(param_names, idx))
         self.x.append(value[0])  # set initial value in x using the value from the data model
         # print('Pushed scalar param ' + group_name + ' to group ' + group_name)
 
@@ -179,6 +183,7 @@ class Optimizer:
 
         self.groups[group_name] = ParamT(param_names, idxs, data_key, getter, setter, bound_max,
                                          bound_min)  # add to params dict
+        self.param_columns.update(zip(param_names, idxs))
         values = getter(self.data_models[data_key])
         for value in values:
             self.x.append(value)  # set initial value in x
@@ -230,6 +235,7 @@ class Optimizer:
 
         self.groups[group_name] = ParamT(param_names, idxs, data_key, getter, setter, bound_max,
                                          bound_min)  # add to params dict
+        self.param_columns.update(zip(param_names, idxs))
         values = getter(self.data_models[data_key])
         for value in values:
             self.x.append(value)  # set initial value in x
@@ -243,14 +249,39 @@ class Optimizer:
         :type params: list
         """
 
+        if str(name) in self.residuals:  # Cannot add a residual that already exists
+            raise ValueError('Residual ' + str(name) + ' already exists. Cannot add it.')
+
         # Check if all listed params exist in the self.params
-        existing_params = self.getParameters()
         for param in params:
-            if param not in existing_params:
+            if param not in self.param_columns:
                 raise ValueError('Cannot push residual ' + name + ' because given dependency parameter ' + param +
                                  ' has not been configured. Did you push this parameter?')
 
         self.residuals[str(name)] = params
+        self.residual_columns.append((1, np.unique([self.param_columns[param] for param in params]).astype(int)))
+
+    def pushResiduals(self, names, columns):
+        """Adds a block of new residuals, all influenced by the same parameters, to the existing list of residuals
+
+        :param names: names of the residuals
+        :type names: list
+        :param columns: columns (in the x vector) of the parameters which affect these residuals, e.g. obtained with
+        getParamColumns
+        :type columns: numpy array
+        """
+        columns = np.unique(np.asarray(columns, dtype=int))  # sorted and without repetitions
+        if columns.size > 0 and (columns[0] < 0 or columns[-1] >= len(self.x)):
+            raise ValueError('Cannot push residuals ' + str(list(names)) + ' because given dependency columns ' +
+                             str(columns) + ' are not in the parameter vector. Did you push these parameters?')
+
+        param_names = self.getParameters()
+        params = [param_names[column] for column in columns]  # shared by all residuals in the block
+        for name in names:
+            if str(name) in self.residuals:  # Cannot add a residual that already exists
+                raise ValueError('Residual ' + str(name) + ' already exists. Cannot add it.')
+            self.residuals[str(name)] = params
+        self.residual_columns.append((len(names), columns))
 
     def setObjectiveFunction(self, handle):
         # type: (function) -> object
@@ -260,6 +291,15 @@ class Optimizer:
         """
         self.objective_function = handle
 
+    def setJacobianFunction(self, handle):
+        """Provide a pointer to a function which computes the jacobian of the residuals analytically. If not given, the
+        jacobian is estimated by finite differences using the sparsity pattern of the sparse matrix.
+
+        :param handle: the function handle. Receives the data models and returns a (number of residuals x number of
+        parameters) matrix, which may be sparse
+        """
+        self.jacobian_function = handle
+
     def setInternalVisualization(self, internal_visualization):
         self.internal_visualization = internal_visualization
 
@@ -345,9 +385,32 @@ class Optimizer:
 
         return errors
 
+    def internalJacobianFunction(self, x):
+        """ A wrapper around the custom given jacobian function which maps the x vector to the model before calling the
+        jacobian function
+
+        :param x: the parameters vector
+        """
+        self.x = x  # setup x parameters.
+        self.fromXToData()  # Copy from parameters to data models.
+        return self.jacobian_function(self.data_models)
+
+    def getJacobianOptions(self):
+        """ Gets the jacobian related options for the least squares scipy function: the analytic jacobian, if a
+        jacobian function was given, or the sparsity pattern for the finite differences otherwise. """
+        if self.jacobian_function is None:
+            return {'jac_sparsity': self.sparse_matrix}
+        else:
+            return {'jac': self.internalJacobianFunction}
+
     def errorDictToList(self, errors):
 
-        if type(errors) is list:
+        if type(errors) is np.ndarray:  # residuals already ordered as configured, no conversion needed
+            if not errors.shape == (len(self.residuals),):
+                raise ValueError('Objective function returned an array of shape ' + str(errors.shape) +
+                                 ' but there are ' + str(len(self.residuals)) + ' residuals configured.')
+            error_list = errors
+        elif type(errors) is list:
             error_list = errors
         elif type(errors) is dict:
             error_dict = errors
@@ -427,8 +490,8 @@ class Optimizer:
         # Call optimization function (finally!)
         print("Starting optimization ...")
         self.tictoc.tic()
-        self.result = least_squares(self.internalObjectiveFunction, self.x, verbose=2, jac_sparsity=self.sparse_matrix,
-                                    bounds=(bounds_min, bounds_max), method='trf', args=(), **optimization_options)
+        self.result = least_squares(self.internalObjectiveFunction, self.x, verbose=2, bounds=(bounds_min, bounds_max),
+                                    method='trf', args=(), **self.getJacobianOptions(), **optimization_options)
 
         self.xf = deepcopy(list(self.result.x))  # Store final x values
         self.fromXToData(self.xf)
@@ -443,8 +506,8 @@ class Optimizer:
         self.data_models['status']['num_function_calls'] = 0
         x_backup = deepcopy(self.x)  # store a copy of the original parameter values
 
-        _ = least_squares(self.internalObjectiveFunction, self.x, verbose=0, jac_sparsity=self.sparse_matrix,
-                          method='trf', args=(), **optimization_options_tmp)
+        _ = least_squares(self.internalObjectiveFunction, self.x, verbose=0, method='trf', args=(),
+                          **self.getJacobianOptions(), **optimization_options_tmp)
 
         # Store number of function calls per iteration
         self.data_models['status']['num_function_calls_per_iteration'] = \
@@ -496,6 +559,16 @@ class Optimizer:
             params.extend(group.param_names)
         return params
 
+    def getParamColumns(self, group_name):
+        """ Gets the columns (in the x vector) of the parameters of a group
+
+        :param group_name: the name of the group of parameters
+        :return: a numpy array with the columns.
+        """
+        if group_name not in self.groups:
+            raise ValueError('Group ' + group_name + ' does not exist.')
+        return np.array(self.groups[group_name].idx, dtype=int)
+
     def getParamsContainingPattern(self, pattern):
         params = []
         for group_name, group in self.groups.items():
@@ -536,15 +609,18 @@ class Optimizer:
         """ Computes the sparse matrix given the parameters and the residuals. Should be called only after setting both.
 
         """
-        params = self.getParameters()
-        self.sparse_matrix = lil_matrix((len(self.residuals), len(params)), dtype=int)
-
-        for i, key in enumerate(self.residuals):
-            for group_name, group in self.groups.items():
-                for j, param in enumerate(group.param_names):
-                    if param in self.residuals[key]:
-                        idx = group.idx[j]
-                        self.sparse_matrix[i, idx] = 1
+        # Rows and columns of the non zero elements, assembled block by block
+        rows, columns = [], []
+        row = 0
+        for number_of_residuals, block_columns in self.residual_columns:
+            rows.append(np.repeat(np.arange(row, row + number_of_residuals), block_columns.size))
+            columns.append(np.tile(block_columns, number_of_residuals))
+            row += number_of_residuals
+
+        rows = np.concatenate(rows) if rows else np.zeros((0,), dtype=int)
+        columns = np.concatenate(columns) if columns else np.zeros((0,), dtype=int)
+        self.sparse_matrix = csr_matrix((np.ones(rows.shape, dtype=int), (rows, columns)),
+                                        shape=(len(self.residuals), len(self.x)))
 
     # ---------------------------
     # Print and display
@@ -24,10 +24,17 @@ Read and write PCL .pcd files in python.
 dimatura@cmu.edu, 2013
 """
 
+import io
 import re
 import struct
 import copy
 import numpy as np
+from numpy.lib.recfunctions import repack_fields
+
+try:  # binary_compressed pcd files are compressed with lzf (pip install python-lzf)
+    import lzf
+except ImportError:
+    lzf = None
 
 from sensor_msgs.msg import PointField
 from sensor_msgs.msg import PointCloud2
@@ -191,14 +198,14 @@ def pointcloud2_to_dtype(cloud_msg):
 def pointcloud2_to_array(cloud_msg, split_rgb=False, remove_padding=True):
     ''' Converts a rospy PointCloud2 message to a numpy recordarray
     Reshapes the returned array to have shape (height, width), even if the height is 1.
-    The reason for using np.fromstring rather than struct.unpack is speed... especially
+    The reason for using np.frombuffer rather than struct.unpack is speed... especially
     for large point clouds, this will be <much> faster.
     '''
     # construct a numpy record type equivalent to the point type of this cloud
     dtype_list = pointcloud2_to_dtype(cloud_msg)
 
     # parse the cloud into an array
-    cloud_arr = np.fromstring(cloud_msg.data, dtype_list)
+    cloud_arr = np.frombuffer(cloud_msg.data, dtype_list)
 
     # remove the dummy fields that were added
     if remove_padding:
@@ -233,7 +240,7 @@ def array_to_pointcloud2(cloud_arr, stamp=None, frame_id=None, merge_rgb=False):
     cloud_msg.point_step = cloud_arr.dtype.itemsize
     cloud_msg.row_step = cloud_msg.point_step * cloud_arr.shape[1]
     cloud_msg.is_dense = all([np.isfinite(cloud_arr[fname]).all() for fname in cloud_arr.dtype.names])
-    cloud_msg.data = cloud_arr.tostring()
+    cloud_msg.data = cloud_arr.tobytes()
     return cloud_msg
 
 
@@ -367,37 +374,89 @@ def _build_dtype(metadata):
     return dtype
 
 
+def parse_ascii_pc_data(f, dtype, metadata):
+    return np.loadtxt(f, dtype=dtype, ndmin=1)
+
+
 def parse_binary_pc_data(f, dtype, metadata):
-    rowstep = metadata['points'] * dtype.itemsize
-    # for some reason pcl adds empty space at the end of files
-    buf = f.read(rowstep)
-    return np.fromstring(buf, dtype=dtype)
+    # read straight into the array, without an intermediate buffer. Only the points are read, because for some reason
+    # pcl adds empty space at the end of files
+    pc_data = np.empty((metadata['points'],), dtype=dtype)
+    if f.readinto(pc_data.view(np.uint8)) != pc_data.nbytes:
+        raise ValueError('Unexpected end of file while reading the pcd data.')
+    return pc_data
 
 
-def point_cloud_from_fileobj(f):
-    """ parse pointcloud coming from file object f
+def parse_binary_compressed_pc_data(f, dtype, metadata):
+    """ binary_compressed data is a header with the compressed and uncompressed sizes (uint32), followed by the lzf
+    compressed data, in which the values of each field are stored contiguously (column major).
+    """
+    if lzf is None:
+        raise ValueError('Reading binary_compressed pcd files requires the lzf module (pip install python-lzf).')
+
+    compressed_size, uncompressed_size = struct.unpack('II', f.read(struct.calcsize('II')))
+    buf = lzf.decompress(f.read(compressed_size), uncompressed_size)
+    if buf is None or len(buf) != uncompressed_size:
+        raise ValueError('Error decompressing binary_compressed pcd data.')
+
+    pc_data = np.empty((metadata['points'],), dtype=dtype)
+    offset = 0
+    for name in dtype.names:
+        field_dtype = dtype.fields[name][0]
+        size = field_dtype.itemsize * pc_data.shape[0]
+        pc_data[name] = np.frombuffer(buf, dtype=field_dtype, count=pc_data.shape[0], offset=offset)
+        offset += size
+    return pc_data
+
+
+def read_header(f):
+    """ reads the header of a pcd file up to the DATA line, leaving f at the start of the data.
     """
     header = []
     while True:
-        ln = f.readline().strip()
+        ln = f.readline()
+        if not ln:
+            raise ValueError('Unexpected end of file while reading the pcd header.')
+        ln = ln.strip()
         if not isinstance(ln, str):
             ln = ln.decode('utf-8')
         header.append(ln)
         if ln.startswith('DATA'):
-            metadata = parse_header(header)
-            dtype = _build_dtype(metadata)
-            break
+            return parse_header(header)
+
 
-    pc_data = parse_binary_pc_data(f, dtype, metadata)
+def point_cloud_from_fileobj(f):
+    """ parse pointcloud coming from file object f
+    """
+    metadata = read_header(f)
+    dtype = _build_dtype(metadata)
+
+    if metadata['data'] == 'ascii':
+        pc_data = parse_ascii_pc_data(f, dtype, metadata)
+    elif metadata['data'] == 'binary':
+        pc_data = parse_binary_pc_data(f, dtype, metadata)
+    elif metadata['data'] == 'binary_compressed':
+        pc_data = parse_binary_compressed_pc_data(f, dtype, metadata)
+    else:
+        raise ValueError('Unknown pcd data type ' + str(metadata['data']) + '.')
     return PointCloud(metadata, pc_data)
 
 
-def point_cloud_from_path(fname):
-    """ load point cloud in binary format
+def point_cloud_from_path(fname, mmap=True):
+    """ load point cloud from a pcd file.
+    binary files are memory mapped (copy on write) if mmap is True, so the points are read from disk only when
+    accessed and changes to them are not written to the file.
     """
     with open(fname, 'rb') as f:
-        pc = point_cloud_from_fileobj(f)
-    return pc
+        metadata = read_header(f)
+        if not (mmap and metadata['data'] == 'binary'):
+            f.seek(0)
+            return point_cloud_from_fileobj(f)
+        offset = f.tell()
+
+    dtype = _build_dtype(metadata)
+    pc_data = np.memmap(fname, dtype=dtype, mode='c', offset=offset, shape=(metadata['points'],))
+    return PointCloud(metadata, pc_data.view(np.ndarray))  # the view keeps the memory map open
 
 
 def point_cloud_to_fileobj(pc, fileobj, data_compression=None):
@@ -412,7 +471,26 @@ def point_cloud_to_fileobj(pc, fileobj, data_compression=None):
 
     header = write_header(metadata).encode('utf-8')
     fileobj.write(header)
-    fileobj.write(pc.pc_data.tostring())
+
+    # the binary data must have only the bytes of the fields, without the padding of the dtype, if any
+    pc_data = repack_fields(np.ascontiguousarray(pc.pc_data))
+    if metadata['data'] == 'ascii':
+        fmt = ['%.10g' if pc_data.dtype.fields[name][0].kind == 'f' else '%d' for name in pc_data.dtype.names]
+        buffer = io.BytesIO()
+        np.savetxt(buffer, pc_data, fmt=' '.join(fmt))
+        fileobj.write(buffer.getvalue())
+    elif metadata['data'] == 'binary':
+        fileobj.write(pc_data.view(np.uint8).data)  # no copy of the points
+    else:  # binary_compressed
+        if lzf is None:
+            raise ValueError('Writing binary_compressed pcd files requires the lzf module (pip install python-lzf).')
+        # the values of each field are stored contiguously before compressing
+        buf = b''.join([np.ascontiguousarray(pc_data[name]).tobytes() for name in pc_data.dtype.names])
+        compressed = lzf.compress(buf)
+        if compressed is None:  # lzf returns None when the data cannot be compressed
+            raise ValueError('Error compressing binary_compressed pcd data.')
+        fileobj.write(struct.pack('II', len(compressed), len(buf)))
+        fileobj.write(compressed)
 
 
 class PointCloud(object):
@@ -463,8 +541,32 @@ class PointCloud(object):
         return array_to_pointcloud2(self.pc_data)
 
     @staticmethod
-    def from_path(fname):
-        return point_cloud_from_path(fname)
+    def from_path(fname, mmap=True):
+        return point_cloud_from_path(fname, mmap)
+
+    @staticmethod
+    def from_array(arr):
+        """ from a numpy structured array, without copying it unless its dtype has padding (e.g. arrays from
+        pointcloud2 messages with unused bytes), which is removed.
+        """
+        pc_data = repack_fields(arr.reshape(-1))
+        md = {'version': .7,
+              'fields': [],
+              'size': [],
+              'count': [],
+              'width': len(pc_data),
+              'height': 1,
+              'viewpoint': [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0],
+              'points': len(pc_data),
+              'type': [],
+              'data': 'binary'}
+        for name in pc_data.dtype.names:
+            t, s = numpy_type_to_pcd_type[pc_data.dtype.fields[name][0]]
+            md['fields'].append(name)
+            md['type'].append(t)
+            md['size'].append(s)
+            md['count'].append(1)
+        return PointCloud(md, pc_data)
 
     @staticmethod
     def from_msg(msg, squeeze=True):
@@ -0,0 +1,169 @@
+"""
+In memory store for the heavy sensor data (images, depth images and point clouds) of a dataset.
+"""
+
+# -------------------------------------------------------------------------------
+# --- IMPORTS
+# -------------------------------------------------------------------------------
+
+# Standard imports
+import threading
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+# ------------------------
+# DATA STRUCTURES   ##
+# ------------------------
+SensorDataT = namedtuple('SensorDataT', 'kind array')
+
+
+# -------------------------------------------------------------------------------
+# --- CLASS
+# -------------------------------------------------------------------------------
+class SensorDataStore:
+    """
+    Keeps the images, depth images and point clouds of a dataset as numpy arrays, with key (collection_key,
+    sensor_key), so that the pixels and points are accessed directly, instead of converting the dictionaries of the
+    dataset to ros messages and then to numpy arrays every time they are needed. Arrays are:
+        - image: a bgr8 image (height x width x 3, uint8)
+        - depth: a depth image in meters (height x width, float32)
+        - point_cloud: a structured array with the fields of the point cloud, e.g. 'x', 'y', 'z'
+
+    The store is kept in the dataset under the key '_sensor_data'. Its data is read only, so copies of the dataset
+    (e.g. copy.deepcopy(dataset)) share the same store.
+
+    Data may also be loaded lazily: instead of the data, a loader function is given, which is called the first time
+    the data is accessed. Lazily loaded data is kept in a least recently used cache of at most max_cached_frames
+    frames, so that memory stays bounded for large datasets.
+
+    Arrays derived from the data of a sensor in a collection, e.g. its labelled points, may also be cached in the store
+    (see getDerived), so that they are computed only once.
+    """
+
+    kinds = ['image', 'depth', 'point_cloud']
+
+    def __init__(self, max_cached_frames=None):
+        self.data = {}  # key=(collection_key, sensor_key) value=SensorDataT
+        self.loaders = {}  # key=(collection_key, sensor_key) value=(kind, loader function)
+        self.cached = OrderedDict()  # lazily loaded data, key=(collection_key, sensor_key) value=SensorDataT
+        self.max_cached_frames = max_cached_frames  # None for no limit
+        self.derived = {}  # key=(collection_key, sensor_key, name) value=array derived from the data
+        self.lock = threading.Lock()  # the cache may be accessed from the visualization threads
+
+    def __contains__(self, key):
+        return key in self.data or key in self.loaders
+
+    def __len__(self):
+        return len(self.data) + len(self.loaders)
+
+    def __deepcopy__(self, memo):
+        return self  # arrays are read only, so they can be shared by copies of the dataset
+
+    def set(self, collection_key, sensor_key, kind, array):
+        """ Adds (or replaces) the data of a sensor in a collection.
+
+        :param collection_key: the collection of the data
+        :param sensor_key: the sensor of the data
+        :param kind: the kind of data, one of 'image', 'depth' or 'point_cloud'
+        :param array: a numpy array with the data
+        """
+        if kind not in self.kinds:
+            raise ValueError('Unknown sensor data kind ' + str(kind) + '. Must be one of ' + str(self.kinds) + '.')
+
+        array.flags.writeable = False  # shared by copies of the dataset, must not be changed in place
+        self.remove(collection_key, sensor_key)
+        self.data[(collection_key, sensor_key)] = SensorDataT(kind, array)
+
+    def setLoader(self, collection_key, sensor_key, kind, loader):
+        """ Adds (or replaces) the data of a sensor in a collection, to be loaded only when it is accessed.
+
+        :param collection_key: the collection of the data
+        :param sensor_key: the sensor of the data
+        :param kind: the kind of data, one of 'image', 'depth' or 'point_cloud'
+        :param loader: a function without arguments which returns a numpy array with the data
+        """
+        if kind not in self.kinds:
+            raise ValueError('Unknown sensor data kind ' + str(kind) + '. Must be one of ' + str(self.kinds) + '.')
+
+        self.remove(collection_key, sensor_key)
+        self.loaders[(collection_key, sensor_key)] = (kind, loader)
+
+    def get(self, collection_key, sensor_key, kind):
+        """ Gets the data of a sensor in a collection, checking that it is of the given kind. """
+        key = (collection_key, sensor_key)
+        if key in self.data:
+            sensor_data = self.data[key]
+        else:
+            sensor_data = self.getCached(key)
+
+        if not sensor_data.kind == kind:
+            raise ValueError('Data of sensor ' + sensor_key + ' in collection ' + collection_key + ' is of kind ' +
+                             sensor_data.kind + ', not ' + kind + '.')
+        return sensor_data.array
+
+    def getCached(self, key):
+        """ Gets lazily loaded data from the cache, loading it if needed and evicting the least recently used. """
+        with self.lock:
+            if key in self.cached:
+                self.cached.move_to_end(key)  # most recently used
+                return self.cached[key]
+
+        kind, loader = self.loaders[key]
+        array = loader()
+        array.flags.writeable = False  # shared by copies of the dataset, must not be changed in place
+        sensor_data = SensorDataT(kind, array)
+
+        with self.lock:
+            self.cached[key] = sensor_data
+            if self.max_cached_frames is not None:
+                while len(self.cached) > self.max_cached_frames:
+                    self.cached.popitem(last=False)  # least recently used
+
+        return sensor_data
+
+    def getDerived(self, collection_key, sensor_key, name, function):
+        """ Gets an array derived from the data of a sensor in a collection, computing it only the first time.
+
+        :param collection_key: the collection of the data
+        :param sensor_key: the sensor of the data
+        :param name: a (hashable) name of the derived array, unique for the sensor in the collection
+        :param function: a function without arguments which returns the derived array
+        """
+        key = (collection_key, sensor_key, name)
+        with self.lock:
+            if key in self.derived:
+                return self.derived[key]
+
+        array = function()
+        array.flags.writeable = False  # shared by copies of the dataset, must not be changed in place
+        with self.lock:
+            self.derived[key] = array
+        return array
+
+    def remove(self, collection_key, sensor_key):
+        key = (collection_key, sensor_key)
+        self.data.pop(key, None)
+        self.loaders.pop(key, None)
+        with self.lock:
+            self.cached.pop(key, None)
+            for derived_key in [k for k in self.derived if k[0:2] == key]:
+                del self.derived[derived_key]
+
+    def setImage(self, collection_key, sensor_key, image):
+        self.set(collection_key, sensor_key, 'image', np.asarray(image, dtype=np.uint8))
+
+    def getImage(self, collection_key, sensor_key):
+        return self.get(collection_key, sensor_key, 'image')
+
+    def setDepthImage(self, collection_key, sensor_key, image):
+        self.set(collection_key, sensor_key, 'depth', np.asarray(image, dtype=np.float32))
+
+    def getDepthImage(self, collection_key, sensor_key):
+        return self.get(collection_key, sensor_key, 'depth')
+
+    def setPointCloud(self, collection_key, sensor_key, cloud):
+        self.set(collection_key, sensor_key, 'point_cloud', np.asarray(cloud).reshape((-1,)))
+
+    def getPointCloud(self, collection_key, sensor_key):
+        return self.get(collection_key, sensor_key, 'point_cloud')
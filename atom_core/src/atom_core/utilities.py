@@ -12,13 +12,13 @@ import subprocess
 from statistics import mean
 from signal import setitimer, signal, SIGALRM, ITIMER_REAL
 
+import numpy as np
 import readchar
 import rospkg
 from colorama import Fore, Style
 from atom_core.system import execute
 
 # 3rd-party
-from rospy_message_converter import message_converter
 from pynput import keyboard
 
 # from open3d import * # This cannot be used. It itereferes with the Image for getMessageTypeFromTopic(topic):
@@ -98,23 +98,14 @@ def create_lambda_with_globals(s):
 
 
 def laser_scan_msg_to_xy(msg):
-    data = message_converter.convert_ros_message_to_dictionary(msg)
+    data = {'ranges': msg.ranges, 'angle_min': msg.angle_min, 'angle_increment': msg.angle_increment}
     return laser_scan_data_to_xy(data)
 
 
 def laser_scan_data_to_xy(data):
-    ranges = data['ranges']
-    angle_min = data['angle_min']
-    angle_increment = data['angle_increment']
-
-    x = []
-    y = []
-    for range_idx, r in enumerate(ranges):
-        theta = angle_min + angle_increment * range_idx
-        x.append(r * math.cos(theta))
-        y.append(r * math.sin(theta))
-
-    return x, y
+    ranges = np.asarray(data['ranges'], dtype=float)
+    thetas = data['angle_min'] + data['angle_increment'] * np.arange(len(ranges))
+    return ranges * np.cos(thetas), ranges * np.sin(thetas)
 
 
 def checkDirectoryExistence(directory, package_name, create_if_nonexistent=False):
@@ -12,18 +12,13 @@ A set of utilities to be used in the optimization algorithms
 import os
 
 import cv2
-import atom_core.ros_numpy
 import open3d as o3d
 import numpy as np
 from numpy.linalg import norm
 
-# ROS imports
-from image_geometry import PinholeCameraModel
-from rospy_message_converter import message_converter
-
 # Atom imports
 from atom_calibration.collect.label_messages import convertDepthImage16UC1to32FC1
-from atom_core.dataset_io import  getPointCloudMessageFromDictionary, read_pcd
+from atom_core.dataset_io import getLabeledPointsFromDataset
 
 # -------------------------------------------------------------------------------
 # --- FUNCTIONS
@@ -81,6 +76,67 @@ def projectToCamera(intrinsic_matrix, distortion, width, height, pts):
     return pixs, valid_pixs, dists
 
 
+def projectToCameraDerivatives(intrinsic_matrix, distortion, pts):
+    """
+    Computes the derivatives of the pixel coordinates produced by projectToCamera
+    :param intrinsic_matrix: 3x3 intrinsic camera matrix
+    :param distortion: should be as follows: (k_1, k_2, p_1, p_2, k_3)
+    :param pts: a list of point coordinates (in the camera frame) with the following format: np array 4xn or 3xn
+    :return: an array nx2x3 with the derivatives of the pixel coordinates w.r.t. the point coordinates, and an array
+    nx2x9 with the derivatives w.r.t. the intrinsics, in the order (fx, fy, cx, cy, k_1, k_2, p_1, p_2, k_3)
+    """
+    _, n_pts = pts.shape
+
+    k1, k2, p1, p2, k3 = np.array(distortion, dtype=float).flatten()
+    fx = intrinsic_matrix[0, 0]
+    fy = intrinsic_matrix[1, 1]
+
+    x = pts[0, :]
+    y = pts[1, :]
+    z = pts[2, :]
+
+    xl = np.divide(x, z)  # compute homogeneous coordinates
+    yl = np.divide(y, z)  # compute homogeneous coordinates
+    r2 = xl ** 2 + yl ** 2  # r square (used multiple times bellow)
+    radial = 1 + k1 * r2 + k2 * r2 ** 2 + k3 * r2 ** 3
+    radial_dr2 = k1 + 2 * k2 * r2 + 3 * k3 * r2 ** 2
+    xll = xl * radial + 2 * p1 * xl * yl + p2 * (r2 + 2 * xl ** 2)
+    yll = yl * radial + p1 * (r2 + 2 * yl ** 2) + 2 * p2 * xl * yl
+
+    # Derivatives of the distorted coordinates w.r.t. the homogeneous coordinates
+    xll_xl = radial + 2 * xl ** 2 * radial_dr2 + 2 * p1 * yl + 6 * p2 * xl
+    xll_yl = 2 * xl * yl * radial_dr2 + 2 * p1 * xl + 2 * p2 * yl
+    yll_xl = xll_yl
+    yll_yl = radial + 2 * yl ** 2 * radial_dr2 + 6 * p1 * yl + 2 * p2 * xl
+
+    # Chain rule with the derivatives of the homogeneous coordinates w.r.t. the point coordinates
+    d_pixs_d_pts = np.zeros((n_pts, 2, 3), dtype=float)
+    d_pixs_d_pts[:, 0, 0] = fx * xll_xl / z
+    d_pixs_d_pts[:, 0, 1] = fx * xll_yl / z
+    d_pixs_d_pts[:, 0, 2] = -fx * (xll_xl * xl + xll_yl * yl) / z
+    d_pixs_d_pts[:, 1, 0] = fy * yll_xl / z
+    d_pixs_d_pts[:, 1, 1] = fy * yll_yl / z
+    d_pixs_d_pts[:, 1, 2] = -fy * (yll_xl * xl + yll_yl * yl) / z
+
+    d_pixs_d_intrinsics = np.zeros((n_pts, 2, 9), dtype=float)
+    d_pixs_d_intrinsics[:, 0, 0] = xll  # fx
+    d_pixs_d_intrinsics[:, 1, 1] = yll  # fy
+    d_pixs_d_intrinsics[:, 0, 2] = 1  # cx
+    d_pixs_d_intrinsics[:, 1, 3] = 1  # cy
+    d_pixs_d_intrinsics[:, 0, 4] = fx * xl * r2  # k1
+    d_pixs_d_intrinsics[:, 1, 4] = fy * yl * r2
+    d_pixs_d_intrinsics[:, 0, 5] = fx * xl * r2 ** 2  # k2
+    d_pixs_d_intrinsics[:, 1, 5] = fy * yl * r2 ** 2
+    d_pixs_d_intrinsics[:, 0, 6] = fx * 2 * xl * yl  # p1
+    d_pixs_d_intrinsics[:, 1, 6] = fy * (r2 + 2 * yl ** 2)
+    d_pixs_d_intrinsics[:, 0, 7] = fx * (r2 + 2 * xl ** 2)  # p2
+    d_pixs_d_intrinsics[:, 1, 7] = fy * 2 * xl * yl
+    d_pixs_d_intrinsics[:, 0, 8] = fx * xl * r2 ** 3  # k3
+    d_pixs_d_intrinsics[:, 1, 8] = fy * yl * r2 ** 3
+
+    return d_pixs_d_pts, d_pixs_d_intrinsics
+
+
 def projectWithoutDistortion(intrinsic_matrix, width, height, pts):
     """
     Projects a list of points to the camera defined transform, intrinsics and distortion
@@ -132,54 +188,48 @@ def convert_from_uvd(cx, cy, fx, fy, xpix, ypix, d):
     y = y_over_z * z
     return x, y, z
 
+def depthIdxsToPoints(image, idxs, camera_info):
+    """
+    Back-projects pixels of a depth image, given by their linear indices, to 3D points in the frame of the depth
+    sensor. All pixels are converted at once, and the ones with nan depth are discarded.
+    :param image: the depth image in meters (height x width)
+    :param idxs: the linear indices of the pixels (y_pix * width + x_pix)
+    :param camera_info: the camera info dictionary of the depth sensor. Uses the projection matrix, as the
+    PinholeCameraModel does.
+    :return: an array (4 x n) with the homogeneous coordinates of the points
+    """
+    P = camera_info['P']
+    f_x, f_y, c_x, c_y = P[0], P[5], P[2], P[6]
+    w = camera_info['width']
+
+    # convert from linear idxs to x_pix and y_pix indices.
+    y_pix, x_pix = np.divmod(np.asarray(idxs, dtype=int).reshape(-1), w)
+
+    # get distance values for these pixel coordinates, ignoring the pixels with nan values
+    distances = image[y_pix, x_pix].astype(float)
+    valid = np.logical_not(np.isnan(distances))
+
+    x, y, z = convert_from_uvd(c_x, c_y, f_x, f_y, x_pix[valid], y_pix[valid], distances[valid])
+    return np.vstack((x, y, z, np.ones(z.shape)))
+
+
 def depthToNPArray(dataset, selected_collection_key, json_file, ss, idxs):
     """
     Convert a depth image to numpy array
     """
     
-    filename = os.path.dirname(json_file) + '/' + \
-                dataset['collections'][selected_collection_key]['data'][ss]['data_file']
+    if '_sensor_data' in dataset and (selected_collection_key, ss) in dataset['_sensor_data']:  # already loaded
+        img = dataset['_sensor_data'].getDepthImage(selected_collection_key, ss)
+    else:
+        filename = os.path.dirname(json_file) + '/' + \
+                    dataset['collections'][selected_collection_key]['data'][ss]['data_file']
 
-    cv_image_int16_tenths_of_millimeters = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
-    
-    img = convertDepthImage16UC1to32FC1(cv_image_int16_tenths_of_millimeters,
-                                        scale=10000.0)
-
-    pinhole_camera_model = PinholeCameraModel()
-    pinhole_camera_model.fromCameraInfo(message_converter.convert_dictionary_to_ros_message(
-        'sensor_msgs/CameraInfo', dataset['sensors'][ss]['camera_info']))
-
-    f_x = pinhole_camera_model.fx()
-    f_y = pinhole_camera_model.fy()
-    c_x = pinhole_camera_model.cx()
-    c_y = pinhole_camera_model.cy()
-    w = pinhole_camera_model.fullResolution()[0]
-
-    # initialize lists
-    xs = []
-    ys = []
-    zs = []
-    for idx in idxs:  # iterate all points
-        # convert from linear idx to x_pix and y_pix indices.
-        y_pix = int(idx / w)
-        x_pix = int(idx - y_pix * w)
-
-        # get distance value for this pixel coordinate
-        distance = img[y_pix, x_pix]
-
-        if np.isnan(distance): # if the value of the pixel is nan, ignore it
-            continue
-
-        # compute 3D point and add to list of coordinates xs, ys, zs
-        x, y, z = convert_from_uvd(c_x, c_y, f_x, f_y, x_pix, y_pix, distance)
-        xs.append(x)
-        ys.append(y)
-        zs.append(z)
-
-    homogeneous = np.ones((len(xs)))
-    points_in_depth = np.array((xs, ys, zs, homogeneous), dtype=float)
+        cv_image_int16_tenths_of_millimeters = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
 
-    return points_in_depth
+        img = convertDepthImage16UC1to32FC1(cv_image_int16_tenths_of_millimeters,
+                                            scale=10000.0)
+
+    return depthIdxsToPoints(img, idxs, dataset['sensors'][ss]['camera_info'])
 
 
 def depthToImage(dataset, selected_collection_key, json_file, pattern_key, ss, ts, tf):
@@ -221,46 +271,34 @@ def depthInImage(dataset, selected_collection_key, pattern_key, ss):
     """
 
     idxs = dataset['collections'][selected_collection_key]['labels'][pattern_key][ss]['idxs_limit_points']
-    pinhole_camera_model = PinholeCameraModel()
-    pinhole_camera_model.fromCameraInfo(message_converter.convert_dictionary_to_ros_message(
-        'sensor_msgs/CameraInfo', dataset['sensors'][ss]['camera_info']))
-    w = pinhole_camera_model.fullResolution()[0]
-
-    # initialize lists
-    xs = []
-    ys = []
-    for idx in idxs:  # iterate all points
-        # convert from linear idx to x_pix and y_pix indices.
-        y_pix = int(idx / w)
-        x_pix = int(idx - y_pix * w)
-        xs.append(x_pix)
-        ys.append(y_pix)
-
-    points_in_depth = np.array((xs, ys), dtype=float)
-    return points_in_depth
+    w = dataset['sensors'][ss]['camera_info']['width']
 
+    # convert from linear idxs to x_pix and y_pix indices.
+    y_pix, x_pix = np.divmod(np.asarray(idxs, dtype=int).reshape(-1), w)
 
-def rangeToImage(mixed_dataset, collection, json_file, pattern_key, ss, ts, tf):
-    filename = os.path.dirname(json_file) + '/' + collection['data'][ss]['data_file']
-    msg = read_pcd(filename)
-    collection['data'][ss].update(message_converter.convert_ros_message_to_dictionary(msg))
-
-    cloud_msg = getPointCloudMessageFromDictionary(collection['data'][ss])
-    idxs = collection['labels'][pattern_key][ss]['idxs_limit_points']
+    points_in_depth = np.array((x_pix, y_pix), dtype=float)
+    return points_in_depth
 
-    pc = atom_core.ros_numpy.numpify(cloud_msg)[idxs]
-    points_in_vel = np.zeros((4, pc.shape[0]))
-    points_in_vel[0, :] = pc['x']
-    points_in_vel[1, :] = pc['y']
-    points_in_vel[2, :] = pc['z']
-    points_in_vel[3, :] = 1
 
+def rangeToImage(dataset, collection_key, pattern_key, ss, ts, tf):
+    """
+    Projects the limit points of the pattern detected by a lidar to the image of a camera (rgb or depth).
+    :param dataset: the dataset, with the point clouds loaded.
+    :param collection_key: the collection.
+    :param pattern_key: the pattern.
+    :param ss: the lidar (source sensor).
+    :param ts: the camera (target sensor).
+    :param tf: the transformation from the lidar to the camera.
+    :return: an array (2 x n) with the coordinates of the points in the image.
+    """
+    points_in_vel = getLabeledPointsFromDataset(dataset, collection_key, pattern_key, ss, 'idxs_limit_points')
     points_in_cam = np.dot(tf, points_in_vel)
 
     # -- Project them to the image
+    collection = dataset['collections'][collection_key]
     w, h = collection['data'][ts]['width'], collection['data'][ts]['height']
-    K = np.ndarray((3, 3), buffer=np.array(mixed_dataset['sensors'][ts]['camera_info']['K']), dtype=float)
-    D = np.ndarray((5, 1), buffer=np.array(mixed_dataset['sensors'][ts]['camera_info']['D']), dtype=float)
+    K = np.ndarray((3, 3), buffer=np.array(dataset['sensors'][ts]['camera_info']['K']), dtype=float)
+    D = np.ndarray((5, 1), buffer=np.array(dataset['sensors'][ts]['camera_info']['D']), dtype=float)
 
     lidar_pts_in_img, _, _ = projectToCamera(K, D, w, h, points_in_cam[0:3, :])
 
@@ -1,5 +1,6 @@
 # Standard imports
 import os
+import tempfile
 from datetime import datetime
 from colorama import Fore, Style
 from copy import deepcopy
@@ -19,18 +20,25 @@ from atom_core.naming import generateKey
 
 def readXacroFile(description_file):
     # xml_robot = URDF.from_parameter_server()
-    urdf_file = '/tmp/description.urdf'
+    # A temp urdf file of its own, so that several processes (e.g. parallel batch jobs) may read descriptions at once
+    file_descriptor, urdf_file = tempfile.mkstemp(prefix='description_', suffix='.urdf')
+    os.close(file_descriptor)
     # print('Parsing description file ' + description_file)
     execute('xacro ' + description_file + ' -o ' + urdf_file, verbose=False)  # create a temp urdf file
     try:
         xml_robot = URDF.from_xml_file(urdf_file)  # read teh urdf file
     except:
         raise ValueError('Could not parse description file ' + description_file)
+    finally:
+        os.remove(urdf_file)
 
     return xml_robot
 
 
-def saveResultsXacro(dataset, selected_collection_key, transforms_list):
+def saveResultsXacro(dataset, selected_collection_key, transforms_list, output_file=None):
+    # If output_file is given, the optimized xacro is saved only to it (and the one with patterns next to it), instead
+    # of to the urdf folder of the calibration package, so that several runs (e.g. parallel batch jobs) do not
+    # overwrite each other's results
     # Cycle all sensors in calibration config, and for each replace the optimized transform in the original xacro
     # Parse xacro description file
     description_file, _, _ = uriReader(dataset["calibration_config"]["description_file"])
@@ -88,26 +96,38 @@ def saveResultsXacro(dataset, selected_collection_key, transforms_list):
 
 
 
-    time = datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")
-    file_name = "optimized_" + time + ".urdf.xacro"
+    package_name = dataset["_metadata"]["package_name"]
 
-    rospack = rospkg.RosPack()
+    if output_file is None:
+        rospack = rospkg.RosPack()
+        time = datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")
+        file_name = "optimized_" + time + ".urdf.xacro"
 
-    package_name = dataset["_metadata"]["package_name"]
+        path_to_urdf_directory = (rospack.get_path(package_name) + "/urdf/")
+        path_to_optimized_directory = (path_to_urdf_directory + "optimized/")
+
+        if not os.path.exists(path_to_optimized_directory):
+            os.mkdir(path_to_optimized_directory)
+        filename_results_xacro = path_to_optimized_directory + file_name
+        with open(filename_results_xacro, "w") as out:
+            out.write(URDF.to_xml_string(xml_robot))
 
-    path_to_urdf_directory = (rospack.get_path(package_name) + "/urdf/")
-    path_to_optimized_directory = (path_to_urdf_directory + "optimized/")
+        optimized_urdf_file = path_to_urdf_directory + 'optimized.urdf.xacro'
+        with open(optimized_urdf_file, "w", ) as out:
+            out.write(URDF.to_xml_string(xml_robot))
+            # print("Saving optimized.urdf.xacro in " + filename_results_xacro + ".")
 
-    if not os.path.exists(path_to_optimized_directory):
-        os.mkdir(path_to_optimized_directory)
-    filename_results_xacro = path_to_optimized_directory + file_name
-    with open(filename_results_xacro, "w") as out:
-        out.write(URDF.to_xml_string(xml_robot))
+        optimized_w_pattern_urdf_file = path_to_urdf_directory + 'optimized_w_pattern.urdf.xacro'
+    else:
+        filename_results_xacro = output_file
+        with open(filename_results_xacro, "w") as out:
+            out.write(URDF.to_xml_string(xml_robot))
 
-    optimized_urdf_file = path_to_urdf_directory + 'optimized.urdf.xacro'
-    with open(optimized_urdf_file, "w", ) as out:
-        out.write(URDF.to_xml_string(xml_robot))
-        # print("Saving optimized.urdf.xacro in " + filename_results_xacro + ".")
+        if output_file.endswith('.urdf.xacro'):
+            optimized_w_pattern_urdf_file = output_file[:-len('.urdf.xacro')] + '_w_pattern.urdf.xacro'
+        else:
+            root, extension = os.path.splitext(output_file)
+            optimized_w_pattern_urdf_file = root + '_w_pattern' + extension
 
     print("Optimized xacro saved to " + str(filename_results_xacro) + " . You can use it as a ROS robot_description.")
 
@@ -137,7 +157,6 @@ def saveResultsXacro(dataset, selected_collection_key, transforms_list):
         
         xml_robot.add_joint(pattern_joint)
 
-        optimized_w_pattern_urdf_file = path_to_urdf_directory + 'optimized_w_pattern.urdf.xacro'
         with open(optimized_w_pattern_urdf_file, "w", ) as out:
             out.write(URDF.to_xml_string(xml_robot))
 
@@ -0,0 +1,411 @@
+"""
+Evaluation of several pairs of sensors at once. The train and test datasets are loaded only once, and the images and
+point clouds of the test dataset are decoded only once, regardless of how many pairs of sensors use them.
+"""
+
+# -------------------------------------------------------------------------------
+# --- IMPORTS
+# -------------------------------------------------------------------------------
+
+# Standard imports
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from colorama import Fore, Style
+from prettytable import PrettyTable
+
+# Atom imports
+from atom_core.atom import getTransform
+from atom_core.dataset_io import (filterCollectionsFromDataset, getDepthImageFromDataset, getLabeledPointsFromDataset,
+                                  getMixedDataset, loadResultsJSON, readAnnotationFile)
+from atom_core.geometry import matrixToRodrigues, traslationRodriguesToTransform
+from atom_core.utilities import rootMeanSquare, saveFileResults
+from atom_core.vision import depthIdxsToPoints, depthInImage, projectToCamera
+from atom_evaluation.metrics import annotationsToArray, nearestNeighbors, pointsInsideImageMask
+from atom_evaluation.utilities import distortCorners, homographyFromTransform, undistortCorners
+
+# ------------------------
+# DATA STRUCTURES   ##
+# ------------------------
+MetricT = namedtuple('MetricT', 'header function')
+EvaluationT = namedtuple('EvaluationT', 'source target pattern_key inter_collection metric header errors')
+
+
+# -------------------------------------------------------------------------------
+# --- FUNCTIONS
+# -------------------------------------------------------------------------------
+def getModality(dataset, sensor_key):
+    modality = dataset['sensors'][sensor_key]['modality']
+    return 'lidar' if modality == 'lidar3d' else modality
+
+
+def getMetricKey(dataset, source, target):
+    """ Gets the key of the metric used to evaluate a pair of sensors, e.g. 'lidar_to_rgb'. """
+    key = getModality(dataset, source) + '_to_' + getModality(dataset, target)
+    if key not in metrics:
+        raise ValueError('Cannot evaluate sensor ' + source + ' against sensor ' + target + ': there is no ' + key +
+                         ' metric. Available metrics are ' + str(list(metrics.keys())) + '.')
+    return key
+
+
+def getSensorToSensorTransform(dataset, target, source, target_collection_key, source_collection_key):
+    """ Gets the transformation from the source sensor, in the source collection, to the target sensor, in the target
+    collection. Both collections are related through the world link. """
+    world_link = dataset['calibration_config']['world_link']
+    target_link = dataset['calibration_config']['sensors'][target]['link']
+    source_link = dataset['calibration_config']['sensors'][source]['link']
+    world_T_target = getTransform(world_link, target_link, dataset['collections'][target_collection_key]['transforms'])
+    world_T_source = getTransform(world_link, source_link, dataset['collections'][source_collection_key]['transforms'])
+    return np.dot(np.linalg.inv(world_T_target), world_T_source)
+
+
+def getIntrinsics(dataset, sensor_key):
+    """ Gets the intrinsic matrix (3x3) and distortion (5x1) of a camera. """
+    camera_info = dataset['sensors'][sensor_key]['camera_info']
+    K = np.reshape(np.array(camera_info['K'], dtype=float), (3, 3))
+    D = np.reshape(np.array(camera_info['D'][0:5], dtype=float), (5, 1))
+    return K, D
+
+
+def projectToSensor(dataset, sensor_key, points):
+    """ Projects points (4 x n), in the frame of a camera (rgb or depth), to its image. """
+    K, D = getIntrinsics(dataset, sensor_key)
+    camera_info = dataset['sensors'][sensor_key]['camera_info']
+    pts_in_image, _, _ = projectToCamera(K, D, camera_info['width'], camera_info['height'], points[0:3, :])
+    return pts_in_image
+
+
+def getDepthPoints(dataset, collection_key, pattern_key, sensor_key, label_key):
+    """ Gets the labelled pixels of a depth image as 3D points, an array (4 x n) of homogeneous coordinates. """
+    idxs = dataset['collections'][collection_key]['labels'][pattern_key][sensor_key][label_key]
+    image = getDepthImageFromDataset(dataset, collection_key, sensor_key)
+    return depthIdxsToPoints(image, idxs, dataset['sensors'][sensor_key]['camera_info'])
+
+
+def getSourcePoints(dataset, collection_key, pattern_key, sensor_key):
+    """ Gets the limit points of the pattern detected by a lidar or depth sensor, as an array (4 x n). """
+    if getModality(dataset, sensor_key) == 'lidar':
+        return getLabeledPointsFromDataset(dataset, collection_key, pattern_key, sensor_key, 'idxs_limit_points')
+    else:
+        return getDepthPoints(dataset, collection_key, pattern_key, sensor_key, 'idxs_limit_points')
+
+
+def pixelErrors(pts_in_image, ground_truth_pts, width, height, border_tolerance=0.0):
+    """ Computes the distance of each point projected to an image to the closest ground truth point. Points outside the
+    image, or inside the border of the image given by border_tolerance, are not considered.
+
+    :return: a NearestNeighborsT, or None if no points are considered.
+    """
+    inside = pointsInsideImageMask(pts_in_image, width, height, border_tolerance)
+    query_pts = pts_in_image[0:2, inside].transpose()
+    if query_pts.shape[0] == 0 or ground_truth_pts.shape[0] == 0:
+        return None
+
+    return nearestNeighbors(query_pts, ground_truth_pts)
+
+
+def errorStatistics(nearest):
+    """ Gets the rms, the average error in x and y and the standard deviation in x and y of the distances to the
+    nearest neighbours. """
+    total_pts = nearest.distances.shape[0]
+    rms = np.sqrt((nearest.distances ** 2).mean())
+    avg_error_x = np.sum(np.abs(nearest.deltas[:, 0])) / total_pts
+    avg_error_y = np.sum(np.abs(nearest.deltas[:, 1])) / total_pts
+    stdev_xy = np.std(nearest.deltas[:, 0:2], axis=0)
+    return [rms, avg_error_x, avg_error_y, stdev_xy[0], stdev_xy[1]]
+
+
+# -------------------------------------------------------------------------------
+# --- METRICS
+# -------------------------------------------------------------------------------
+# Each metric computes the errors of the source sensor, in the source collection, against the target sensor, in the
+# target collection. It returns a list of values, one per column of its header, or None if the errors cannot be
+# computed, e.g. if no points of the source sensor are projected to the image of the target sensor.
+
+def rangeToRgbErrors(engine, pattern_key, source, target, source_collection_key, target_collection_key):
+    """ Reprojection error of the limit points of a lidar or depth sensor to the annotated pattern borders of a camera.
+    """
+    dataset = engine.dataset
+    target_T_source = getSensorToSensorTransform(dataset, target, source, target_collection_key, source_collection_key)
+    points = np.dot(target_T_source, getSourcePoints(dataset, source_collection_key, pattern_key, source))
+    pts_in_image = projectToSensor(dataset, target, points)
+
+    camera_info = dataset['sensors'][target]['camera_info']
+    annotated_pts = annotationsToArray(engine.annotations[target][target_collection_key])
+    nearest = pixelErrors(pts_in_image, annotated_pts, camera_info['width'], camera_info['height'])
+    if nearest is None:
+        return None
+
+    return [rootMeanSquare(list(nearest.distances)), np.average(nearest.deltas[:, 0]),
+            np.average(nearest.deltas[:, 1])]
+
+
+def rangeToDepthErrors(engine, pattern_key, source, target, source_collection_key, target_collection_key):
+    """ Reprojection error of the limit points of a lidar or depth sensor to the limit points (or the annotated pattern
+    borders) of a depth sensor. """
+    dataset = engine.dataset
+    target_T_source = getSensorToSensorTransform(dataset, target, source, target_collection_key, source_collection_key)
+    points = np.dot(target_T_source, getSourcePoints(dataset, source_collection_key, pattern_key, source))
+    pts_in_image = projectToSensor(dataset, target, points)
+
+    if engine.args['use_annotations']:
+        ground_truth_pts = annotationsToArray(engine.annotations[target][target_collection_key])
+    else:
+        ground_truth_pts = depthInImage(dataset, target_collection_key, pattern_key, target).transpose()
+
+    camera_info = dataset['sensors'][target]['camera_info']
+    nearest = pixelErrors(pts_in_image, ground_truth_pts, camera_info['width'], camera_info['height'],
+                          engine.args['border_tolerance'])
+    if nearest is None:
+        return None
+
+    return errorStatistics(nearest)
+
+
+def lidarToLidarErrors(engine, pattern_key, source, target, source_collection_key, target_collection_key):
+    """ Distance of the labelled points of the target lidar to the closest labelled points of the source lidar. """
+    dataset = engine.dataset
+    target_T_source = getSensorToSensorTransform(dataset, target, source, target_collection_key, source_collection_key)
+    source_pts = getLabeledPointsFromDataset(dataset, source_collection_key, pattern_key, source, 'idxs')
+    source_pts = np.dot(target_T_source, source_pts)
+    target_pts = getLabeledPointsFromDataset(dataset, target_collection_key, pattern_key, target, 'idxs')
+    if target_pts.shape[1] == 0 or source_pts.shape[1] == 0:
+        return None
+
+    return errorStatistics(nearestNeighbors(target_pts[0:3, :].transpose(), source_pts[0:3, :].transpose()))
+
+
+def rgbToRgbErrors(engine, pattern_key, source, target, source_collection_key, target_collection_key):
+    """ Error of the corners detected by the source camera, projected to the target camera through the homography of
+    the pattern plane, to the corners detected by the target camera, as well as the translation and rotation errors
+    between the poses of the pattern estimated by each camera. See rgb_to_rgb_evaluation. """
+    dataset = engine.dataset
+    pattern = dataset['calibration_config']['calibration_patterns'][pattern_key]
+    labels_s = dataset['collections'][source_collection_key]['labels'][pattern_key][source]['idxs']
+    labels_t = dataset['collections'][target_collection_key]['labels'][pattern_key][target]['idxs']
+    K_s, D_s = getIntrinsics(dataset, source)
+    K_t, D_t = getIntrinsics(dataset, target)
+
+    corners_s = np.array([[p['x'] for p in labels_s], [p['y'] for p in labels_s], np.ones(len(labels_s))], float)
+    corners_t = np.array([[p['x'] for p in labels_t], [p['y'] for p in labels_t], np.ones(len(labels_t))], float)
+    idxs_s = [p['id'] for p in labels_s]
+    idxs_t = [p['id'] for p in labels_t]
+
+    # Corners detected by both cameras
+    column_t = {corner_id: idx for idx, corner_id in enumerate(idxs_t)}
+    correspondences = [(idx, column_t[corner_id]) for idx, corner_id in enumerate(idxs_s) if corner_id in column_t]
+    if not correspondences:
+        return None
+
+    # Corner coordinates in the pattern's local coordinate frame, and poses of the pattern in each camera
+    nx, ny, square = pattern['dimension']['x'], pattern['dimension']['y'], pattern['size']
+    objp = np.zeros((nx * ny, 3), float)
+    objp[:, :2] = square * np.mgrid[0:nx, 0:ny].T.reshape(-1, 2)
+    _, rvecs, tvecs = cv2.solvePnP(objp[idxs_s], np.array(corners_s[0:2, :].T, dtype=np.float32), K_s, D_s)
+    ss_T_p = traslationRodriguesToTransform(tvecs, rvecs)
+    _, rvecs, tvecs = cv2.solvePnP(objp[idxs_t], np.array(corners_t[0:2, :].T, dtype=np.float32), K_t, D_t)
+    st_T_p_detected = traslationRodriguesToTransform(tvecs, rvecs)
+
+    # Project the corners of the source camera to the target camera through the homography of the pattern's plane
+    st_T_ss = getSensorToSensorTransform(dataset, target, source, target_collection_key, source_collection_key)
+    st_T_p = np.dot(st_T_ss, ss_T_p)
+    ss_H_p = np.dot(K_s, homographyFromTransform(ss_T_p))
+    st_H_p = np.dot(K_t, homographyFromTransform(st_T_p))
+    st_H_ss = np.dot(st_H_p, np.linalg.inv(ss_H_p))  # combined homography
+
+    ucorners_s_proj_to_t = np.dot(st_H_ss, undistortCorners(corners_s, K_s, D_s))
+    ucorners_s_proj_to_t = ucorners_s_proj_to_t / np.tile(ucorners_s_proj_to_t[2, :], (3, 1))
+    corners_s_proj_to_t = distortCorners(ucorners_s_proj_to_t, K_t, D_t)
+
+    idxs_s_corr, idxs_t_corr = np.array(correspondences).transpose()
+    deltas = np.abs(corners_t[0:2, idxs_t_corr] - corners_s_proj_to_t[0:2, idxs_s_corr])
+
+    # Translation and rotation errors between the poses of the pattern in the world, as seen by each camera
+    world_link = dataset['calibration_config']['world_link']
+    source_link = dataset['calibration_config']['sensors'][source]['link']
+    target_link = dataset['calibration_config']['sensors'][target]['link']
+    pattern_pose_source = np.dot(getTransform(world_link, source_link,
+                                              dataset['collections'][source_collection_key]['transforms']), ss_T_p)
+    pattern_pose_target = np.dot(getTransform(world_link, target_link,
+                                              dataset['collections'][target_collection_key]['transforms']),
+                                 st_T_p_detected)
+    delta = np.dot(np.linalg.inv(pattern_pose_source), pattern_pose_target)
+
+    return [rootMeanSquare(list(np.sqrt(np.sum(deltas ** 2, axis=0)))), np.average(deltas[0, :]),
+            np.average(deltas[1, :]), np.linalg.norm(delta[0:3, 3]) * 1000,
+            np.linalg.norm(matrixToRodrigues(delta[0:3, 0:3])) * 180.0 / np.pi]
+
+
+metrics = {'rgb_to_rgb': MetricT(['RMS (pix)', 'X err (pix)', 'Y err (pix)', 'Trans (mm)', 'Rot (deg)'],
+                                 rgbToRgbErrors),
+           'lidar_to_rgb': MetricT(['RMS (pix)', 'X err (pix)', 'Y err (pix)'], rangeToRgbErrors),
+           'depth_to_rgb': MetricT(['RMS (pix)', 'X err (pix)', 'Y err (pix)'], rangeToRgbErrors),
+           'lidar_to_depth': MetricT(['RMS (pix)', 'X err (pix)', 'Y err (pix)', 'X StDev (pix)', 'Y StDev (pix)'],
+                                     rangeToDepthErrors),
+           'depth_to_depth': MetricT(['RMS (pix)', 'X err (pix)', 'Y err (pix)', 'X StDev (pix)', 'Y StDev (pix)'],
+                                     rangeToDepthErrors),
+           'lidar_to_lidar': MetricT(['RMS (m)', 'X err (m)', 'Y err (m)', 'X StDev (m)', 'Y StDev (m)'],
+                                     lidarToLidarErrors)}
+
+
+# -------------------------------------------------------------------------------
+# --- TABLES
+# -------------------------------------------------------------------------------
+def getEvaluationTables(evaluation):
+    """ Builds the table of errors per collection of an evaluation, with a bottom row of averages and the largest error
+    of each column in red.
+
+    :return: the table to print and the table to save, without colors.
+    """
+    table_header = ['Collection Pair' if evaluation.inter_collection else 'Collection #'] + evaluation.header
+    table = PrettyTable(table_header)
+    table_to_save = PrettyTable(table_header)
+
+    for collection_label, values in evaluation.errors.items():
+        if values is None:
+            continue
+        row = [str(collection_label)] + ['%.4f' % value for value in values]
+        table.add_row(row)
+        table_to_save.add_row(row)
+
+    valid_errors = np.array([v for v in evaluation.errors.values() if v is not None], dtype=float)
+    if valid_errors.shape[0] == 0:
+        return table, table_to_save
+
+    averages = ['%.4f' % value for value in np.mean(valid_errors, axis=0)]
+    table.add_row([Fore.BLUE + Style.BRIGHT + 'Averages' + Style.RESET_ALL] +
+                  [Fore.BLUE + value + Style.RESET_ALL for value in averages])
+    table_to_save.add_row(['Averages'] + averages)
+
+    # Put larger errors in red per column
+    for col_idx, max_row_idx in enumerate(np.argmax(valid_errors, axis=0)):
+        table.rows[max_row_idx][col_idx + 1] = Fore.RED + table.rows[max_row_idx][col_idx + 1] + Style.RESET_ALL
+
+    table.align = 'c'
+    table_to_save.align = 'c'
+    return table, table_to_save
+
+
+# -------------------------------------------------------------------------------
+# --- CLASS
+# -------------------------------------------------------------------------------
+class EvaluationEngine:
+    """
+    Evaluates the calibration of several pairs of sensors, with the calibrated transforms and intrinsics of a train
+    dataset and the collections of a test dataset. Both datasets are loaded once, and the data of the test dataset is
+    decoded only when first used, and then shared by all evaluations (see atom_core.sensor_data_store).
+
+    The metric of each pair of sensors is selected after their modalities (see metrics). The errors of each pair of
+    collections are computed in parallel.
+    """
+
+    def __init__(self, args):
+        """
+        :param args: a dictionary with 'train_json_file', 'test_json_file', 'collection_selection_function',
+        'use_incomplete_collections', 'remove_partial_detections', 'border_tolerance' and 'use_annotations'.
+        """
+        self.args = args
+
+        # Loads the train json file containing the calibration results. Its sensor data is never used.
+        self.train_dataset, self.train_json_file = loadResultsJSON(args['train_json_file'],
+                                                                   args['collection_selection_function'],
+                                                                   use_sensor_data_store=True, lazy_loading=True)
+
+        # Loads the test json file containing a set of collections to evaluate the calibration
+        test_dataset, self.test_json_file = loadResultsJSON(args['test_json_file'],
+                                                            args['collection_selection_function'],
+                                                            use_sensor_data_store=True, lazy_loading=True)
+        test_dataset = filterCollectionsFromDataset(test_dataset, args)
+
+        # Mixed dataset with the calibrated transforms from train and the rest from test
+        self.dataset = getMixedDataset(self.train_dataset, test_dataset)
+        self.annotations = {}  # key=sensor_key, value=annotations of the sensor in the test dataset
+
+    def loadAnnotations(self, sensor_key):
+        if sensor_key not in self.annotations:
+            self.annotations[sensor_key], _ = readAnnotationFile(self.test_json_file, sensor_key)
+
+    def getCollectionPairs(self, pattern_key, source, target, inter_collection):
+        """ Gets the pairs (source collection, target collection) in which the pattern was detected by both sensors.
+        Without inter collection, each collection is paired with itself. """
+        collections = self.dataset['collections']
+        keys = sorted(collections.keys(), key=lambda key: int(key))
+        source_keys = [k for k in keys if collections[k]['labels'][pattern_key][source]['detected']]
+        target_keys = [k for k in keys if collections[k]['labels'][pattern_key][target]['detected']]
+
+        if inter_collection:
+            return [(source_key, target_key) for source_key in source_keys for target_key in target_keys]
+        else:
+            return [(key, key) for key in source_keys if key in target_keys]
+
+    def evaluate(self, sensor_pairs, inter_collection=False, pattern_keys=None, number_of_workers=1):
+        """ Evaluates several pairs of sensors.
+
+        :param sensor_pairs: a list of tuples (source sensor, target sensor)
+        :param inter_collection: if True, each collection of the source sensor is evaluated against each collection of
+        the target sensor. Only patterns which are fixed are evaluated.
+        :param pattern_keys: the patterns to evaluate. All patterns if None.
+        :param number_of_workers: number of threads computing the errors.
+        :return: a list with an EvaluationT for each pair of sensors and pattern.
+        """
+        if pattern_keys is None:
+            pattern_keys = list(self.dataset['calibration_config']['calibration_patterns'].keys())
+
+        # Check the pairs and load the annotations before starting, so that errors are reported at once
+        for source, target in sensor_pairs:
+            metric_key = getMetricKey(self.dataset, source, target)
+            if metric_key in ['lidar_to_rgb', 'depth_to_rgb'] or \
+                    (metric_key in ['lidar_to_depth', 'depth_to_depth'] and self.args['use_annotations']):
+                self.loadAnnotations(target)
+
+        executor = ThreadPoolExecutor(max_workers=number_of_workers)
+        evaluations = []
+        for source, target in sensor_pairs:
+            metric_key = getMetricKey(self.dataset, source, target)
+            for pattern_key in pattern_keys:
+                pattern = self.dataset['calibration_config']['calibration_patterns'][pattern_key]
+                if inter_collection and not pattern['fixed']:
+                    print(Fore.YELLOW + pattern_key + ' is not fixed, inter collection evaluation of ' + source +
+                          ' to ' + target + ' is disabled.' + Style.RESET_ALL)
+                    continue
+
+                futures = OrderedDict()
+                for source_collection_key, target_collection_key in \
+                        self.getCollectionPairs(pattern_key, source, target, inter_collection):
+                    label = (source_collection_key, target_collection_key) if inter_collection \
+                        else source_collection_key
+                    futures[label] = executor.submit(metrics[metric_key].function, self, pattern_key, source, target,
+                                                     source_collection_key, target_collection_key)
+
+                evaluations.append((EvaluationT(source, target, pattern_key, inter_collection, metric_key,
+                                                metrics[metric_key].header, OrderedDict()), futures))
+
+        for evaluation, futures in evaluations:  # collect the errors, in order
+            for label, future in futures.items():
+                evaluation.errors[label] = future.result()
+
+        executor.shutdown(wait=True)
+        return [evaluation for evaluation, _ in evaluations]
+
+    def report(self, evaluations, save_file_results=False):
+        """ Prints the table of errors of each evaluation and, if save_file_results, saves them to csv files in the
+        results folder of the test dataset (see atom_core.utilities.saveFileResults). """
+        for evaluation in evaluations:
+            table, table_to_save = getEvaluationTables(evaluation)
+            print(Style.BRIGHT + '\nErrors per collection' + Style.RESET_ALL + ' of ' + Fore.BLUE + evaluation.source +
+                  Style.RESET_ALL + ' to ' + Fore.BLUE + evaluation.target + Style.RESET_ALL + ' (' +
+                  evaluation.metric + ', pattern ' + evaluation.pattern_key + ')')
+            print(table)
+
+            skipped = [str(label) for label, values in evaluation.errors.items() if values is None]
+            if skipped:
+                print(Fore.YELLOW + 'No errors could be computed for collections ' + ', '.join(skipped) +
+                      Style.RESET_ALL)
+
+            if save_file_results:
+                prefix = 'inter_collection_' if evaluation.inter_collection else ''
+                results_name = prefix + evaluation.source + '_to_' + evaluation.target + '_' + \
+                    evaluation.pattern_key + '_results.csv'
+                saveFileResults(self.train_json_file, self.test_json_file, results_name, table_to_save)
@@ -0,0 +1,71 @@
+"""
+ATOM evaluation metrics, based on the nearest neighbours between two sets of points.
+"""
+
+# -------------------------------------------------------------------------------
+# --- IMPORTS
+# -------------------------------------------------------------------------------
+
+from collections import namedtuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# ------------------------
+# DATA STRUCTURES   ##
+# ------------------------
+NearestNeighborsT = namedtuple('NearestNeighborsT', 'distances deltas idxs')
+
+
+# -------------------------------------------------------------------------------
+# --- FUNCTIONS
+# -------------------------------------------------------------------------------
+def nearestNeighbors(query_points, reference_points):
+    """ Finds, for each query point, the nearest reference point. All query points are searched at once in a kd-tree
+    of the reference points.
+
+    :param query_points: an array (number of query points x dimensions)
+    :param reference_points: an array (number of reference points x dimensions)
+    :return: a NearestNeighborsT with, for each query point, the distance to its nearest reference point (n), the
+    absolute difference to it in each axis (n x dimensions), and its index in reference_points (n).
+    """
+    reference_points = np.asarray(reference_points, dtype=float)
+    query_points = np.asarray(query_points, dtype=float).reshape((-1, reference_points.shape[-1]))
+    if query_points.shape[0] == 0:
+        return NearestNeighborsT(np.zeros((0,)), np.zeros(query_points.shape), np.zeros((0,), dtype=int))
+    if reference_points.shape[0] == 0:
+        raise ValueError('Cannot search for nearest neighbours without reference points.')
+
+    distances, idxs = cKDTree(reference_points).query(query_points, k=1)
+    deltas = np.abs(query_points - reference_points[idxs])
+    return NearestNeighborsT(distances, deltas, idxs)
+
+
+def annotationsToArray(annotations, sides=None):
+    """ Gets the points of the annotation of the pattern borders in a collection as an array.
+
+    :param annotations: the annotations of a collection, a dictionary with keys the sides of the pattern, each with
+    the coordinates 'ixs' and 'iys' of the annotated points.
+    :param sides: the sides to get the points from. All sides if None.
+    :return: an array (number of points x 2)
+    """
+    if sides is None:
+        sides = annotations.keys()
+
+    xs = [x for side in sides for x in annotations[side]['ixs']]
+    ys = [y for side in sides for y in annotations[side]['iys']]
+    return np.array([xs, ys], dtype=float).reshape((2, -1)).transpose()
+
+
+def pointsInsideImageMask(points, width, height, border_tolerance=0.0):
+    """ Checks which image points are inside the image, excluding a border.
+
+    :param points: an array (2 x number of points) with the x and y coordinates of the points
+    :param width: width of the image
+    :param height: height of the image
+    :param border_tolerance: fraction of the width and height of the image excluded at each side
+    :return: a boolean array (number of points)
+    """
+    xs, ys = points[0, :], points[1, :]
+    return np.logical_and.reduce([xs >= width * border_tolerance, xs <= width * (1 - border_tolerance),
+                                  ys >= height * border_tolerance, ys <= height * (1 - border_tolerance)])
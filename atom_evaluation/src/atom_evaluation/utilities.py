@@ -8,6 +8,7 @@ ATOM evaluation utilities
 
 import numpy as np
 import math
+import cv2
 from atom_core.atom import getTransform
 
 
@@ -145,3 +146,64 @@ def averageTransforms(l_transforms):
     avg_q = tuple(avg_q)
 
     return (avg_t, avg_q)
+
+
+def homographyFromTransform(T):
+    H = np.zeros((3, 3), float)
+
+    H[0, 0] = T[0, 0]
+    H[0, 1] = T[0, 1]
+    H[0, 2] = T[0, 3]
+
+    H[1, 0] = T[1, 0]
+    H[1, 1] = T[1, 1]
+    H[1, 2] = T[1, 3]
+
+    H[2, 0] = T[2, 0]
+    H[2, 1] = T[2, 1]
+    H[2, 2] = T[2, 3]
+
+    return H
+
+
+def undistortCorners(pts_in, K, D):
+    """ Remove distortion from corner points. """
+
+    # Assume points are represented as:
+    # pt = [x1 x2 x3 ... xn]
+    #      [y1 y2 y3 ... yn]
+    #      [ 1  1  1 ...  1] ( optional)
+
+    # remove homogeneous coordinate, and transpose since opencv needs the transposed notation
+    points2 = cv2.undistortPoints(pts_in[0:2].T, K, D)
+
+    fx, fy, cx, cy = K[0, 0], K[1, 1], K[0, 2], K[1, 2]
+
+    undistorted_corners = np.ones((3, pts_in.shape[1]), np.float32)
+    undistorted_corners[0, :] = points2[:, 0, 0] * fx + cx
+    undistorted_corners[1, :] = points2[:, 0, 1] * fy + cy
+
+    return undistorted_corners
+
+
+def distortCorners(corners, K, D):
+    # from https://docs.opencv.org/2.4/modules/calib3d/doc/camera_calibration_and_3d_reconstruction.html
+    # where it says x'' = ... x'o
+
+    fx, fy, cx, cy = K[0, 0], K[1, 1], K[0, 2], K[1, 2]
+    k1, k2, p1, p2, k3 = D
+
+    # # compute the homogeneous image coordinates (non pixels)
+    xl = (corners[0, :] - cx) / fx
+    yl = (corners[1, :] - cy) / fy
+
+    # # apply undistortion
+    r2 = xl ** 2 + yl ** 2  # r square (used multiple times bellow)
+    xll = xl * (1 + k1 * r2 + k2 * r2 ** 2 + k3 * r2 ** 3) + 2 * p1 * xl * yl + p2 * (r2 + 2 * xl ** 2)
+    yll = yl * (1 + k1 * r2 + k2 * r2 ** 2 + k3 * r2 ** 3) + p1 * (r2 + 2 * yl ** 2) + 2 * p2 * xl * yl
+
+    distorted_corners = np.ones((3, corners.shape[1]), np.float32)
+    distorted_corners[0, :] = xll * fx + cx
+    distorted_corners[1, :] = yll * fy + cy
+
+    return distorted_corners